@@ -13,6 +13,7 @@ DEBUG = os.getenv('DEBUG', 'False') == 'True'
 ALLOWED_HOSTS = os.getenv('ALLOWED_HOSTS', 'localhost,127.0.0.1').split(',')
 
 INSTALLED_APPS = [
+    'daphne',  # runserver serves ASGI (HTTP + WebSockets)
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -22,6 +23,7 @@ INSTALLED_APPS = [
     'rest_framework',
     'corsheaders',
     'django_cleanup.apps.CleanupConfig',  # Ensure file cleanup is active
+    'channels',
     'music',
 ]
 
@@ -53,6 +55,8 @@ TEMPLATES = [{
 }]
 
 WSGI_APPLICATION = 'config.wsgi.application'
+# WebSockets (music.routing) are served by the ASGI app: daphne config.asgi:application
+ASGI_APPLICATION = 'config.asgi.application'
 
 DATABASES = {
     'default': {
@@ -83,9 +87,11 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # File Upload Settings
 MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', 100)) * 1024 * 1024  # 100MB default
 DATA_UPLOAD_MAX_MEMORY_SIZE = MAX_UPLOAD_SIZE  # Max size for in-memory uploads
-FILE_UPLOAD_MAX_MEMORY_SIZE = MAX_UPLOAD_SIZE  # Max size before writing to disk
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE', 2621440))  # 2.5MB before spooling to disk
 
-# File upload handlers
+# File upload handlers (audio upload views additionally install
+# music.utils.uploads.StreamingAudioUploadHandler, which writes straight
+# into tracks/ and hashes while receiving)
 FILE_UPLOAD_HANDLERS = [
     'django.core.files.uploadhandler.MemoryFileUploadHandler',
     'django.core.files.uploadhandler.TemporaryFileUploadHandler',
@@ -93,6 +99,160 @@ FILE_UPLOAD_HANDLERS = [
 
 SUPPORTED_FORMATS = os.getenv('SUPPORTED_FORMATS', 'mp3,flac,ogg,m4a,wav').split(',')
 
+# Resumable chunked uploads
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 8)) * 1024 * 1024  # 8MB max per PUT
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv('UPLOAD_SESSION_TTL_HOURS', 24))  # Idle time before GC
+
+# Cache - shared between web and Celery workers when Redis is configured
+REDIS_URL = os.getenv('REDIS_URL', '')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Channel layer for WebSocket groups, shared by ASGI servers and workers.
+# CHANNEL_REDIS_URLS lists one Redis per shard (comma-separated); channels
+# and groups are spread over them by consistent hashing
+CHANNEL_REDIS_URLS = [url for url in os.getenv('CHANNEL_REDIS_URLS', REDIS_URL).split(',') if url]
+if CHANNEL_REDIS_URLS:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': CHANNEL_REDIS_URLS,
+                'capacity': int(os.getenv('CHANNEL_LAYER_CAPACITY', 1000)),  # Messages queued per channel
+                'expiry': 30,
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
+    }
+
+# Parsed audio metadata is cached by content hash (30 days default)
+METADATA_PROBE_CACHE_TIMEOUT = int(os.getenv('METADATA_PROBE_CACHE_TIMEOUT', 60 * 60 * 24 * 30))
+
+# yt-dlp extraction results, keyed by canonical media id (stream URLs expire)
+DOWNLOAD_INFO_CACHE_TIMEOUT = int(os.getenv('DOWNLOAD_INFO_CACHE_TIMEOUT', 600))
+
+# Playlist imports: child downloads running at once per import, and max items
+DOWNLOAD_BATCH_CONCURRENCY = int(os.getenv('DOWNLOAD_BATCH_CONCURRENCY', 4))
+DOWNLOAD_PLAYLIST_MAX_ITEMS = int(os.getenv('DOWNLOAD_PLAYLIST_MAX_ITEMS', 500))
+
+# Running download slots expire after this many seconds if never released
+DOWNLOAD_SLOT_LEASE = int(os.getenv('DOWNLOAD_SLOT_LEASE', 60 * 60))
+
+# Running download stages refresh a heartbeat every N seconds; one silent for
+# DOWNLOAD_STALE_AFTER seconds is requeued by reap_stale_downloads
+DOWNLOAD_HEARTBEAT_INTERVAL = int(os.getenv('DOWNLOAD_HEARTBEAT_INTERVAL', 30))
+DOWNLOAD_STALE_AFTER = int(os.getenv('DOWNLOAD_STALE_AFTER', 5 * 60))
+# Running tasks with no heartbeat at all (stage message lost, worker died
+# before its first beat, cache flushed) are requeued once started this many
+# seconds ago; keep it above the longest queue wait between stages
+DOWNLOAD_LOST_AFTER = int(os.getenv('DOWNLOAD_LOST_AFTER', 2 * 60 * 60))
+# Scratch directories in downloads/temp no live task uses are removed after
+# this many seconds
+DOWNLOAD_TEMP_MAX_AGE = int(os.getenv('DOWNLOAD_TEMP_MAX_AGE', 6 * 60 * 60))
+# New fetches wait while downloads/temp holds more than this (MB, 0 = no
+# limit) or the media volume has less than DOWNLOAD_SCRATCH_MIN_FREE MB free
+DOWNLOAD_SCRATCH_QUOTA = int(os.getenv('DOWNLOAD_SCRATCH_QUOTA', 10 * 1024))
+DOWNLOAD_SCRATCH_MIN_FREE = int(os.getenv('DOWNLOAD_SCRATCH_MIN_FREE', 1024))
+
+# Circuit breaker: N transient failures of a source within the window (s)
+# pause all its downloads for the cooldown (s)
+DOWNLOAD_BREAKER_THRESHOLD = int(os.getenv('DOWNLOAD_BREAKER_THRESHOLD', 5))
+DOWNLOAD_BREAKER_WINDOW = int(os.getenv('DOWNLOAD_BREAKER_WINDOW', 5 * 60))
+DOWNLOAD_BREAKER_COOLDOWN = int(os.getenv('DOWNLOAD_BREAKER_COOLDOWN', 10 * 60))
+
+# Async fetch worker (manage.py fetch_worker): fetches in flight per process,
+# per source, and fetched files allowed to wait for transcode before it pauses
+DOWNLOAD_ASYNC_FETCH_CONCURRENCY = int(os.getenv('DOWNLOAD_ASYNC_FETCH_CONCURRENCY', 50))
+DOWNLOAD_ASYNC_SOURCE_CONCURRENCY = int(os.getenv('DOWNLOAD_ASYNC_SOURCE_CONCURRENCY', 16))
+DOWNLOAD_TRANSCODE_BACKLOG = int(os.getenv('DOWNLOAD_TRANSCODE_BACKLOG', 100))
+
+# Live download progress: minimum seconds between published updates per task
+DOWNLOAD_PROGRESS_INTERVAL = float(os.getenv('DOWNLOAD_PROGRESS_INTERVAL', 0.5))
+
+# Seconds between cancellation checks of a running download or ffmpeg job
+DOWNLOAD_CANCEL_CHECK_INTERVAL = float(os.getenv('DOWNLOAD_CANCEL_CHECK_INTERVAL', 2))
+
+# Download backend class; benchmarks swap in the offline fake
+# (music.utils.benchmark.FakeMediaDownloader, see benchmark_downloads)
+DOWNLOADER_BACKEND = os.getenv('DOWNLOADER_BACKEND', 'music.utils.downloader.MediaDownloader')
+
+# Fake backend: extraction latency (s), transfer rate (MB/s), clip length (s), transcode time (s)
+FAKE_DOWNLOAD_LATENCY = float(os.getenv('FAKE_DOWNLOAD_LATENCY', 0.2))
+FAKE_DOWNLOAD_THROUGHPUT = float(os.getenv('FAKE_DOWNLOAD_THROUGHPUT', 20))
+FAKE_DOWNLOAD_DURATION = int(os.getenv('FAKE_DOWNLOAD_DURATION', 30))
+FAKE_TRANSCODE_SECONDS = float(os.getenv('FAKE_TRANSCODE_SECONDS', 0.1))
+
+# Seconds a listener stays counted without a WebSocket ping
+LISTENER_PRESENCE_TTL = int(os.getenv('LISTENER_PRESENCE_TTL', 90))
+# Listener counts are broadcast at most once per track per this many seconds
+LISTENER_BROADCAST_INTERVAL = float(os.getenv('LISTENER_BROADCAST_INTERVAL', 2))
+
+# "Playing now" board: tracks shown, window (s) and snapshot cadence (s)
+NOW_PLAYING_TOP_K = int(os.getenv('NOW_PLAYING_TOP_K', 10))
+NOW_PLAYING_WINDOW = int(os.getenv('NOW_PLAYING_WINDOW', 300))
+NOW_PLAYING_INTERVAL = float(os.getenv('NOW_PLAYING_INTERVAL', 5))
+# Play starts a connection may report per minute, and in a burst
+NOW_PLAYING_STARTS_PER_MINUTE = int(os.getenv('NOW_PLAYING_STARTS_PER_MINUTE', 6))
+NOW_PLAYING_START_BURST = int(os.getenv('NOW_PLAYING_START_BURST', 3))
+
+# Artist/album/genre name -> id resolver (in-process LRU + shared cache)
+ENTITY_RESOLVER_CACHE_SIZE = int(os.getenv('ENTITY_RESOLVER_CACHE_SIZE', 4096))
+ENTITY_RESOLVER_CACHE_TIMEOUT = int(os.getenv('ENTITY_RESOLVER_CACHE_TIMEOUT', 60 * 60 * 24))
+
+# Celery
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', REDIS_URL or 'redis://localhost:6379/0')
+CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', CELERY_BROKER_URL)
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_ACCEPT_CONTENT = ['json']
+CELERY_TIMEZONE = TIME_ZONE
+# Download pipeline stages get their own queues so worker pools can be
+# sized per bottleneck (network-bound fetch, CPU-bound transcode)
+DOWNLOAD_STAGE_QUEUES = {
+    'music.tasks.process_download_task': 'extract',
+    'music.tasks.fetch_download': 'fetch',
+    'music.tasks.transcode_download': 'transcode',
+    'music.tasks.ingest_download': 'ingest',
+}
+# Prefixed onto the stage queues (benchmark_downloads runs its own set)
+DOWNLOAD_QUEUE_PREFIX = os.getenv('DOWNLOAD_QUEUE_PREFIX', '')
+CELERY_TASK_ROUTES = {
+    name: {'queue': f'{DOWNLOAD_QUEUE_PREFIX}{queue}'} for name, queue in DOWNLOAD_STAGE_QUEUES.items()
+}
+CELERY_BEAT_SCHEDULE = {
+    'cleanup-old-failed-tasks': {
+        'task': 'music.tasks.cleanup_old_failed_tasks',
+        'schedule': 60 * 60 * 24,
+    },
+    'retry-failed-downloads': {
+        'task': 'music.tasks.retry_failed_downloads',
+        'schedule': 60 * 60 * 6,
+    },
+    'reap-stale-downloads': {
+        'task': 'music.tasks.reap_stale_downloads',
+        'schedule': 60,
+    },
+    'cleanup-abandoned-upload-sessions': {
+        'task': 'music.tasks.cleanup_abandoned_upload_sessions',
+        'schedule': 60 * 60,
+    },
+}
+
 # Security Settings for Production
 if not DEBUG:
     SECURE_SSL_REDIRECT = os.getenv('SECURE_SSL_REDIRECT', 'True') == 'True'
@@ -18,7 +18,7 @@ from django.urls import reverse
 from django.db.models import Sum, Count
 from .models import (
     Genre, Artist, Album, MusicFile, Playlist, 
-    Favorite, SystemSettings, UploadSession, DownloadTask
+    Favorite, SystemSettings, UploadSession, ChunkedUpload, DownloadTask
 )
 
 
@@ -54,7 +54,7 @@ class MusicStreamAdminSite(admin.AdminSite):
                 status='completed'
             ).order_by('-created_at')[:5],
             'active_downloads': DownloadTask.objects.filter(
-                status__in=['pending', 'downloading', 'processing']
+                status__in=DownloadTask.ACTIVE_STATUSES
             ).count(),
         }
         
@@ -176,13 +176,14 @@ class AlbumAdmin(admin.ModelAdmin):
 class MusicFileAdmin(admin.ModelAdmin):
     list_display = (
         'title', 'artist', 'album', 'format_badge', 
-        'duration_display', 'play_count_badge', 'audio_preview'
+        'duration_display', 'play_count_badge', 'processing_status', 'audio_preview'
     )
-    list_filter = ('artist', 'album', 'genre', 'format', 'created_at')
+    list_filter = ('artist', 'album', 'genre', 'format', 'processing_status', 'created_at')
     search_fields = ('title', 'artist__name', 'album__title')
     readonly_fields = (
         'created_at', 'updated_at', 'file_size_display', 
-        'duration', 'play_count', 'download_count', 'audio_player'
+        'duration', 'play_count', 'download_count', 'audio_player',
+        'processing_status', 'content_hash'
     )
     ordering = ('-created_at',)
     autocomplete_fields = ['artist', 'album', 'genre']
@@ -192,10 +193,10 @@ class MusicFileAdmin(admin.ModelAdmin):
             'fields': ('title', 'artist', 'album', 'genre')
         }),
         ('File', {
-            'fields': ('file', 'format', 'file_size_display')
+            'fields': ('file', 'format', 'file_size_display', 'content_hash')
         }),
         ('Metadata', {
-            'fields': ('duration', 'bitrate'),
+            'fields': ('duration', 'bitrate', 'processing_status'),
             'classes': ('collapse',)
         }),
         ('Statistics', {
@@ -285,7 +286,7 @@ class MusicFileAdmin(admin.ModelAdmin):
     
     def extract_metadata(self, request, queryset):
         for track in queryset:
-            track.save()  # Triggers metadata extraction
+            track.refresh_metadata()  # Cached by content hash
         self.message_user(
             request, 
             f"Metadata extracted for {queryset.count()} tracks."
@@ -318,6 +319,12 @@ class SystemSettingsAdmin(admin.ModelAdmin):
                 'normalize_audio'
             )
         }),
+        ('Download Scheduling', {
+            'fields': (
+                'download_rate_per_minute', 'download_burst',
+                'download_max_concurrent', 'download_source_limits'
+            )
+        }),
         ('UI Settings', {
             'fields': ('default_theme', 'enable_animations')
         }),
@@ -348,6 +355,26 @@ class SystemSettingsAdmin(admin.ModelAdmin):
 # Upload Session Admin
 # ============================================================================
 
+class ChunkedUploadInline(admin.TabularInline):
+    model = ChunkedUpload
+    extra = 0
+    can_delete = False
+    fields = (
+        'filename', 'status', 'received_display',
+        'result_track', 'error_message', 'updated_at'
+    )
+    readonly_fields = fields
+    
+    def received_display(self, obj):
+        if not obj.total_size:
+            return "—"
+        return f"{obj.bytes_received * 100 // obj.total_size}% ({len(obj.received_ranges)} ranges)"
+    received_display.short_description = "Received"
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(UploadSession, site=admin_site)
 class UploadSessionAdmin(admin.ModelAdmin):
     list_display = (
@@ -362,6 +389,7 @@ class UploadSessionAdmin(admin.ModelAdmin):
         'created_at', 'completed_at'
     )
     ordering = ('-created_at',)
+    inlines = [ChunkedUploadInline]
     
     def id_short(self, obj):
         return str(obj.id)[:8]
@@ -414,22 +442,23 @@ class DownloadTaskAdmin(admin.ModelAdmin):
         'id_short', 'user', 'source_type', 'status_badge',
         'progress_bar', 'result_link', 'created_at'
     )
-    list_filter = ('status', 'source_type', 'user', 'created_at')
-    search_fields = ('user__username', 'url', 'original_title', 'id')
+    list_filter = ('status', 'source_type', 'error_kind', 'user', 'created_at')
+    search_fields = ('user__username', 'url', 'original_title', 'id', 'media_id')
     readonly_fields = (
-        'id', 'user', 'url', 'source_type', 'status', 'progress',
+        'id', 'user', 'parent', 'item_count', 'media_id',
+        'url', 'source_type', 'status', 'progress',
         'current_step', 'original_title', 'original_artist', 'duration',
-        'file_size', 'result_track', 'error_message', 'retry_count',
+        'file_size', 'result_track', 'error_message', 'error_kind', 'retry_count',
         'created_at', 'started_at', 'completed_at'
     )
     ordering = ('-created_at',)
     
     fieldsets = (
         ('Task Info', {
-            'fields': ('id', 'user', 'status', 'created_at')
+            'fields': ('id', 'user', 'status', 'created_at', 'parent', 'item_count')
         }),
         ('Source', {
-            'fields': ('url', 'source_type', 'original_title', 'original_artist')
+            'fields': ('url', 'source_type', 'media_id', 'original_title', 'original_artist')
         }),
         ('Progress', {
             'fields': ('progress', 'current_step', 'started_at')
@@ -442,7 +471,7 @@ class DownloadTaskAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
         ('Error Info', {
-            'fields': ('error_message', 'retry_count'),
+            'fields': ('error_message', 'error_kind', 'retry_count'),
             'classes': ('collapse',)
         }),
     )
@@ -454,6 +483,7 @@ class DownloadTaskAdmin(admin.ModelAdmin):
     def status_badge(self, obj):
         colors = {
             'pending': '#FFA500',
+            'queued': '#F1C40F',
             'downloading': '#4ECDC4',
             'processing': '#9B59B6',
             'completed': '#1db954',
@@ -5,3 +5,7 @@ class MusicConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'music'
     verbose_name = 'Music Library'
+
+    def ready(self):
+        # Registers cache invalidation for the entity resolver
+        from .utils import resolver  # noqa: F401
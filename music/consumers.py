@@ -1,18 +1,28 @@
 import json
+import uuid
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.core.cache import cache
+
+from .models import DownloadTask
+from .utils import now_playing, presence
+from .utils.progress import progress_group
 
 
 class TrackListenersConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for real-time track listener count updates.
     Broadcasts how many users are currently listening to each track.
+    
+    Each connection is counted as a presence member with a TTL that the
+    client's ping refreshes (music.utils.presence), so dropped connections
+    stop counting on their own. Count changes reach the group through the
+    presence aggregator, coalesced per track, not one send per join/leave.
     """
 
     async def connect(self):
-        self.track_id = self.scope['url_route']['kwargs'].get('track_id')
-        self.room_group_name = f'track_{self.track_id}_listeners'
+        self.track_id = str(self.scope['url_route']['kwargs'].get('track_id'))
+        self.room_group_name = presence.listeners_group(self.track_id)
 
         # Join track listeners group
         await self.channel_layer.group_add(
@@ -22,11 +32,10 @@ class TrackListenersConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
 
-        # Increment listener count
-        await self.increment_listeners()
-
-        # Send current listener count
-        count = await self.get_listener_count()
+        # Count this connection and send the current listener count; the
+        # others learn about it from the next coalesced broadcast
+        presence.ensure_aggregator(self.channel_layer)
+        count = await presence.join(self.track_id, self.channel_name)
         await self.send(text_data=json.dumps({
             'type': 'listener_count',
             'track_id': self.track_id,
@@ -34,19 +43,11 @@ class TrackListenersConsumer(AsyncWebsocketConsumer):
         }))
 
     async def disconnect(self, close_code):
-        # Decrement listener count
-        await self.decrement_listeners()
+        if not hasattr(self, 'room_group_name'):
+            return
 
-        # Send updated count to group
-        count = await self.get_listener_count()
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'listener_count_message',
-                'track_id': self.track_id,
-                'count': count
-            }
-        )
+        # Stop counting this connection (broadcast by the aggregator)
+        await presence.leave(self.track_id, self.channel_name)
 
         # Leave track listeners group
         await self.channel_layer.group_discard(
@@ -60,7 +61,8 @@ class TrackListenersConsumer(AsyncWebsocketConsumer):
         message_type = data.get('type')
 
         if message_type == 'ping':
-            # Heartbeat to keep connection alive
+            # Heartbeat: keeps the connection alive and its presence counted
+            await presence.join(self.track_id, self.channel_name)
             await self.send(text_data=json.dumps({
                 'type': 'pong'
             }))
@@ -73,38 +75,20 @@ class TrackListenersConsumer(AsyncWebsocketConsumer):
             'count': event['count']
         }))
 
-    @database_sync_to_async
-    def increment_listeners(self):
-        """Increment the listener count for a track in cache"""
-        cache_key = f'track_listeners_{self.track_id}'
-        current_count = cache.get(cache_key, 0)
-        cache.set(cache_key, current_count + 1, timeout=None)
-        return current_count + 1
-
-    @database_sync_to_async
-    def decrement_listeners(self):
-        """Decrement the listener count for a track in cache"""
-        cache_key = f'track_listeners_{self.track_id}'
-        current_count = cache.get(cache_key, 0)
-        new_count = max(0, current_count - 1)
-        cache.set(cache_key, new_count, timeout=None)
-        return new_count
-
-    @database_sync_to_async
-    def get_listener_count(self):
-        """Get current listener count for a track"""
-        cache_key = f'track_listeners_{self.track_id}'
-        return cache.get(cache_key, 0)
-
 
 class NowPlayingConsumer(AsyncWebsocketConsumer):
     """
-    WebSocket consumer for broadcasting now playing updates across all users.
-    Shows what tracks are being played in real-time globally.
+    WebSocket consumer for the global "playing now" board.
+
+    Clients report play starts; the server counts them (music.utils.now_playing)
+    instead of relaying them, and every subscriber receives a snapshot of
+    the top tracks on connect and then at a fixed cadence. Reports are
+    rate-limited per connection, and only the track id is taken from them.
     """
 
     async def connect(self):
-        self.room_group_name = 'now_playing'
+        self.room_group_name = now_playing.GROUP
+        self.limiter = now_playing.StartLimiter()
 
         # Join now playing group
         await self.channel_layer.group_add(
@@ -114,6 +98,12 @@ class NowPlayingConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
 
+        now_playing.ensure_publisher(self.channel_layer)
+        await self.send(text_data=json.dumps({
+            'type': 'now_playing',
+            'tracks': await now_playing.current_board()
+        }))
+
     async def disconnect(self, close_code):
         # Leave now playing group
         await self.channel_layer.group_discard(
@@ -127,24 +117,82 @@ class NowPlayingConsumer(AsyncWebsocketConsumer):
         message_type = data.get('type')
 
         if message_type == 'track_start':
-            # Broadcast track start to all connected clients
-            await self.channel_layer.group_send(
+            try:
+                track_id = uuid.UUID(str(data.get('track_id')))
+            except ValueError:
+                return
+            if not self.limiter.allow():
+                await self.send(text_data=json.dumps({
+                    'type': 'rate_limited'
+                }))
+                return
+            await now_playing.record_play(track_id)
+
+    async def now_playing_board(self, event):
+        """Send the latest board snapshot to WebSocket"""
+        await self.send(text_data=json.dumps({
+            'type': 'now_playing',
+            'tracks': event['tracks']
+        }))
+
+
+class DownloadProgressConsumer(AsyncWebsocketConsumer):
+    """
+    WebSocket consumer streaming the authenticated user's download progress.
+    Sends a snapshot of active tasks on connect, then relays the events
+    published by download workers (music.utils.progress).
+    """
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+
+        self.user = user
+        self.room_group_name = progress_group(user.id)
+
+        # Join the user's download progress group
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+
+        await self.accept()
+
+        tasks = await self.get_active_progress()
+        await self.send(text_data=json.dumps({
+            'type': 'snapshot',
+            'tasks': tasks
+        }))
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'room_group_name'):
+            await self.channel_layer.group_discard(
                 self.room_group_name,
-                {
-                    'type': 'track_playing',
-                    'track_id': data.get('track_id'),
-                    'track_title': data.get('track_title'),
-                    'artist': data.get('artist'),
-                    'user_id': data.get('user_id')
-                }
+                self.channel_name
             )
 
-    async def track_playing(self, event):
-        """Send track playing update to WebSocket"""
+    async def receive(self, text_data):
+        """Handle incoming WebSocket messages"""
+        data = json.loads(text_data)
+
+        if data.get('type') == 'ping':
+            await self.send(text_data=json.dumps({
+                'type': 'pong'
+            }))
+
+    async def download_progress(self, event):
+        """Send a download progress update to WebSocket"""
         await self.send(text_data=json.dumps({
-            'type': 'track_playing',
-            'track_id': event['track_id'],
-            'track_title': event['track_title'],
-            'artist': event['artist'],
-            'user_id': event.get('user_id')
+            'type': 'progress',
+            'task_id': event['task_id'],
+            'status': event['status'],
+            'progress': event['progress'],
+            'step': event['step']
         }))
+
+    @database_sync_to_async
+    def get_active_progress(self):
+        """Current progress of the user's active download tasks"""
+        return DownloadTask.live_progress(self.user)
@@ -0,0 +1,152 @@
+"""Management command to hash existing tracks and collapse duplicates
+
+Usage:
+    python manage.py backfill_content_hashes [--workers 8] [--batch-size 500] [--dry-run]
+
+Tracks without a content hash are hashed in parallel. The first track
+stored for a given hash (or the one that already carries it) becomes
+canonical and is moved to content-addressed storage; every other copy is
+merged into it (playlists, favorites, download/upload results and play
+counts are repointed) and deleted together with its redundant file.
+"""
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from music.models import ChunkedUpload, DownloadTask, Favorite, MusicFile, Playlist
+from music.utils.catalog import find_tracks_by_hash
+from music.utils.metadata import compute_file_hash, hash_for_path
+from music.utils.uploads import content_storage_name, move_into_storage
+
+
+class Command(BaseCommand):
+    help = 'Хеширование треков и удаление дубликатов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=min(8, (os.cpu_count() or 1) * 2),
+            help='Количество потоков для хеширования'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Треков за один проход'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, что будет сделано'
+        )
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        stats = defaultdict(int)
+
+        pending = (
+            MusicFile.objects.filter(content_hash__isnull=True)
+            .exclude(file='')
+            .order_by('created_at')
+            .only('id', 'file', 'play_count', 'download_count', 'created_at')
+        )
+
+        pending_ids = list(pending.values_list('pk', flat=True))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(pending_ids), batch_size):
+                batch = list(pending.filter(pk__in=pending_ids[start:start + batch_size]))
+
+                groups = defaultdict(list)
+                for track, content_hash in zip(batch, pool.map(self._hash, batch)):
+                    if content_hash:
+                        groups[content_hash].append(track)
+                    else:
+                        stats['missing'] += 1
+
+                existing = find_tracks_by_hash(groups)
+                for content_hash, tracks in groups.items():
+                    canonical = existing.get(content_hash) or tracks[0]
+                    duplicates = [t for t in tracks if t.pk != canonical.pk]
+                    stats['hashed'] += len(tracks)
+                    stats['duplicates'] += len(duplicates)
+                    if dry_run:
+                        continue
+
+                    with transaction.atomic():
+                        if duplicates:
+                            self._collapse(canonical, duplicates)
+                        if not canonical.content_hash:
+                            self._adopt(canonical, content_hash)
+
+        prefix = '[dry-run] ' if dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}✅ Хешировано: {stats['hashed']}, "
+            f"дубликатов: {stats['duplicates']}, без файла: {stats['missing']}"
+        ))
+
+    def _hash(self, track):
+        try:
+            return hash_for_path(track.file.path)
+        except NotImplementedError:
+            with track.file.open('rb') as f:
+                return compute_file_hash(f)
+        except (OSError, ValueError) as e:
+            self.stderr.write(f"⚠️  {track.pk}: {e}")
+            return None
+
+    def _collapse(self, canonical, duplicates):
+        """Repoint everything referencing the duplicates, then delete them"""
+        dup_ids = [track.pk for track in duplicates]
+
+        through = Playlist.tracks.through
+        playlist_ids = set(
+            through.objects.filter(musicfile_id__in=dup_ids).values_list('playlist_id', flat=True)
+        )
+        through.objects.bulk_create(
+            [through(playlist_id=pk, musicfile_id=canonical.pk) for pk in playlist_ids],
+            ignore_conflicts=True
+        )
+
+        user_ids = set(
+            Favorite.objects.filter(track_id__in=dup_ids).values_list('user_id', flat=True)
+        )
+        Favorite.objects.bulk_create(
+            [Favorite(user_id=pk, track_id=canonical.pk) for pk in user_ids],
+            ignore_conflicts=True
+        )
+
+        DownloadTask.objects.filter(result_track_id__in=dup_ids).update(result_track=canonical)
+        ChunkedUpload.objects.filter(result_track_id__in=dup_ids).update(result_track=canonical)
+
+        MusicFile.objects.filter(pk=canonical.pk).update(
+            play_count=F('play_count') + sum(t.play_count for t in duplicates),
+            download_count=F('download_count') + sum(t.download_count for t in duplicates),
+        )
+
+        # A duplicate row pointing at the canonical file must not take it along
+        MusicFile.objects.filter(pk__in=dup_ids, file=canonical.file.name).update(file='')
+        MusicFile.objects.filter(pk__in=dup_ids).delete()
+
+    def _adopt(self, canonical, content_hash):
+        """Record the hash and move the file to its content-addressed name"""
+        old_name = canonical.file.name
+        new_name = content_storage_name(content_hash, old_name)
+        try:
+            old_path = canonical.file.path
+        except NotImplementedError:
+            # Remote storage: keep the object where it is
+            new_name, old_path = old_name, None
+
+        if old_path and new_name != old_name:
+            move_into_storage(old_path, new_name)
+        MusicFile.objects.filter(pk=canonical.pk).update(
+            content_hash=content_hash, file=new_name
+        )
@@ -0,0 +1,215 @@
+"""Management command measuring download pipeline throughput offline
+
+Usage:
+    python manage.py benchmark_downloads [--items 50] [--mode eager|broker]
+        [--concurrency 4] [--latency 0.2] [--throughput 20] [--duration 30]
+        [--format mp3] [--respect-limits] [--keep]
+
+Imports ``--items`` fake URLs through the real Celery task path with the
+offline backend (music.utils.benchmark.FakeMediaDownloader), then reports
+imports per minute, per-stage latency percentiles and DB writes per stage.
+
+--mode eager    runs every pipeline in-process (CELERY_TASK_ALWAYS_EAGER),
+                ``--concurrency`` imports at a time
+--mode broker   starts a threaded worker on the configured broker with the
+                fake backend and waits for the queue to drain; stage numbers
+                need a shared cache (REDIS_URL). The run uses its own stage
+                queues (DOWNLOAD_QUEUE_PREFIX), so workers already running
+                on the broker never pick up benchmark jobs
+
+Per-source rate limits are lifted for the run unless --respect-limits is
+given. Benchmark tasks, tracks and files are deleted afterwards unless
+--keep is given.
+"""
+
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from celery import current_app
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from music.models import DownloadTask, MusicFile, SystemSettings
+from music.utils import benchmark
+from music.utils.downloader import MediaDownloader
+
+FAKE_BACKEND = 'music.utils.benchmark.FakeMediaDownloader'
+BENCHMARK_HOST = 'benchmark.invalid'
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+class Command(BaseCommand):
+    help = 'Офлайн-бенчмарк пропускной способности загрузок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=50, help='Количество импортов')
+        parser.add_argument(
+            '--mode', choices=['eager', 'broker'], default='eager',
+            help='eager: в этом процессе; broker: через брокер и воркер'
+        )
+        parser.add_argument('--concurrency', type=int, default=4, help='Параллельных импортов / потоков воркера')
+        parser.add_argument('--latency', type=float, help='Задержка извлечения, с')
+        parser.add_argument('--throughput', type=float, help='Скорость загрузки, МБ/с')
+        parser.add_argument('--duration', type=int, help='Длина клипа, с')
+        parser.add_argument('--format', default='mp3', help='Выходной формат')
+        parser.add_argument('--timeout', type=int, default=600, help='Максимальное время прогона, с')
+        parser.add_argument('--respect-limits', action='store_true', help='Не снимать лимиты источника')
+        parser.add_argument('--keep', action='store_true', help='Не удалять задачи и треки')
+
+    def handle(self, *args, **options):
+        fake = {
+            'FAKE_DOWNLOAD_LATENCY': options['latency'],
+            'FAKE_DOWNLOAD_THROUGHPUT': options['throughput'],
+            'FAKE_DOWNLOAD_DURATION': options['duration'],
+        }
+        fake = {name: value for name, value in fake.items() if value is not None}
+        run_id = uuid.uuid4().hex[:8]
+        user, _ = User.objects.get_or_create(username='benchmark', defaults={'is_active': False})
+        tasks = DownloadTask.objects.bulk_create([
+            DownloadTask(
+                user=user,
+                url=f'https://{BENCHMARK_HOST}/{run_id}/{n}',
+                output_format=options['format'],
+            )
+            for n in range(options['items'])
+        ])
+
+        system = SystemSettings.load()
+        original_limits = system.download_source_limits
+        source = MediaDownloader.detect_source(tasks[0].url)
+        if not options['respect_limits']:
+            system.download_source_limits = {
+                **(original_limits or {}),
+                source: {'rate_per_minute': 0, 'max_concurrent': 0},
+            }
+            system.save(update_fields=['download_source_limits'])
+
+        try:
+            with override_settings(DOWNLOADER_BACKEND=FAKE_BACKEND, **fake):
+                run = self._run_eager if options['mode'] == 'eager' else self._run_broker
+                elapsed = run(tasks, options, fake)
+            self._report(tasks, elapsed)
+        finally:
+            if not options['respect_limits']:
+                system.download_source_limits = original_limits
+                system.save(update_fields=['download_source_limits'])
+            if not options['keep']:
+                self._cleanup(tasks)
+
+    def _run_eager(self, tasks, options, fake):
+        from music.tasks import resume_download
+
+        def run(task):
+            try:
+                resume_download(task)
+            finally:
+                connection.close()
+
+        conf = current_app.conf
+        previous = conf.task_always_eager
+        conf.task_always_eager = True
+        try:
+            started = time.perf_counter()
+            if options['concurrency'] > 1:
+                with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+                    list(pool.map(run, tasks))
+            else:
+                for task in tasks:
+                    resume_download(task)
+            return time.perf_counter() - started
+        finally:
+            conf.task_always_eager = previous
+
+    def _run_broker(self, tasks, options, fake):
+        from music.tasks import STAGE_TASKS, stage_task_id
+
+        # Queues and worker of this run only: shared workers would run the
+        # jobs with the real downloader, and any worker answers a plain ping
+        prefix = f'benchmark-{os.getpid()}-'
+        queues = {name: f'{prefix}{queue}' for name, queue in settings.DOWNLOAD_STAGE_QUEUES.items()}
+        worker_name = f'benchmark-{os.getpid()}@{socket.gethostname()}'
+        env = {**os.environ, 'DOWNLOADER_BACKEND': FAKE_BACKEND, 'DOWNLOAD_QUEUE_PREFIX': prefix}
+        env.update({name: str(value) for name, value in fake.items()})
+        worker = subprocess.Popen([
+            sys.executable, '-m', 'celery', '-A', 'config', 'worker',
+            '-Q', ','.join(queues.values()), '-P', 'threads', '-c', str(options['concurrency']),
+            '-I', 'music.utils.benchmark', '-n', worker_name, '-l', 'warning',
+        ], env=env)
+        try:
+            deadline = time.monotonic() + 60
+            while not current_app.control.ping(destination=[worker_name], timeout=1):
+                if worker.poll() is not None or time.monotonic() > deadline:
+                    raise CommandError('Benchmark worker did not start')
+
+            started = time.perf_counter()
+            for task in tasks:
+                stage_task = STAGE_TASKS[task.stage]
+                stage_task.apply_async(
+                    args=[str(task.id)], task_id=stage_task_id(task.id, task.stage), queue=queues[stage_task.name]
+                )
+            ids = [task.id for task in tasks]
+            deadline = time.monotonic() + options['timeout']
+            while DownloadTask.objects.filter(id__in=ids, status__in=DownloadTask.ACTIVE_STATUSES).exists():
+                if time.monotonic() > deadline:
+                    raise CommandError(f"Benchmark did not finish within {options['timeout']}s")
+                time.sleep(0.2)
+            return time.perf_counter() - started
+        finally:
+            worker.terminate()
+            worker.wait(timeout=30)
+
+    def _report(self, tasks, elapsed):
+        from music.tasks import DOWNLOAD_STAGES
+
+        ids = [task.id for task in tasks]
+        completed = DownloadTask.objects.filter(id__in=ids, status='completed').count()
+
+        self.stdout.write(self.style.HTTP_INFO('=' * 60))
+        self.stdout.write(
+            f"Импортов: {len(tasks)}, готово: {completed}, "
+            f"ошибок: {len(tasks) - completed}, время: {elapsed:.2f} с"
+        )
+        self.stdout.write(self.style.SUCCESS(f"Пропускная способность: {completed / elapsed * 60:.1f} задач/мин"))
+
+        samples = benchmark.stage_stats(ids, DOWNLOAD_STAGES)
+        if not any(samples.values()):
+            self.stdout.write(self.style.WARNING('⚠️  Нет данных по этапам (нужен общий кэш, REDIS_URL)'))
+            return
+        self.stdout.write(f"{'этап':<10}{'n':>6}{'p50 мс':>10}{'p90 мс':>10}{'p99 мс':>10}{'max мс':>10}{'записей':>10}")
+        total_writes = 0
+        for stage in DOWNLOAD_STAGES:
+            stage_samples = samples[stage]
+            if not stage_samples:
+                continue
+            millis = [sample['seconds'] * 1000 for sample in stage_samples]
+            writes = [sample['writes'] for sample in stage_samples]
+            total_writes += sum(writes)
+            self.stdout.write(
+                f"{stage:<10}{len(millis):>6}{percentile(millis, 50):>10.1f}{percentile(millis, 90):>10.1f}"
+                f"{percentile(millis, 99):>10.1f}{max(millis):>10.1f}{statistics.mean(writes):>10.1f}"
+            )
+        self.stdout.write(f"Записей в БД на импорт: {total_writes / max(1, len(tasks)):.1f}")
+
+    def _cleanup(self, tasks):
+        ids = [task.id for task in tasks]
+        track_ids = list(
+            DownloadTask.objects.filter(id__in=ids, result_track__isnull=False)
+            .values_list('result_track_id', flat=True)
+        )
+        DownloadTask.objects.filter(id__in=ids).delete()
+        for track in MusicFile.objects.filter(id__in=track_ids):
+            track.delete()
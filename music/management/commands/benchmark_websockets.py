@@ -0,0 +1,177 @@
+"""Management command load-testing the realtime WebSocket consumers
+
+Usage:
+    python manage.py benchmark_websockets [--listeners 1000] [--now-playing 1000]
+        [--tracks 10] [--rounds 5] [--concurrency 200] [--timeout 10]
+        [--memory-layer]
+
+Opens ``--listeners`` simulated clients on the track-listener consumer
+(spread over ``--tracks`` tracks) and ``--now-playing`` clients on the
+now-playing consumer, all in this process through channels'
+``WebsocketCommunicator`` and the real URL routing, ``--concurrency``
+handshakes at a time. Then runs ``--rounds`` broadcast rounds (a listener
+count to every track group, a published now-playing board) and reports:
+
+- connect latency: handshake until the first message (count / snapshot)
+- fan-out latency: broadcast sent until each client received it
+- memory per connection: process RSS growth over the connect phase,
+  simulated clients included (an upper bound for the server side)
+- throughput: messages delivered per second during the rounds
+
+The configured channel layer is used (Redis with CHANNEL_REDIS_URLS), or
+the in-memory layer with --memory-layer. The periodic listener and
+now-playing broadcasts are paused for the run, so only the rounds' messages
+are measured.
+"""
+
+import asyncio
+import os
+import resource
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing.websocket import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from music.models import MusicFile
+from music.routing import websocket_urlpatterns
+from music.utils import now_playing, presence
+
+from .benchmark_downloads import percentile
+
+MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+# Keeps the periodic broadcasts out of the measured rounds
+PAUSED_INTERVAL = 24 * 60 * 60
+
+
+def rss_bytes() -> int:
+    """Current resident set size of this process"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Peak RSS (KB on Linux) where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест WebSocket-консьюмеров (слушатели и «сейчас играет»)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--listeners', type=int, default=1000, help='Клиентов счётчика слушателей')
+        parser.add_argument('--now-playing', type=int, default=1000, help='Клиентов ленты «сейчас играет»')
+        parser.add_argument('--tracks', type=int, default=10, help='Треков, между которыми делятся слушатели')
+        parser.add_argument('--rounds', type=int, default=5, help='Раундов рассылки')
+        parser.add_argument('--concurrency', type=int, default=200, help='Одновременных подключений')
+        parser.add_argument('--timeout', type=float, default=10, help='Ожидание сообщения клиентом, с')
+        parser.add_argument('--memory-layer', action='store_true', help='In-memory channel layer вместо настроенного')
+
+    def handle(self, *args, **options):
+        if options['listeners'] + options['now_playing'] <= 0:
+            raise CommandError('Нужен хотя бы один клиент')
+        # Real tracks make the now-playing board non-empty
+        track_ids = [str(track_id) for track_id in MusicFile.objects.values_list('id', flat=True)[:options['tracks']]]
+        track_ids += [str(uuid.uuid4()) for _ in range(options['tracks'] - len(track_ids))]
+
+        layers = MEMORY_LAYER if options['memory_layer'] else None
+        intervals = (presence.BROADCAST_INTERVAL, now_playing.PUBLISH_INTERVAL)
+        presence.BROADCAST_INTERVAL = now_playing.PUBLISH_INTERVAL = PAUSED_INTERVAL
+        try:
+            if layers:
+                with override_settings(CHANNEL_LAYERS=layers):
+                    results = async_to_sync(self._run)(track_ids, options)
+            else:
+                results = async_to_sync(self._run)(track_ids, options)
+        finally:
+            presence.BROADCAST_INTERVAL, now_playing.PUBLISH_INTERVAL = intervals
+        self._report(results, options)
+
+    async def _run(self, track_ids, options):
+        application = URLRouter(websocket_urlpatterns)
+        layer = get_channel_layer()
+        gate = asyncio.Semaphore(options['concurrency'])
+        timeout = options['timeout']
+        results = {'connect': {}, 'fanout': {}, 'delivered': 0, 'lost': 0, 'failed': 0}
+
+        clients = [
+            ('listeners', track_ids[n % len(track_ids)], f'/ws/track/{track_ids[n % len(track_ids)]}/listeners/')
+            for n in range(options['listeners'])
+        ] + [('now_playing', track_ids[n % len(track_ids)], '/ws/now-playing/') for n in range(options['now_playing'])]
+
+        async def connect(kind, track_id, path):
+            async with gate:
+                communicator = WebsocketCommunicator(application, path)
+                started = time.perf_counter()
+                try:
+                    connected, _ = await communicator.connect(timeout=timeout)
+                    if not connected:
+                        raise ConnectionError(path)
+                    await communicator.receive_json_from(timeout=timeout)
+                except Exception:
+                    results['failed'] += 1
+                    return None
+                results['connect'].setdefault(kind, []).append((time.perf_counter() - started) * 1000)
+                if kind == 'now_playing':
+                    await communicator.send_json_to({'type': 'track_start', 'track_id': track_id})
+                return kind, communicator
+
+        rss_before = rss_bytes()
+        connect_started = time.perf_counter()
+        connections = [client for client in await asyncio.gather(*(connect(*client) for client in clients)) if client]
+        results['connect_seconds'] = time.perf_counter() - connect_started
+        results['connections'] = len(connections)
+        results['rss_per_connection'] = (rss_bytes() - rss_before) / max(1, len(connections))
+
+        async def receive(kind, communicator, sent):
+            try:
+                await communicator.receive_json_from(timeout=timeout)
+            except Exception:
+                results['lost'] += 1
+                return
+            results['delivered'] += 1
+            results['fanout'].setdefault(kind, []).append((time.perf_counter() - sent) * 1000)
+
+        fanout_seconds = 0.0
+        for _ in range(options['rounds']):
+            sent = time.perf_counter()
+            waiting = [asyncio.ensure_future(receive(kind, communicator, sent)) for kind, communicator in connections]
+            counts = await presence.listener_counts(track_ids)
+            for track_id, count in counts.items():
+                await layer.group_send(presence.listeners_group(track_id), {
+                    'type': 'listener_count_message',
+                    'track_id': track_id,
+                    'count': count,
+                })
+            await now_playing.publish_board(layer)
+            await asyncio.gather(*waiting)
+            fanout_seconds += time.perf_counter() - sent
+        results['fanout_seconds'] = fanout_seconds
+
+        await asyncio.gather(*(communicator.disconnect() for _, communicator in connections))
+        return results
+
+    def _report(self, results, options):
+        self.stdout.write(self.style.HTTP_INFO('=' * 60))
+        self.stdout.write(
+            f"Клиентов: {results['connections']}, ошибок подключения: {results['failed']}, "
+            f"подключение за {results['connect_seconds']:.2f} с"
+        )
+        self.stdout.write(f"{'метрика':<24}{'n':>7}{'p50 мс':>10}{'p90 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+        for title, samples in (('connect', results['connect']), ('fanout', results['fanout'])):
+            for kind, millis in sorted(samples.items()):
+                self.stdout.write(
+                    f"{f'{title} {kind}':<24}{len(millis):>7}{percentile(millis, 50):>10.1f}"
+                    f"{percentile(millis, 90):>10.1f}{percentile(millis, 99):>10.1f}{max(millis):>10.1f}"
+                )
+        self.stdout.write(f"Память на соединение: {results['rss_per_connection'] / 1024:.1f} КБ (RSS, вместе с клиентом)")
+        if results['fanout_seconds']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Пропускная способность: {results['delivered'] / results['fanout_seconds']:.0f} сообщений/с "
+                f"за {options['rounds']} раундов"
+            ))
+        if results['lost']:
+            self.stdout.write(self.style.WARNING(f"⚠️  Не доставлено сообщений: {results['lost']}"))
@@ -0,0 +1,48 @@
+"""Management command running the asyncio fetch worker
+
+Usage:
+    python manage.py fetch_worker [--concurrency 50] [--per-source 16]
+        [--backlog 100] [--burst]
+
+Consumes the ``fetch`` queue in place of ``celery worker -Q fetch``, with
+up to ``--concurrency`` downloads in flight in one process (see
+music.utils.async_fetch). No new fetch starts while ``--backlog`` fetched
+files wait for transcode (0 = no limit). ``--burst`` exits once the queue
+is empty. SIGTERM/SIGINT stop taking messages and wait for running fetches.
+"""
+
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand
+
+from music.utils.async_fetch import AsyncFetchWorker
+
+
+class Command(BaseCommand):
+    help = 'Асинхронный воркер этапа загрузки (очередь fetch)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, help='Одновременных загрузок')
+        parser.add_argument('--per-source', type=int, help='Одновременных загрузок на источник')
+        parser.add_argument('--backlog', type=int, help='Максимум файлов в очереди на конвертацию (0 = без лимита)')
+        parser.add_argument('--burst', action='store_true', help='Завершиться, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        worker = AsyncFetchWorker(
+            concurrency=options['concurrency'],
+            per_source=options['per_source'],
+            backlog=options['backlog'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"🚀 Воркер загрузок: {worker.concurrency} потоков, {worker.per_source} на источник"
+        ))
+        asyncio.run(self._run(worker, options['burst']))
+        self.stdout.write(self.style.SUCCESS(f"✅ Остановлен, обработано задач: {worker.processed}"))
+
+    async def _run(self, worker, burst):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        await worker.run(stop, burst=burst)
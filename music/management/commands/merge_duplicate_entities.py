@@ -0,0 +1,26 @@
+"""Management command to merge duplicate artists, albums and genres
+
+Usage:
+    python manage.py merge_duplicate_entities
+
+Rows whose names normalize to the same key (case, Unicode form and
+whitespace folded) are collapsed into the oldest one; tracks and albums are
+repointed before the duplicates are deleted. The normalized keys are
+rewritten afterwards, so run it after changing the normalization rules or
+importing data that bypassed the resolver.
+"""
+
+from django.core.management.base import BaseCommand
+
+from music.utils.resolver import merge_duplicate_entities
+
+
+class Command(BaseCommand):
+    help = 'Объединение дубликатов исполнителей, альбомов и жанров'
+
+    def handle(self, *args, **options):
+        merged = merge_duplicate_entities()
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Объединено исполнителей: {merged['artists']}, "
+            f"альбомов: {merged['albums']}, жанров: {merged['genres']}"
+        ))
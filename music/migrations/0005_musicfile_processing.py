@@ -0,0 +1,22 @@
+# Generated migration - background upload enrichment
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music', '0004_chunked_uploads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='musicfile',
+            name='waveform',
+            field=models.JSONField(blank=True, help_text='Normalized peak amplitudes', null=True),
+        ),
+        migrations.AddField(
+            model_name='musicfile',
+            name='processing_status',
+            field=models.CharField(choices=[('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], db_index=True, default='ready', max_length=20),
+        ),
+    ]
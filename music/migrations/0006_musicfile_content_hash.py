@@ -0,0 +1,24 @@
+# Generated migration - content-addressed track storage
+from django.db import migrations, models
+import django.core.validators
+import music.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music', '0005_musicfile_processing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='musicfile',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, help_text='SHA-256 of the audio bytes', max_length=64, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='musicfile',
+            name='file',
+            field=models.FileField(upload_to=music.models.track_upload_path, validators=[django.core.validators.FileExtensionValidator(['mp3', 'flac', 'ogg', 'm4a', 'wav'])]),
+        ),
+    ]
@@ -0,0 +1,97 @@
+# Generated migration - normalized lookup keys for artists, albums and genres
+import unicodedata
+
+from django.db import migrations, models
+
+
+# Frozen copies of music.models.normalize_name and
+# music.utils.resolver.merge_duplicate_entities as of this migration, so
+# later changes to the runtime code never change what it does
+
+def normalize_name(value, max_length=255):
+    value = unicodedata.normalize('NFKC', value or '')
+    return ' '.join(value.casefold().split())[:max_length]
+
+
+def duplicate_groups(model, group_key, *fields):
+    """Yield (kept_id, [duplicate ids]) for rows sharing the same group key"""
+    groups = {}
+    for row in model.objects.order_by('created_at', 'pk').values('pk', *fields):
+        groups.setdefault(group_key(row), []).append(row['pk'])
+    for ids in groups.values():
+        if len(ids) > 1:
+            yield ids[0], ids[1:]
+
+
+def write_keys(model, source, key, max_length):
+    stale = []
+    for row in model.objects.only('pk', source, key):
+        value = normalize_name(getattr(row, source), max_length)
+        if getattr(row, key) != value:
+            setattr(row, key, value)
+            stale.append(row)
+    model.objects.bulk_update(stale, [key], batch_size=500)
+
+
+def populate_keys_and_merge(apps, schema_editor):
+    """Merge artists, albums and genres whose names share a key, then store the keys"""
+    Artist = apps.get_model('music', 'Artist')
+    Album = apps.get_model('music', 'Album')
+    Genre = apps.get_model('music', 'Genre')
+    MusicFile = apps.get_model('music', 'MusicFile')
+
+    for keep, dup_ids in duplicate_groups(Artist, lambda r: normalize_name(r['name']), 'name'):
+        MusicFile.objects.filter(artist_id__in=dup_ids).update(artist_id=keep)
+        # Albums move over, folding into the kept artist's album of the same title
+        kept_albums = {
+            normalize_name(title): pk for pk, title in
+            Album.objects.filter(artist_id=keep).values_list('pk', 'title')
+        }
+        for album in Album.objects.filter(artist_id__in=dup_ids).order_by('created_at', 'pk'):
+            title_key = normalize_name(album.title)
+            target = kept_albums.setdefault(title_key, album.pk)
+            if target != album.pk:
+                MusicFile.objects.filter(album_id=album.pk).update(album_id=target)
+                Album.objects.filter(pk=album.pk).delete()
+            else:
+                Album.objects.filter(pk=album.pk).update(artist_id=keep, title_key=title_key)
+        Artist.objects.filter(pk__in=dup_ids).delete()
+    write_keys(Artist, 'name', 'name_key', 255)
+
+    album_key = lambda r: (r['artist_id'], normalize_name(r['title']))  # noqa: E731
+    for keep, dup_ids in duplicate_groups(Album, album_key, 'artist_id', 'title'):
+        MusicFile.objects.filter(album_id__in=dup_ids).update(album_id=keep)
+        Album.objects.filter(pk__in=dup_ids).delete()
+    write_keys(Album, 'title', 'title_key', 255)
+
+    for keep, dup_ids in duplicate_groups(Genre, lambda r: normalize_name(r['name'], 100), 'name'):
+        MusicFile.objects.filter(genre_id__in=dup_ids).update(genre_id=keep)
+        Album.objects.filter(genre_id__in=dup_ids).update(genre_id=keep)
+        Genre.objects.filter(pk__in=dup_ids).delete()
+    write_keys(Genre, 'name', 'name_key', 100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music', '0006_musicfile_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='artist',
+            name='name_key',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='genre',
+            name='name_key',
+            field=models.CharField(editable=False, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='title_key',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+        migrations.RunPython(populate_keys_and_merge, migrations.RunPython.noop),
+    ]
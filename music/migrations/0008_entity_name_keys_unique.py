@@ -0,0 +1,31 @@
+# Generated migration - unique normalized keys (separate transaction from the merge)
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music', '0007_entity_name_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='artist',
+            name='name_key',
+            field=models.CharField(editable=False, max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='genre',
+            name='name_key',
+            field=models.CharField(editable=False, max_length=100, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='album',
+            name='title_key',
+            field=models.CharField(editable=False, max_length=255),
+        ),
+        migrations.AddConstraint(
+            model_name='album',
+            constraint=models.UniqueConstraint(fields=('artist', 'title_key'), name='unique_album_title_key'),
+        ),
+    ]
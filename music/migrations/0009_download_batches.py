@@ -0,0 +1,33 @@
+# Generated migration - playlist imports as batches of child download tasks
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music', '0008_entity_name_keys_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadtask',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='music.downloadtask'),
+        ),
+        migrations.AddField(
+            model_name='downloadtask',
+            name='item_count',
+            field=models.IntegerField(default=0, help_text='Child tasks of a playlist import'),
+        ),
+        migrations.AddField(
+            model_name='downloadtask',
+            name='media_id',
+            field=models.CharField(blank=True, db_index=True, help_text='Canonical <extractor>:<id> of the source media', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='downloadtask',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('queued', 'Queued'), ('downloading', 'Downloading'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], db_index=True, default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated migration - per-source download rate limits
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music', '0009_download_batches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='systemsettings',
+            name='download_rate_per_minute',
+            field=models.PositiveIntegerField(default=20, help_text='Downloads started per minute per source (0 = unlimited)'),
+        ),
+        migrations.AddField(
+            model_name='systemsettings',
+            name='download_burst',
+            field=models.PositiveIntegerField(default=5, help_text='Downloads a source may start back to back'),
+        ),
+        migrations.AddField(
+            model_name='systemsettings',
+            name='download_max_concurrent',
+            field=models.PositiveIntegerField(default=4, help_text='Downloads running at once per source (0 = unlimited)'),
+        ),
+        migrations.AddField(
+            model_name='systemsettings',
+            name='download_source_limits',
+            field=models.JSONField(blank=True, default=dict, help_text='Per-source overrides, e.g. {"youtube": {"rate_per_minute": 10, "max_concurrent": 2}}'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated migration - canonical media id lookups for import reuse
+from django.db import migrations, models
+
+
+def backfill_media_ids(apps, schema_editor):
+    """Key earlier imports by canonical media id so they can be reused"""
+    from music.utils.downloader import canonical_media_id
+
+    DownloadTask = apps.get_model('music', 'DownloadTask')
+    stale = []
+    for task in DownloadTask.objects.filter(media_id='').only('id', 'url').iterator():
+        media_id = canonical_media_id(task.url)
+        if media_id:
+            task.media_id = media_id[:255]
+            stale.append(task)
+    DownloadTask.objects.bulk_update(stale, ['media_id'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music', '0010_download_scheduling'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='downloadtask',
+            name='media_id',
+            field=models.CharField(blank=True, help_text='Canonical <extractor>:<id> of the source media', max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='downloadtask',
+            index=models.Index(fields=['media_id', 'output_format', 'output_quality'], name='music_downl_media_output_idx'),
+        ),
+        migrations.RunPython(backfill_media_ids, migrations.RunPython.noop),
+    ]
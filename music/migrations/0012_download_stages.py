@@ -0,0 +1,22 @@
+# Generated migration - staged download pipeline
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music', '0011_download_media_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadtask',
+            name='stage',
+            field=models.CharField(choices=[('probe', 'Probe'), ('fetch', 'Fetch'), ('transcode', 'Transcode'), ('ingest', 'Ingest')], default='probe', help_text='Pipeline stage to run (or resume) next', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='downloadtask',
+            name='staged_file',
+            field=models.CharField(blank=True, help_text='Output of the last finished stage, relative to MEDIA_ROOT', max_length=500),
+        ),
+    ]
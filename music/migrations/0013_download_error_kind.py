@@ -0,0 +1,17 @@
+# Generated migration - permanent vs transient download failures
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music', '0012_download_stages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadtask',
+            name='error_kind',
+            field=models.CharField(blank=True, choices=[('transient', 'Transient'), ('permanent', 'Permanent')], max_length=20),
+        ),
+    ]
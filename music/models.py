@@ -1,16 +1,29 @@
 import uuid
 import os
 import logging
+import unicodedata
 from django.db import models
+from django.db.models import Case, Value, When
+from django.db.models.functions import Concat
 from django.contrib.auth.models import User
 from django.core.validators import FileExtensionValidator, URLValidator
-from mutagen import File as MutagenFile
+from .utils.metadata import compute_file_hash, probe_audio
+from .utils.progress import ProgressPublisher, cached_progress
+from .utils.uploads import content_storage_name
 
 logger = logging.getLogger(__name__)
 
+
+def normalize_name(value, max_length=255):
+    """Lookup key for catalog names: Unicode-normalized, case- and space-folded"""
+    value = unicodedata.normalize('NFKC', value or '')
+    return ' '.join(value.casefold().split())[:max_length]
+
+
 class Genre(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=100, unique=True)
+    name_key = models.CharField(max_length=100, unique=True, editable=False)
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -20,9 +33,14 @@ class Genre(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.name_key = normalize_name(self.name, 100)
+        super().save(*args, **kwargs)
+
 class Artist(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255)
+    name_key = models.CharField(max_length=255, unique=True, editable=False)
     bio = models.TextField(blank=True)
     photo = models.ImageField(upload_to='artists/', blank=True, null=True)
     website = models.URLField(blank=True)
@@ -34,9 +52,14 @@ class Artist(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.name_key = normalize_name(self.name)
+        super().save(*args, **kwargs)
+
 class Album(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     title = models.CharField(max_length=255)
+    title_key = models.CharField(max_length=255, editable=False)
     artist = models.ForeignKey(Artist, on_delete=models.CASCADE, related_name='albums')
     cover = models.ImageField(upload_to='covers/', blank=True, null=True)
     year = models.IntegerField(null=True, blank=True)
@@ -46,10 +69,24 @@ class Album(models.Model):
     class Meta:
         ordering = ['-year', 'title']
         unique_together = ['title', 'artist']
+        constraints = [
+            models.UniqueConstraint(fields=['artist', 'title_key'], name='unique_album_title_key'),
+        ]
 
     def __str__(self):
         return f"{self.title} - {self.artist.name}"
 
+    def save(self, *args, **kwargs):
+        self.title_key = normalize_name(self.title)
+        super().save(*args, **kwargs)
+
+def track_upload_path(instance, filename):
+    """Content-addressed location for track audio: tracks/ab/<sha256>.<ext>"""
+    if instance.content_hash:
+        return content_storage_name(instance.content_hash, filename)
+    return f"tracks/{filename}"
+
+
 class MusicFile(models.Model):
     FORMAT_CHOICES = [
         ('mp3', 'MP3'),
@@ -59,6 +96,12 @@ class MusicFile(models.Model):
         ('wav', 'WAV'),
     ]
     
+    PROCESSING_CHOICES = [
+        ('processing', 'Processing'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    ]
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     title = models.CharField(max_length=255)
     artist = models.ForeignKey(Artist, on_delete=models.CASCADE, related_name='tracks')
@@ -67,9 +110,17 @@ class MusicFile(models.Model):
     
     # Files
     file = models.FileField(
-        upload_to='tracks/',
+        upload_to=track_upload_path,
         validators=[FileExtensionValidator(['mp3', 'flac', 'ogg', 'm4a', 'wav'])]
     )
+    content_hash = models.CharField(
+        max_length=64,
+        unique=True,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="SHA-256 of the audio bytes"
+    )
     cover_image = models.ImageField(upload_to='covers/', blank=True, null=True)
     format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default='mp3')
     
@@ -77,6 +128,15 @@ class MusicFile(models.Model):
     duration = models.IntegerField(default=0, help_text="Duration in seconds")
     file_size = models.BigIntegerField(default=0)
     bitrate = models.IntegerField(null=True, blank=True)
+    waveform = models.JSONField(null=True, blank=True, help_text="Normalized peak amplitudes")
+    
+    # Post-upload enrichment state (tags, artwork, waveform run in Celery)
+    processing_status = models.CharField(
+        max_length=20,
+        choices=PROCESSING_CHOICES,
+        default='ready',
+        db_index=True
+    )
     
     # Statistics
     play_count = models.PositiveIntegerField(default=0)
@@ -95,16 +155,14 @@ class MusicFile(models.Model):
         return f"{self.title} - {self.artist.name}"
 
     def save(self, *args, **kwargs):
-        if self.file and not self.duration:
-            try:
-                self.file_size = self.file.size
-                audio = MutagenFile(self.file)
-                if audio and audio.info:
-                    self.duration = int(audio.info.length)
-                    if hasattr(audio.info, 'bitrate'):
-                        self.bitrate = int(audio.info.bitrate / 1000)
-            except Exception as e:
-                logger.error(f"Metadata extraction error: {e}")
+        # Newly assigned files (admin/forms) are stored under their content hash
+        if self.file and not self.file._committed:
+            self.store_file(self.file.file, self.file.name)
+        
+        update_fields = kwargs.get('update_fields')
+        needs_probe = update_fields is None or 'duration' in update_fields
+        if self.file and not self.duration and needs_probe:
+            self.apply_metadata(probe_audio(self.file))
         
         # Ensure format is lowercase extension
         if self.file and not self.format:
@@ -112,6 +170,36 @@ class MusicFile(models.Model):
             
         super().save(*args, **kwargs)
 
+    def store_file(self, content, file_name, content_hash=None):
+        """
+        Point the track at content-addressed storage for ``content``.
+        
+        The bytes are written only when no identical blob is stored yet;
+        otherwise the existing blob is linked. The row itself is not saved.
+        """
+        self.content_hash = content_hash or compute_file_hash(content)
+        storage_name = content_storage_name(self.content_hash, file_name)
+        if self.file.storage.exists(storage_name):
+            self.file.name = storage_name
+            self.file._committed = True
+        else:
+            self.file.save(file_name, content, save=False)
+
+    def apply_metadata(self, metadata):
+        """Copy technical info from a probe_audio() result onto the track"""
+        if not metadata:
+            return
+        self.file_size = metadata.get('file_size') or self.file_size
+        self.duration = metadata.get('duration') or self.duration
+        self.bitrate = metadata.get('bitrate') or self.bitrate
+
+    def refresh_metadata(self):
+        """Re-read technical info; unchanged files are served from the probe cache"""
+        if not self.file:
+            return
+        self.apply_metadata(probe_audio(self.file))
+        self.save(update_fields=['file_size', 'duration', 'bitrate', 'updated_at'])
+
     def increment_play_count(self):
         self.play_count += 1
         self.save(update_fields=['play_count'])
@@ -176,6 +264,25 @@ class SystemSettings(models.Model):
     auto_generate_waveforms = models.BooleanField(default=False)
     normalize_audio = models.BooleanField(default=False)
     
+    # Download Scheduling (per source, shared by all workers)
+    download_rate_per_minute = models.PositiveIntegerField(
+        default=20,
+        help_text="Downloads started per minute per source (0 = unlimited)"
+    )
+    download_burst = models.PositiveIntegerField(
+        default=5,
+        help_text="Downloads a source may start back to back"
+    )
+    download_max_concurrent = models.PositiveIntegerField(
+        default=4,
+        help_text="Downloads running at once per source (0 = unlimited)"
+    )
+    download_source_limits = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text='Per-source overrides, e.g. {"youtube": {"rate_per_minute": 10, "max_concurrent": 2}}'
+    )
+    
     # UI Settings
     default_theme = models.CharField(
         max_length=20,
@@ -278,6 +385,113 @@ class UploadSession(models.Model):
         if self.completed_at:
             return (self.completed_at - self.created_at).total_seconds()
         return None
+    
+    def record_results(self, succeeded=0, failed=0, errors=()):
+        """Atomically count finished files and close the session when all are done"""
+        from django.utils import timezone
+        updates = {
+            'successful_uploads': models.F('successful_uploads') + succeeded,
+            'failed_uploads': models.F('failed_uploads') + failed,
+            'status': 'processing',
+        }
+        if errors:
+            updates['error_log'] = Concat(
+                'error_log', Value(''.join(f"{e}\n" for e in errors)),
+                output_field=models.TextField()
+            )
+        UploadSession.objects.filter(pk=self.pk).update(**updates)
+        
+        # Close the session once every file has reported
+        finished = models.F('successful_uploads') + models.F('failed_uploads')
+        UploadSession.objects.filter(
+            pk=self.pk, total_files__lte=finished
+        ).update(
+            status=Case(
+                When(successful_uploads=0, then=Value('failed')),
+                default=Value('completed'),
+            ),
+            completed_at=timezone.now(),
+        )
+        self.refresh_from_db()
+
+
+class ChunkedUpload(models.Model):
+    """A single resumable file upload assembled from ranged chunks"""
+    
+    STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
+        ('complete', 'Complete'),
+        ('failed', 'Failed'),
+        ('expired', 'Expired'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    session = models.ForeignKey(
+        UploadSession,
+        on_delete=models.CASCADE,
+        related_name='chunked_uploads'
+    )
+    filename = models.CharField(max_length=255)
+    total_size = models.BigIntegerField()
+    
+    # Sorted, merged [start, end) byte ranges already written to disk
+    received_ranges = models.JSONField(default=list, blank=True)
+    bytes_received = models.BigIntegerField(default=0)
+    
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='uploading',
+        db_index=True
+    )
+    result_track = models.ForeignKey(
+        MusicFile,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='chunked_uploads'
+    )
+    error_message = models.TextField(blank=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    
+    class Meta:
+        ordering = ['created_at']
+    
+    def __str__(self):
+        return f"Chunked upload {self.filename} ({self.bytes_received}/{self.total_size})"
+    
+    @property
+    def is_complete(self):
+        """True when the received ranges cover the whole file"""
+        return self.received_ranges == [[0, self.total_size]]
+    
+    @property
+    def missing_ranges(self):
+        """Byte ranges the client still has to send"""
+        missing = []
+        cursor = 0
+        for start, end in self.received_ranges:
+            if start > cursor:
+                missing.append([cursor, start])
+            cursor = max(cursor, end)
+        if cursor < self.total_size:
+            missing.append([cursor, self.total_size])
+        return missing
+    
+    def add_range(self, start, end):
+        """Merge a freshly written [start, end) range and persist progress"""
+        ranges = sorted(self.received_ranges + [[start, end]])
+        merged = []
+        for range_start, range_end in ranges:
+            if merged and range_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], range_end)
+            else:
+                merged.append([range_start, range_end])
+        self.received_ranges = merged
+        self.bytes_received = sum(e - s for s, e in merged)
+        self.save(update_fields=['received_ranges', 'bytes_received', 'updated_at'])
 
 
 class DownloadTask(models.Model):
@@ -285,6 +499,7 @@ class DownloadTask(models.Model):
     
     STATUS_CHOICES = [
         ('pending', 'Pending'),
+        ('queued', 'Queued'),
         ('downloading', 'Downloading'),
         ('processing', 'Processing'),
         ('completed', 'Completed'),
@@ -299,6 +514,22 @@ class DownloadTask(models.Model):
         ('url', 'Direct URL'),
     ]
     
+    ACTIVE_STATUSES = ('pending', 'queued', 'downloading', 'processing')
+    
+    # Permanent failures (private, removed, geo-blocked...) are never retried
+    ERROR_KIND_CHOICES = [
+        ('transient', 'Transient'),
+        ('permanent', 'Permanent'),
+    ]
+    
+    # Pipeline stages, in order (see music.tasks)
+    STAGE_CHOICES = [
+        ('probe', 'Probe'),
+        ('fetch', 'Fetch'),
+        ('transcode', 'Transcode'),
+        ('ingest', 'Ingest'),
+    ]
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(
         User,
@@ -306,9 +537,24 @@ class DownloadTask(models.Model):
         related_name='download_tasks'
     )
     
+    # Playlist imports: the parent batch and its per-track child tasks
+    parent = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='children'
+    )
+    item_count = models.IntegerField(default=0, help_text="Child tasks of a playlist import")
+    
     # Source information
     url = models.URLField(max_length=2048, validators=[URLValidator()])
     source_type = models.CharField(max_length=20, choices=SOURCE_CHOICES, default='url')
+    media_id = models.CharField(
+        max_length=255,
+        blank=True,
+        help_text="Canonical <extractor>:<id> of the source media"
+    )
     
     # Task status with index for fast filtering
     status = models.CharField(
@@ -321,6 +567,17 @@ class DownloadTask(models.Model):
     # Progress tracking
     progress = models.IntegerField(default=0, help_text="Progress percentage 0-100")
     current_step = models.CharField(max_length=100, blank=True)
+    stage = models.CharField(
+        max_length=20,
+        choices=STAGE_CHOICES,
+        default='probe',
+        help_text="Pipeline stage to run (or resume) next"
+    )
+    staged_file = models.CharField(
+        max_length=500,
+        blank=True,
+        help_text="Output of the last finished stage, relative to MEDIA_ROOT"
+    )
     
     # Download metadata
     original_title = models.CharField(max_length=500, blank=True)
@@ -351,6 +608,7 @@ class DownloadTask(models.Model):
     
     # Error handling
     error_message = models.TextField(blank=True)
+    error_kind = models.CharField(max_length=20, choices=ERROR_KIND_CHOICES, blank=True)
     retry_count = models.IntegerField(default=0)
     
     # Timestamps with index for date-based queries
@@ -363,6 +621,11 @@ class DownloadTask(models.Model):
         indexes = [
             models.Index(fields=['user', 'status']),
             models.Index(fields=['status', 'created_at']),
+            # Finds an earlier import of the same media and output settings
+            models.Index(
+                fields=['media_id', 'output_format', 'output_quality'],
+                name='music_downl_media_output_idx'
+            ),
         ]
     
     def __str__(self):
@@ -371,7 +634,12 @@ class DownloadTask(models.Model):
     @property
     def is_active(self):
         """Check if task is currently being processed"""
-        return self.status in ['pending', 'downloading', 'processing']
+        return self.status in self.ACTIVE_STATUSES
+    
+    @property
+    def is_batch(self):
+        """Playlist import expanded into child tasks"""
+        return self.item_count > 0
     
     @property
     def elapsed_time(self):
@@ -381,33 +649,201 @@ class DownloadTask(models.Model):
             return (end_time - self.started_at).total_seconds()
         return None
     
-    def update_progress(self, progress, step=None):
-        """Efficiently update progress without triggering full save"""
+    def publish_progress(self, progress, step=None, force=False):
+        """
+        Stream progress to the user's download page without a DB write.
+        Updates are throttled; returns whether this one was sent.
+        """
         self.progress = min(100, max(0, progress))
         if step:
             self.current_step = step
+        publisher = getattr(self, '_progress_publisher', None)
+        if publisher is None:
+            publisher = self._progress_publisher = ProgressPublisher(self.id, self.user_id)
+        return publisher.publish(self.progress, self.current_step, self.status, force=force)
+    
+    def update_progress(self, progress, step=None):
+        """Persist a stage transition (and publish it)"""
+        self.publish_progress(progress, step, force=True)
         self.save(update_fields=['progress', 'current_step'])
     
+    def _update_unless_cancelled(self, **fields):
+        """
+        Write a worker-side status change without overwriting a concurrent
+        cancel. Returns False (and adopts the cancel) when the task was
+        cancelled meanwhile.
+        """
+        if not type(self).objects.filter(pk=self.pk).exclude(status='cancelled').update(**fields):
+            self.status = 'cancelled'
+            return False
+        for name, value in fields.items():
+            setattr(self, name, value)
+        return True
+    
     def mark_started(self):
-        """Mark task as started"""
+        """
+        Mark task as downloading (again, when a stage resumes after a
+        requeue); False when it was cancelled meanwhile.
+        """
         from django.utils import timezone
-        self.status = 'downloading'
-        self.started_at = timezone.now()
-        self.save(update_fields=['status', 'started_at'])
-    
-    def mark_completed(self, track):
+        if not self._update_unless_cancelled(status='downloading', started_at=self.started_at or timezone.now()):
+            return False
+        self.publish_progress(self.progress, force=True)
+        return True
+    
+    def mark_processing(self, progress, step):
+        """
+        Mark the download as finished and post-processing as started;
+        False when the task was cancelled meanwhile.
+        """
+        if not self._update_unless_cancelled(status='processing', progress=progress, current_step=step):
+            return False
+        self.publish_progress(progress, step, force=True)
+        return True
+    
+    def cancel_requested(self):
+        """Whether the task was cancelled since it was loaded (one pk lookup)"""
+        return type(self).objects.filter(pk=self.pk, status='cancelled').exists()
+    
+    def cancel(self):
+        """
+        Cancel this task, or every unfinished child of a playlist import.
+        
+        Only the rows change here; workers notice the status on their next
+        check (see music.tasks.cancel_download). Returns the ids of the
+        cancelled tasks.
+        """
+        from django.utils import timezone
+        
+        ids = [self.id]
+        if self.is_batch:
+            ids += list(
+                self.children.filter(status__in=self.ACTIVE_STATUSES).values_list('id', flat=True)
+            )
+        ids = list(
+            type(self).objects.filter(id__in=ids, status__in=self.ACTIVE_STATUSES)
+            .values_list('id', flat=True)
+        )
+        if not ids:
+            return []
+        
+        type(self).objects.filter(id__in=ids).update(
+            status='cancelled', current_step='Cancelled', completed_at=timezone.now()
+        )
+        self.refresh_from_db(fields=['status', 'current_step', 'completed_at'])
+        self.publish_progress(self.progress, force=True)
+        return ids
+    
+    def mark_completed(self, track, step=None):
         """Mark task as completed with result"""
         from django.utils import timezone
         self.status = 'completed'
         self.progress = 100
         self.result_track = track
         self.completed_at = timezone.now()
-        self.save(update_fields=['status', 'progress', 'result_track', 'completed_at'])
+        if step:
+            self.current_step = step
+        self.save(update_fields=['status', 'progress', 'current_step', 'result_track', 'completed_at'])
+        self.publish_progress(100, force=True)
+    
+    @classmethod
+    def reusable_tracks(cls, media_ids, output_format, output_quality):
+        """
+        Map media ids to the tracks of earlier completed imports with the
+        same output format and quality.
+        """
+        media_ids = {media_id for media_id in media_ids if media_id}
+        if not media_ids:
+            return {}
+        return dict(
+            cls.objects.filter(
+                media_id__in=media_ids,
+                output_format=output_format,
+                output_quality=output_quality,
+                status='completed',
+                result_track__isnull=False,
+            ).values_list('media_id', 'result_track_id')
+        )
+    
+    def complete_from_existing(self):
+        """
+        Finish instantly when this media was already imported with the same
+        output settings. Returns whether the task was completed.
+        """
+        track_id = self.reusable_tracks(
+            [self.media_id], self.output_format, self.output_quality
+        ).get(self.media_id)
+        track = MusicFile.objects.filter(pk=track_id).first() if track_id else None
+        if track is None:
+            return False
+        from django.utils import timezone
+        self.started_at = self.started_at or timezone.now()
+        self.save(update_fields=['media_id', 'started_at'])
+        self.mark_completed(track, step='Already in library')
+        return True
     
-    def mark_failed(self, error_msg):
-        """Mark task as failed with error message"""
+    def mark_failed(self, error_msg, permanent=False):
+        """Mark task as failed; permanent failures are never retried"""
         from django.utils import timezone
         self.status = 'failed'
         self.error_message = error_msg
+        self.error_kind = 'permanent' if permanent else 'transient'
         self.completed_at = timezone.now()
-        self.save(update_fields=['status', 'error_message', 'completed_at'])
+        self.save(update_fields=['status', 'error_message', 'error_kind', 'completed_at'])
+        self.publish_progress(self.progress, force=True)
+    
+    def refresh_batch_progress(self):
+        """
+        Recompute a playlist import's status and progress from its child
+        tasks with one aggregate query. Finished children (completed or
+        failed) count as 100%; the rest by their last persisted stage.
+        """
+        from django.db.models import Count, Q, Sum
+        from django.utils import timezone
+        
+        stats = self.children.filter(item_count=0).aggregate(
+            total=Count('id'),
+            completed=Count('id', filter=Q(status='completed')),
+            failed=Count('id', filter=Q(status__in=['failed', 'cancelled'])),
+            active_progress=Sum('progress', filter=Q(status__in=self.ACTIVE_STATUSES)),
+        )
+        total = stats['total']
+        if not total:
+            return
+        done = stats['completed'] + stats['failed']
+        progress = (100 * done + (stats['active_progress'] or 0)) // total
+        
+        update_fields = ['status', 'progress', 'current_step']
+        if done < total:
+            self.status = 'downloading'
+        else:
+            self.status = 'completed' if stats['completed'] else 'failed'
+            self.completed_at = timezone.now()
+            update_fields.append('completed_at')
+        step = f"{stats['completed']}/{total} imported"
+        if stats['failed']:
+            step += f", {stats['failed']} failed"
+        self.publish_progress(progress, step, force=True)
+        self.save(update_fields=update_fields)
+    
+    @classmethod
+    def live_progress(cls, user):
+        """
+        Progress of a user's active tasks: the persisted stage, overlaid
+        with the latest value published by the worker.
+        """
+        rows = list(
+            cls.objects.filter(user=user, parent__isnull=True, status__in=cls.ACTIVE_STATUSES)
+            .values_list('id', 'status', 'progress', 'current_step')
+        )
+        live = cached_progress(task_id for task_id, *_ in rows)
+        return [
+            {
+                'task_id': str(task_id),
+                'status': status,
+                'progress': progress,
+                'step': step,
+                **live.get(str(task_id), {}),
+            }
+            for task_id, status, progress, step in rows
+        ]
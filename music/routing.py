@@ -0,0 +1,9 @@
+from django.urls import path
+
+from . import consumers
+
+websocket_urlpatterns = [
+    path('ws/track/<uuid:track_id>/listeners/', consumers.TrackListenersConsumer.as_asgi()),
+    path('ws/now-playing/', consumers.NowPlayingConsumer.as_asgi()),
+    path('ws/downloads/', consumers.DownloadProgressConsumer.as_asgi()),
+]
@@ -131,40 +131,49 @@ class TrackListenersSocket {
                 console.log(`Listening to track ${trackId} listener updates`);
             }
         });
+
+        // The server stops counting listeners that go quiet (LISTENER_PRESENCE_TTL)
+        this.pingTimer = setInterval(() => {
+            wsManager.send(this.socketName, { type: 'ping' });
+        }, TrackListenersSocket.PING_INTERVAL);
     }
 
     disconnect() {
+        clearInterval(this.pingTimer);
         wsManager.disconnect(this.socketName);
     }
 }
 
 
+TrackListenersSocket.PING_INTERVAL = 30000;
+
+
 /**
  * Now Playing WebSocket
- * Shows what tracks are being played globally in real-time
+ * Receives the server's "playing now" board (top tracks of the last minutes)
  */
 class NowPlayingSocket {
-    constructor(onTrackPlaying) {
-        this.onTrackPlaying = onTrackPlaying;
+    constructor(onBoard) {
+        this.onBoard = onBoard;
         this.socketName = 'now_playing';
 
         wsManager.connect(this.socketName, '/ws/now-playing/', {
             onMessage: (data) => {
-                if (data.type === 'track_playing') {
-                    this.onTrackPlaying(data);
+                if (data.type === 'now_playing') {
+                    this.onBoard(data.tracks);
                 }
             }
         });
     }
 
     /**
-     * Broadcast that user started playing a track
-     * @param {object} trackData - Track information
+     * Report that the user started playing a track
+     * @param {string} trackId - Track UUID
      */
-    broadcastTrackStart(trackData) {
+    broadcastTrackStart(trackId) {
         wsManager.send(this.socketName, {
             type: 'track_start',
-            ...trackData
+            track_id: trackId
         });
     }
 
@@ -1,122 +1,392 @@
 """Celery tasks for background processing"""
 
 import logging
+import os
+import random
+import uuid
 from pathlib import Path
 from typing import Optional
 
-from celery import shared_task
+from celery import current_app, shared_task
+from celery.exceptions import Retry
 from django.conf import settings
-from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
 from django.utils import timezone
 
-from .models import DownloadTask, MusicFile, Artist, Album, Genre
-from .utils.downloader import MediaDownloader, DownloadProgressTracker
+from .models import (
+    DownloadTask, MusicFile, Artist, Album, Genre,
+    SystemSettings, UploadSession, ChunkedUpload,
+)
+from .utils.catalog import bulk_enrich_tracks
+from .utils.downloader import (
+    MediaDownloader, DownloadCancelled, DownloadProgressTracker, canonical_media_id,
+    get_downloader, is_permanent_error,
+)
+from .utils.heartbeat import Heartbeat, forget_heartbeats, last_heartbeats
+from .utils.metadata import hash_for_path, probe_audio, TAG_KEYS
+from .utils.resolver import resolve_artist_id
+from .utils.scheduler import get_scheduler
+from .utils.scratch import job_dir, release_job_dir, remove_entry, space_wait, stale_entries
+from .utils.uploads import (
+    CHUNKED_DIR, content_storage_name, discard_chunked_file, move_into_storage,
+)
+from .utils.waveform import generate_waveform
 
 logger = logging.getLogger(__name__)
 
+# Children of one playlist import downloading at the same time
+BATCH_CONCURRENCY = getattr(settings, 'DOWNLOAD_BATCH_CONCURRENCY', 4)
+PLAYLIST_MAX_ITEMS = getattr(settings, 'DOWNLOAD_PLAYLIST_MAX_ITEMS', 500)
+# Running stages without a heartbeat for this long are presumed dead
+STALE_AFTER = getattr(settings, 'DOWNLOAD_STALE_AFTER', 5 * 60)
+# Running tasks without any heartbeat are presumed lost after this long
+LOST_AFTER = getattr(settings, 'DOWNLOAD_LOST_AFTER', 2 * 60 * 60)
+TEMP_MAX_AGE = getattr(settings, 'DOWNLOAD_TEMP_MAX_AGE', 6 * 60 * 60)
+
+
+# ============================================================================
+# Download pipeline: probe -> fetch -> transcode -> ingest
+# ============================================================================
+#
+# Each stage is its own task on its own queue (CELERY_TASK_ROUTES), so
+# network-bound fetch workers and CPU-bound transcode workers can be sized
+# independently. A stage hands over to the next one when it succeeds;
+# failures retry only the failed stage, whose input (DownloadTask.staged_file)
+# is kept.
+#
+# Stage messages carry a predictable Celery id (stage_task_id), so
+# cancel_download can revoke whatever is still queued; running stages
+# notice the cancelled status themselves and stop.
+
+def _run_stage(self, task_id: str, stage: str, body):
+    """
+    Run one pipeline stage and dispatch whatever comes next.
+    
+    ``body(task)`` returns None to continue with the next stage, a stage
+    name to jump to, or a result dict when the task is finished.
+    """
+    task = DownloadTask.objects.filter(id=task_id).first()
+    if task is None:
+        logger.error(f"DownloadTask {task_id} not found")
+        return {'status': 'failed', 'error': 'Task not found'}
+    if task.status in ('completed', 'failed', 'cancelled'):
+        return {'status': task.status}
+    
+    if task.stage != stage:
+        task.stage = stage
+        task.save(update_fields=['stage'])
+    
+    try:
+        # Lets reap_stale_downloads tell a dead worker from a slow stage
+        with Heartbeat(task.id):
+            outcome = body(task)
+    except Retry:
+        raise
+    except DownloadCancelled:
+        logger.info(f"Download task {task_id} cancelled during {stage}")
+        _discard_staged_file(task)
+        outcome = {'status': 'cancelled'}
+    except Exception as e:
+        logger.error(f"Download task {task_id} failed in {stage}: {str(e)}", exc_info=True)
+        if is_permanent_error(e):
+            # Private, removed or unsupported media: retrying cannot help
+            task.mark_failed(str(e), permanent=True)
+            _finish_download(task)
+            return {'status': 'failed', 'error': str(e)}
+        
+        # Enough transient failures in a row pause the whole source (local
+        # transcode/ingest trouble says nothing about the source)
+        if stage in SOURCE_STAGES:
+            get_scheduler().record_failure(MediaDownloader.detect_source(task.url))
+        if task.retry_count < 3:
+            task.retry_count += 1
+            task.save(update_fields=['retry_count'])
+            
+            # Retry this stage with exponential backoff. Deferrals (_admit,
+            # _reserve_scratch) also count in request.retries, so failures
+            # are bounded by task.retry_count, not by Celery's max_retries.
+            raise self.retry(exc=e, countdown=60 * (2 ** task.retry_count), max_retries=None)
+        task.mark_failed(f"Max retries exceeded: {str(e)}")
+        _finish_download(task)
+        return {'status': 'failed', 'error': str(e)}
+    
+    if stage in SOURCE_STAGES:
+        get_scheduler().record_success(MediaDownloader.detect_source(task.url))
+    
+    if not isinstance(outcome, dict):
+        next_stage = outcome or DOWNLOAD_STAGES[DOWNLOAD_STAGES.index(stage) + 1]
+        _queue_stage(task_id, next_stage)
+        return {'status': 'running', 'stage': next_stage}
+    
+    _finish_download(task)
+    return outcome
+
+
+def _finish_download(task):
+    """Bookkeeping once a task completed or failed for good"""
+    get_scheduler().release(MediaDownloader.detect_source(task.url), task.id)
+    release_job_dir(task.id)
+    # A finished child frees a slot of its playlist import
+    if task.parent_id:
+        advance_download_batch(task.parent_id)
+
+
+def _admit(self, task):
+    """Hold a per-source slot, deferring the stage when over budget"""
+    source = MediaDownloader.detect_source(task.url)
+    wait = get_scheduler().acquire(source, task.id)
+    if wait:
+        logger.info(f"Download task {task.id} deferred {wait:.1f}s: {source} over budget")
+        raise self.retry(countdown=wait + random.uniform(0, 1), max_retries=None)
+    return source
+
+
+def _reserve_scratch(self, task):
+    """Defer the stage while scratch is over quota or the disk is nearly full"""
+    wait = space_wait()
+    if wait:
+        logger.info(f"Download task {task.id} deferred {wait:.1f}s: no scratch space")
+        raise self.retry(countdown=wait + random.uniform(0, 1), max_retries=None)
+
+
+def stage_task_id(task_id, stage: str) -> str:
+    """Celery id of a download's stage message (stable across retries)"""
+    return f'download-{task_id}-{stage}'
+
+
+def _queue_stage(task_id, stage: str):
+    STAGE_TASKS[stage].apply_async(args=[str(task_id)], task_id=stage_task_id(task_id, stage))
+
+
+def _staged_path(task) -> Optional[Path]:
+    path = Path(settings.MEDIA_ROOT) / task.staged_file if task.staged_file else None
+    return path if path and path.exists() else None
+
+
+def _stage_file(task, path: Path):
+    """Record a stage's output so later stages (or retries) pick it up"""
+    task.staged_file = str(path.relative_to(settings.MEDIA_ROOT))
+    task.save(update_fields=['staged_file'])
+
+
+def _discard_staged_file(task):
+    path = _staged_path(task)
+    if path is not None:
+        get_downloader().cleanup_file(path)
+    if task.staged_file:
+        task.staged_file = ''
+        task.save(update_fields=['staged_file'])
+
+
+def _reused_result(task):
+    return {
+        'status': 'completed',
+        'track_id': str(task.result_track_id),
+        'title': task.result_track.title,
+        'duplicate': True,
+    }
+
 
 @shared_task(bind=True, max_retries=3)
 def process_download_task(self, task_id: str):
     """
-    Background task to download and process media from URL
+    Stage 1 (probe): start a download from its URL
+    
+    Validates and extracts the URL once. Playlist, album and channel URLs
+    are expanded into child tasks of a batch instead (see expand_playlist);
+    media imported before with the same settings complete right away.
+    
+    Jobs are admitted by the per-source scheduler; over budget they are
+    deferred (retried later without counting as a failure).
     
     Args:
         task_id: UUID of DownloadTask
     
     Returns:
-        dict: Result with status and track_id if successful
+        dict: Result with status and track_id if finished here
     """
-    try:
-        # Get task
-        task = DownloadTask.objects.get(id=task_id)
+    def probe(task):
+        # Already expanded playlist (e.g. re-queued): just keep it moving
+        if task.is_batch:
+            advance_download_batch(task.id)
+            return {'status': 'batch', 'items': task.item_count}
+        
+        # Imported before with the same settings: no network, no ffmpeg
+        task.media_id = task.media_id or (canonical_media_id(task.url) or '')[:255]
+        if task.complete_from_existing():
+            logger.info(f"Download task {task_id} reused track {task.result_track_id}")
+            return _reused_result(task)
         
-        # Mark as started
-        task.mark_started()
+        _admit(self, task)
+        if not task.mark_started():
+            raise DownloadCancelled()
+        downloader = get_downloader()
         
-        # Initialize downloader
-        downloader = MediaDownloader()
+        # Progress between stage transitions is only published (channel
+        # layer + cache); the row is written when the stage changes.
         
-        # Step 1: Validate URL (5%)
-        task.update_progress(5, "Validating URL...")
+        # Validate URL (5%) - the only yt-dlp extraction of this task
+        task.publish_progress(5, "Validating URL...", force=True)
         is_valid, message = downloader.validate_url(task.url)
         
         if not is_valid:
-            task.mark_failed(f"URL validation failed: {message}")
+            # Network trouble is retried; bad, private or too long media is not
+            if downloader.last_error is not None and not is_permanent_error(downloader.last_error):
+                raise downloader.last_error
+            task.mark_failed(f"URL validation failed: {message}", permanent=True)
             return {'status': 'failed', 'error': message}
         
-        # Step 2: Extract metadata (10%)
-        task.update_progress(10, "Extracting video info...")
-        video_info = downloader.get_video_info(task.url)
+        # Extract metadata (10%) - reuses the validation extraction
+        task.publish_progress(10, "Extracting video info...", force=True)
+        info = downloader.extract_info(task.url)
         
-        if not video_info:
+        if not info:
             task.mark_failed("Failed to extract video information")
             return {'status': 'failed', 'error': 'Info extraction failed'}
+        if task.cancel_requested():
+            raise DownloadCancelled()
+        
+        entries = downloader.playlist_entries(info)
+        if entries is not None:
+            return expand_playlist(task, info, entries)
+        
+        video_info = downloader.summarize_info(info)
+        task.media_id = video_info['media_id'][:255]
+        
+        # The id may only be known after extraction: still skip the download
+        if task.complete_from_existing():
+            return _reused_result(task)
         
-        # Update task with original metadata
         task.original_title = video_info.get('title', '')[:500]
         task.original_artist = video_info.get('artist', '')[:255]
         task.duration = video_info.get('duration', 0)
-        task.save(update_fields=['original_title', 'original_artist', 'duration'])
-        
-        # Step 3: Download audio (10% -> 80%)
-        task.update_progress(15, "Starting download...")
+        task.publish_progress(15, "Waiting for download...", force=True)
+        task.save(update_fields=[
+            'original_title', 'original_artist', 'duration', 'media_id',
+            'progress', 'current_step'
+        ])
+    
+    return _run_stage(self, task_id, 'probe', probe)
+
+
+@shared_task(bind=True, max_retries=3)
+def fetch_download(self, task_id: str):
+    """Stage 2 (fetch): download the audio stream as-is (15% -> 80%)"""
+    def fetch(task):
+        _reserve_scratch(self, task)
+        source = _admit(self, task)
+        # Requeued tasks resume here as 'pending'/'queued': running again
+        # puts them back in reap_stale_downloads' view
+        if not task.mark_started():
+            raise DownloadCancelled()
+        downloader = get_downloader(download_dir=job_dir(task.id))
         
-        # Create progress tracker
         def progress_callback(percent, step):
             # Map 0-100% download to 15-80% task progress
-            task_percent = 15 + int(percent * 0.65)
-            task.update_progress(task_percent, step)
+            task.publish_progress(15 + int(percent * 0.65), step)
         
-        tracker = DownloadProgressTracker(task_id, progress_callback)
+        task.publish_progress(15, "Starting download...", force=True)
+        try:
+            fetched = downloader.fetch_audio(
+                task.url,
+                progress_callback=DownloadProgressTracker(
+                    task_id, progress_callback, is_cancelled=task.cancel_requested
+                ),
+            )
+        finally:
+            # Only probe and fetch talk to the source
+            get_scheduler().release(source, task.id)
         
-        downloaded_file = downloader.download_audio(
-            url=task.url,
+        if not fetched:
+            task.mark_failed("Download completed but file not found")
+            return {'status': 'failed', 'error': 'File not found'}
+        _stage_file(task, fetched)
+    
+    return _run_stage(self, task_id, 'fetch', fetch)
+
+
+@shared_task(bind=True, max_retries=3)
+def transcode_download(self, task_id: str):
+    """Stage 3 (transcode): convert to the output format and tag (80% -> 88%)"""
+    def transcode(task):
+        fetched = _staged_path(task)
+        if fetched is None:
+            return 'fetch'
+        
+        if not task.mark_processing(80, "Converting audio..."):
+            raise DownloadCancelled()
+        converted = get_downloader().transcode_audio(
+            fetched,
             output_format=task.output_format,
             quality=task.output_quality.replace('k', ''),
-            progress_callback=tracker
+            tags={'title': task.original_title, 'artist': task.original_artist},
+            is_cancelled=task.cancel_requested,
         )
+        _stage_file(task, converted)
+        fetched.unlink(missing_ok=True)
+    
+    return _run_stage(self, task_id, 'transcode', transcode)
+
+
+@shared_task(bind=True, max_retries=3)
+def ingest_download(self, task_id: str):
+    """Stage 4 (ingest): store the file and create the track (88% -> 100%)"""
+    def ingest(task):
+        downloaded_file = _staged_path(task)
+        if downloaded_file is None or downloaded_file.suffix != f'.{task.output_format}':
+            return 'fetch' if downloaded_file is None else 'transcode'
+        downloader = get_downloader()
         
-        if not downloaded_file or not downloaded_file.exists():
-            task.mark_failed("Download completed but file not found")
-            return {'status': 'failed', 'error': 'File not found'}
+        # Identical audio already in the library: reuse that track
+        content_hash = hash_for_path(downloaded_file)
+        existing = MusicFile.objects.filter(content_hash=content_hash).first()
+        if existing:
+            downloader.cleanup_file(downloaded_file)
+            task.mark_completed(existing)
+            logger.info(f"Download task {task_id} matched existing track {existing.id}")
+            return {
+                'status': 'completed',
+                'track_id': str(existing.id),
+                'title': existing.title,
+                'duplicate': True,
+            }
         
-        # Step 4: Extract metadata from file (85%)
-        task.update_progress(85, "Extracting metadata...")
+        # Extract metadata from file
+        if not task.mark_processing(88, "Extracting metadata..."):
+            raise DownloadCancelled()
         file_metadata = downloader.extract_metadata(downloaded_file)
         
-        # Step 5: Create database entries (90%)
-        task.update_progress(90, "Creating database entries...")
+        # Create database entries
+        task.publish_progress(90, "Creating database entries...", force=True)
         
-        # Get or create artist
-        artist_name = task.original_artist or "Unknown Artist"
-        artist, _ = Artist.objects.get_or_create(
-            name=artist_name,
-            defaults={'bio': ''}
-        )
+        # Resolve artist (cached; concurrent workers converge on one row)
+        artist_id = resolve_artist_id(task.original_artist or "Unknown Artist")
         
-        # Create MusicFile
-        track_title = task.original_title or downloaded_file.stem
-        
-        with open(downloaded_file, 'rb') as f:
-            django_file = File(f, name=downloaded_file.name)
-            
-            track = MusicFile.objects.create(
-                title=track_title,
-                artist=artist,
-                format=task.output_format,
-                duration=file_metadata.get('duration', task.duration or 0),
-                bitrate=file_metadata.get('bitrate', int(task.output_quality.replace('k', ''))),
-                file_size=downloaded_file.stat().st_size,
-            )
-            
-            # Move file to proper location
-            track.file.save(downloaded_file.name, django_file, save=True)
+        track = MusicFile(
+            title=task.original_title or downloaded_file.stem,
+            artist_id=artist_id,
+            format=task.output_format,
+            content_hash=content_hash,
+            duration=file_metadata.get('duration', task.duration or 0),
+            bitrate=file_metadata.get('bitrate', int(task.output_quality.replace('k', ''))),
+            file_size=downloaded_file.stat().st_size,
+        )
         
-        # Step 6: Cleanup (95%)
-        task.update_progress(95, "Cleaning up...")
-        downloader.cleanup_file(downloaded_file)
+        # Rename the file into content-addressed storage (no copy on the
+        # same filesystem) and insert the row once, fully populated
+        storage_name = content_storage_name(content_hash, downloaded_file.name)
+        track.file = move_into_storage(downloaded_file, storage_name)
+        try:
+            track.save()
+        except Exception:
+            # Give the stage its input back so a retry does not re-download
+            if not downloaded_file.exists():
+                os.link(default_storage.path(storage_name), downloaded_file)
+            raise
         
-        # Step 7: Mark completed (100%)
         task.mark_completed(track)
         
         logger.info(f"Download task {task_id} completed successfully. Track ID: {track.id}")
@@ -126,31 +396,226 @@ def process_download_task(self, task_id: str):
             'track_id': str(track.id),
             'title': track.title,
         }
-        
-    except DownloadTask.DoesNotExist:
-        logger.error(f"DownloadTask {task_id} not found")
-        return {'status': 'failed', 'error': 'Task not found'}
     
-    except Exception as e:
-        logger.error(f"Download task {task_id} failed: {str(e)}", exc_info=True)
-        
+    return _run_stage(self, task_id, 'ingest', ingest)
+
+
+DOWNLOAD_STAGES = ('probe', 'fetch', 'transcode', 'ingest')
+# Stages talking to the source; their outcomes drive its circuit breaker
+SOURCE_STAGES = ('probe', 'fetch')
+STAGE_TASKS = {
+    'probe': process_download_task,
+    'fetch': fetch_download,
+    'transcode': transcode_download,
+    'ingest': ingest_download,
+}
+
+
+def resume_download(task):
+    """Queue a task at the stage it stopped at (probe for new tasks)"""
+    _queue_stage(task.id, task.stage)
+
+
+def cancel_download(task):
+    """
+    Cancel a download (or a whole playlist import) for good.
+    
+    Stage messages still waiting in a queue or on a retry countdown are
+    revoked; a stage that is already running stops at its next check
+    (the yt-dlp progress hook, or the ffmpeg poll) and removes its files.
+    
+    Returns:
+        int: Number of tasks cancelled
+    """
+    ids = task.cancel()
+    if ids:
         try:
-            task = DownloadTask.objects.get(id=task_id)
+            current_app.control.revoke(
+                [stage_task_id(task_id, stage) for task_id in ids for stage in DOWNLOAD_STAGES]
+            )
+        except Exception as e:
+            # Revoked or not, a queued stage exits once it sees the status
+            logger.error(f"Failed to revoke download task {task.id}: {e}")
+        if task.parent_id:
+            advance_download_batch(task.parent_id)
+    return len(ids)
+
+
+def expand_playlist(task, info, entries):
+    """
+    Fan a flat playlist extraction out into child tasks of a batch.
+    
+    Children go under the root import, so a nested playlist (an album in a
+    discography) adds its tracks to the same batch. Media already in this
+    batch are skipped and media imported before are linked to their track
+    right away; the rest are queued BATCH_CONCURRENCY at a time.
+    """
+    root = task.parent or task
+    entries = entries[:PLAYLIST_MAX_ITEMS]
+    
+    seen = set(root.children.exclude(media_id='').values_list('media_id', flat=True))
+    imported = DownloadTask.reusable_tracks(
+        [entry['media_id'][:255] for entry in entries], task.output_format, task.output_quality
+    )
+    
+    now = timezone.now()
+    children = []
+    for entry in entries:
+        media_id = entry['media_id'][:255]
+        if media_id in seen:
+            continue
+        seen.add(media_id)
+        child = DownloadTask(
+            user_id=task.user_id,
+            parent=root,
+            url=entry['url'][:2048],
+            source_type=task.source_type,
+            media_id=media_id,
+            original_title=entry['title'][:500],
+            output_format=task.output_format,
+            output_quality=task.output_quality,
+        )
+        if media_id in imported:
+            child.status = 'completed'
+            child.progress = 100
+            child.current_step = 'Already in library'
+            child.result_track_id = imported[media_id]
+            child.completed_at = now
+        children.append(child)
+    
+    if not children and not root.children.exists():
+        task.mark_failed("Playlist is empty", permanent=True)
+        return {'status': 'failed', 'error': 'Playlist is empty'}
+    
+    with transaction.atomic():
+        DownloadTask.objects.bulk_create(children)
+        task.original_title = (info.get('title') or '')[:500]
+        task.original_artist = (info.get('uploader') or info.get('artist') or '')[:255]
+        task.media_id = MediaDownloader.media_id_for(info)[:255]
+        task.item_count = len(children)
+        if task is root:
+            task.save(update_fields=['original_title', 'original_artist', 'media_id', 'item_count'])
+        else:
+            # A nested playlist only contributes its items to the root batch
+            task.status = 'completed'
+            task.progress = 100
+            task.current_step = f"Expanded into {len(children)} items"
+            task.completed_at = now
+            task.save(update_fields=[
+                'original_title', 'original_artist', 'media_id', 'item_count',
+                'status', 'progress', 'current_step', 'completed_at'
+            ])
+            DownloadTask.objects.filter(id=root.id).update(item_count=F('item_count') + len(children))
+    
+    advance_download_batch(root.id)
+    logger.info(f"Download task {task.id} expanded into {len(children)} child tasks")
+    return {'status': 'expanded', 'items': len(children)}
+
+
+def advance_download_batch(batch_id):
+    """
+    Queue a playlist import's next pending children (keeping at most
+    BATCH_CONCURRENCY running) and refresh its aggregate progress.
+    """
+    with transaction.atomic():
+        # Serializes concurrent finishing children of the same batch
+        batch = DownloadTask.objects.select_for_update().get(id=batch_id)
+        if batch.status == 'cancelled':
+            return
+        children = batch.children.filter(item_count=0)
+        running = children.filter(status__in=['queued', 'downloading', 'processing']).count()
+        next_tasks = list(
+            children.filter(status='pending')
+            .order_by('created_at')
+            .only('id', 'stage')[:max(0, BATCH_CONCURRENCY - running)]
+        )
+        if next_tasks:
+            DownloadTask.objects.filter(id__in=[t.id for t in next_tasks]).update(status='queued')
+            transaction.on_commit(lambda: [resume_download(t) for t in next_tasks])
+        batch.refresh_batch_progress()
+
+
+def _report_upload_session(session_id, succeeded, failed, errors):
+    if session_id:
+        session = UploadSession.objects.filter(id=session_id).first()
+        if session:
+            session.record_results(succeeded, failed, errors)
+
+
+@shared_task(bind=True, max_retries=3)
+def enrich_uploaded_tracks(self, track_ids, session_id: Optional[str] = None,
+                           overrides: Optional[dict] = None):
+    """
+    Background enrichment for freshly uploaded tracks
+    
+    Each file is probed once (tags, duration/bitrate, embedded artwork),
+    artist/album/genre are resolved for the whole batch with set-based
+    queries, a waveform is rendered when enabled in SystemSettings and the
+    outcome is reported to the UploadSession.
+    
+    Args:
+        track_ids: UUIDs of MusicFile rows in 'processing' state
+        session_id: UUID of the UploadSession to report to
+        overrides: Catalog values the uploader set explicitly
+    
+    Returns:
+        dict: Counts of ready and failed tracks
+    """
+    system_settings = SystemSettings.load()
+    tracks = list(MusicFile.objects.filter(id__in=track_ids, processing_status='processing'))
+    
+    ready, probes, failed, errors = [], [], [], []
+    saved_covers = []
+    for track in tracks:
+        try:
+            probe = probe_audio(track.file)
+            if not system_settings.auto_extract_metadata:
+                probe = {k: v for k, v in probe.items() if k not in TAG_KEYS}
             
-            # Retry logic
-            if task.retry_count < 3:
-                task.retry_count += 1
-                task.save(update_fields=['retry_count'])
-                
-                # Retry with exponential backoff
-                countdown = 60 * (2 ** task.retry_count)
-                raise self.retry(exc=e, countdown=countdown)
-            else:
-                task.mark_failed(f"Max retries exceeded: {str(e)}")
-        except Exception:
-            pass
+            if not track.cover_image and probe.get('artwork') and probe.get('artwork_mime'):
+                artwork_ext = probe['artwork_mime'].split('/')[-1].replace('jpeg', 'jpg')
+                track.cover_image.save(
+                    f"{track.id}_cover.{artwork_ext}", ContentFile(probe['artwork']), save=False
+                )
+                saved_covers.append(track)
+            
+            if system_settings.auto_generate_waveforms:
+                track.waveform = generate_waveform(track.file.path)
+            
+            ready.append(track)
+            probes.append(probe)
+        except Exception as e:
+            logger.error(f"Enrichment failed for track {track.id}: {e}", exc_info=True)
+            if saved_covers and saved_covers[-1] is track:
+                saved_covers.pop().cover_image.delete(save=False)
+            failed.append(track.id)
+            errors.append(f"{track.title}: {e}")
+    
+    try:
+        bulk_enrich_tracks(ready, probes, overrides, extra_fields=['cover_image', 'waveform'])
+    except Exception as e:
+        logger.error(f"Enrichment batch failed: {e}", exc_info=True)
+        # No row points at these files: the retry writes them again
+        for track in saved_covers:
+            track.cover_image.delete(save=False)
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=30)
         
-        return {'status': 'failed', 'error': str(e)}
+        # Last attempt: fail the whole batch so nothing stays 'processing'
+        # and the upload session still closes
+        MusicFile.objects.filter(id__in=[track.id for track in tracks]).update(processing_status='failed')
+        errors.extend(f"{track.title}: {e}" for track in ready)
+        _report_upload_session(session_id, 0, len(tracks), errors)
+        return {'ready': 0, 'failed': len(tracks)}
+    
+    if failed:
+        MusicFile.objects.filter(id__in=failed).update(processing_status='failed')
+    
+    _report_upload_session(session_id, len(ready), len(failed), errors)
+    
+    logger.info(f"Enriched {len(ready)} uploaded tracks ({len(failed)} failed)")
+    
+    return {'ready': len(ready), 'failed': len(failed)}
 
 
 @shared_task
@@ -181,8 +646,9 @@ def retry_failed_downloads():
     """
     failed_tasks = DownloadTask.objects.filter(
         status='failed',
-        retry_count__lt=3
-    )[:10]  # Limit to 10 at a time
+        retry_count__lt=3,
+        item_count=0
+    ).exclude(error_kind='permanent')[:10]  # Limit to 10 at a time
     
     retried_count = 0
     
@@ -190,12 +656,144 @@ def retry_failed_downloads():
         task.status = 'pending'
         task.progress = 0
         task.error_message = ''
-        task.save(update_fields=['status', 'progress', 'error_message'])
+        task.error_kind = ''
+        task.save(update_fields=['status', 'progress', 'error_message', 'error_kind'])
         
-        # Queue for processing
-        process_download_task.delay(str(task.id))
+        # Resume at the failed stage (playlist items wait for a batch slot)
+        if task.parent_id:
+            advance_download_batch(task.parent_id)
+        else:
+            resume_download(task)
         retried_count += 1
     
     logger.info(f"Retried {retried_count} failed download tasks")
     
     return {'retried': retried_count}
+
+
+def _is_uuid(value: str) -> bool:
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
+
+
+@shared_task
+def reap_stale_downloads():
+    """
+    Periodic task to recover downloads whose worker died mid-stage
+    Runs every minute; running tasks whose heartbeat stopped for
+    DOWNLOAD_STALE_AFTER seconds, or that never beat and started more than
+    DOWNLOAD_LOST_AFTER seconds ago, are requeued at their stage (or failed
+    after 3 attempts) with one bulk UPDATE, and scratch directories no
+    live task uses are removed after DOWNLOAD_TEMP_MAX_AGE
+    """
+    from datetime import timedelta
+    
+    running = DownloadTask.objects.filter(status__in=['downloading', 'processing'], item_count=0)
+    beats = last_heartbeats(running.values_list('id', flat=True))
+    cutoff = timezone.now().timestamp() - STALE_AFTER
+    stale_ids = [task_id for task_id, beat in beats.items() if beat < cutoff]
+    
+    # No beat at all: the stage message was lost after its early ack, the
+    # worker died before its first beat, or the cache lost the key
+    lost_before = timezone.now() - timedelta(seconds=LOST_AFTER)
+    silent = running.filter(
+        Q(started_at__lt=lost_before) | Q(started_at__isnull=True, created_at__lt=lost_before)
+    ).values_list('id', flat=True)
+    stale_ids += [str(task_id) for task_id in silent if str(task_id) not in beats]
+    
+    reaped = []
+    if stale_ids:
+        requeue = When(retry_count__lt=3, then=Value('pending'))
+        DownloadTask.objects.filter(
+            id__in=stale_ids, status__in=['downloading', 'processing']
+        ).update(
+            status=Case(requeue, default=Value('failed')),
+            retry_count=Case(When(retry_count__lt=3, then=F('retry_count') + 1), default=F('retry_count')),
+            error_message=Value('Worker stopped responding'),
+            error_kind=Value('transient'),
+            completed_at=Case(When(retry_count__lt=3, then=Value(None)), default=Value(timezone.now())),
+        )
+        forget_heartbeats(stale_ids)
+        reaped = list(DownloadTask.objects.filter(id__in=stale_ids, error_message='Worker stopped responding'))
+    
+    for task in reaped:
+        logger.error(f"Download task {task.id} lost its worker during {task.stage}: {task.status}")
+        if task.status == 'pending' and not task.parent_id:
+            get_scheduler().release(MediaDownloader.detect_source(task.url), task.id)
+            resume_download(task)
+        else:
+            # Failed for good, or a playlist item that its batch queues again
+            _finish_download(task)
+    requeued = sum(task.status == 'pending' for task in reaped)
+    
+    # Scratch no live task uses: partial fetches, leftovers of reaped or cancelled tasks
+    entries = stale_entries(TEMP_MAX_AGE)
+    live = set()
+    if entries:
+        names = [path.name for path in entries]
+        live_tasks = DownloadTask.objects.exclude(status__in=['completed', 'cancelled'])
+        live = {str(task_id) for task_id in live_tasks.filter(
+            id__in=[name for name in names if _is_uuid(name)]
+        ).values_list('id', flat=True)}
+        # Loose files of downloads staged before per-job directories
+        live.update(Path(name).name for name in live_tasks.filter(
+            staged_file__in=[str(path.relative_to(settings.MEDIA_ROOT)) for path in entries]
+        ).values_list('staged_file', flat=True))
+    orphaned = 0
+    for path in entries:
+        if path.name not in live:
+            remove_entry(path)
+            orphaned += 1
+    
+    logger.info(f"Reaped {len(reaped)} stale downloads ({requeued} requeued), removed {orphaned} orphaned temp files")
+    
+    return {'reaped': len(reaped), 'requeued': requeued, 'orphaned': orphaned}
+
+
+@shared_task
+def cleanup_abandoned_upload_sessions():
+    """
+    Periodic task to garbage-collect abandoned resumable uploads
+    Runs hourly; uploads idle for UPLOAD_SESSION_TTL_HOURS are expired,
+    their part files removed and their sessions closed
+    """
+    from datetime import timedelta
+    
+    cutoff = timezone.now() - timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+    
+    stale = list(ChunkedUpload.objects.filter(
+        status='uploading',
+        updated_at__lt=cutoff
+    ).select_related('session'))
+    
+    for upload in stale:
+        discard_chunked_file(upload.id)
+    
+    ChunkedUpload.objects.filter(
+        id__in=[u.id for u in stale],
+        status='uploading'
+    ).update(status='expired', error_message='Upload abandoned')
+    
+    for upload in stale:
+        upload.session.record_results(failed=1, errors=[f"{upload.filename}: upload abandoned"])
+    
+    # Part files whose rows are gone (deleted sessions) or no longer uploading
+    orphaned = 0
+    chunked_dir = Path(settings.MEDIA_ROOT) / CHUNKED_DIR
+    if chunked_dir.exists():
+        active = {
+            str(pk) for pk in ChunkedUpload.objects.filter(
+                status='uploading'
+            ).values_list('id', flat=True)
+        }
+        for part in chunked_dir.glob('*.part'):
+            if part.stem not in active and part.stat().st_mtime < cutoff.timestamp():
+                part.unlink(missing_ok=True)
+                orphaned += 1
+    
+    logger.info(f"Expired {len(stale)} abandoned uploads, removed {orphaned} orphaned part files")
+    
+    return {'expired': len(stale), 'orphaned': orphaned}
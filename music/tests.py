@@ -1,9 +1,37 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client
 from django.contrib.auth.models import User
 from django.urls import reverse
-from music.models import Artist, Album, MusicFile
+from music.models import Artist, Album, MusicFile, UploadSession, ChunkedUpload
+import io
 import json
+import os
+import shutil
+import tempfile
+import wave
+from unittest import mock
+from django.core.cache import cache
+from django.test import override_settings
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
+from music.utils import metadata as metadata_utils
+
+
+def make_wav_bytes(seconds=1, rate=8000):
+    """Build a small silent mono WAV file in memory"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b'\x00\x00' * rate * seconds)
+    return buffer.getvalue()
+
+
+def run_tasks_eagerly(test):
+    """Execute Celery tasks inline for the duration of a test"""
+    from config.celery import app as celery_app
+    celery_app.conf.task_always_eager = True
+    test.addCleanup(setattr, celery_app.conf, 'task_always_eager', False)
 
 
 class ArtistModelTests(TestCase):
@@ -119,6 +147,24 @@ class ViewsTests(TestCase):
         response = self.client.get(reverse('index'), {'q': 'Test Song'})
         self.assertEqual(response.status_code, 200)
     
+    def test_download_uses_readable_filename(self):
+        """Test downloads are named after the track, not its content-addressed file"""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        with override_settings(MEDIA_ROOT=media_root):
+            self.music_file.title = 'Jóga / "Live"'
+            self.music_file.file.save(f"{'ab' * 32}.mp3", ContentFile(b'ID3 audio'))
+            download = self.client.get(reverse('music:download', args=[self.music_file.pk]))
+            stream = self.client.get(reverse('music:stream', args=[self.music_file.pk]))
+            download.close()
+            stream.close()
+        
+        self.assertEqual(
+            download['Content-Disposition'],
+            "attachment; filename*=utf-8''Test%20Artist%20-%20J%C3%B3ga%20Live.mp3"
+        )
+        self.assertTrue(stream['Content-Disposition'].startswith("inline; filename*=utf-8''Test%20Artist"))
+    
     def test_pagination(self):
         """Test pagination works correctly"""
         # Create additional music files
@@ -195,3 +241,1514 @@ class InputValidationTests(TestCase):
                 format="mp3",
                 file_size=1024
             )
+
+
+class MetadataProbeTests(TestCase):
+    """Unit tests for the cached single-pass metadata probe"""
+    
+    def setUp(self):
+        cache.clear()
+        self.tmp = tempfile.NamedTemporaryFile(suffix='.wav', delete=False)
+        self.tmp.write(make_wav_bytes(seconds=2))
+        self.tmp.close()
+    
+    def tearDown(self):
+        os.remove(self.tmp.name)
+    
+    def test_probe_returns_technical_info(self):
+        """Test probe reports duration, hash and size"""
+        result = metadata_utils.probe_audio(self.tmp.name)
+        self.assertEqual(result['duration'], 2)
+        self.assertEqual(result['file_size'], os.path.getsize(self.tmp.name))
+        self.assertEqual(len(result['content_hash']), 64)
+    
+    def test_probe_parses_unchanged_bytes_once(self):
+        """Test repeated probes of the same content hit the cache"""
+        with mock.patch.object(
+            metadata_utils, 'MutagenFile', wraps=metadata_utils.MutagenFile
+        ) as parser:
+            metadata_utils.probe_audio(self.tmp.name)
+            metadata_utils.probe_audio(self.tmp.name)
+            upload = SimpleUploadedFile('copy.wav', make_wav_bytes(seconds=2))
+            metadata_utils.probe_audio(upload)
+        self.assertEqual(parser.call_count, 1)
+    
+    def test_unparseable_file_is_cached(self):
+        """Test files mutagen can't read are not re-parsed on every save"""
+        with open(self.tmp.name, 'wb') as f:
+            f.write(b'not audio at all')
+        with mock.patch.object(
+            metadata_utils, 'MutagenFile', return_value=None
+        ) as parser:
+            first = metadata_utils.probe_audio(self.tmp.name)
+            metadata_utils.probe_audio(self.tmp.name)
+        self.assertNotIn('duration', first)
+        self.assertEqual(parser.call_count, 1)
+
+
+class StreamingUploadTests(TestCase):
+    """Unit tests for the streaming audio upload handler"""
+    
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        run_tasks_eagerly(self)
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def test_upload_is_written_once_into_tracks(self):
+        """Test the upload lands in tracks/ without a temp copy"""
+        upload = SimpleUploadedFile('song.wav', make_wav_bytes(), content_type='audio/wav')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('music:upload_music'), {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        
+        track = MusicFile.objects.get(id=json.loads(response.content)['id'])
+        self.assertTrue(track.file.name.startswith('tracks/'))
+        self.assertEqual(track.format, 'wav')
+        self.assertEqual(track.duration, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'temp')))
+    
+    def test_upload_returns_before_enrichment(self):
+        """Test the response carries a placeholder that the task completes"""
+        from music.models import SystemSettings
+        SystemSettings.objects.update_or_create(pk=1, defaults={'auto_generate_waveforms': True})
+        
+        upload = SimpleUploadedFile('Demo Take.wav', make_wav_bytes(seconds=2))
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('music:upload_music'), {'file': upload})
+        data = json.loads(response.content)
+        self.assertEqual(data['status'], 'processing')
+        
+        track = MusicFile.objects.get(id=data['id'])
+        self.assertFalse(track.duration)
+        self.assertEqual(track.processing_status, 'processing')
+        self.assertEqual(track.title, 'Demo Take')
+        
+        for callback in callbacks:
+            callback()
+        track.refresh_from_db()
+        self.assertEqual(track.processing_status, 'ready')
+        self.assertEqual(track.duration, 2)
+        self.assertEqual(len(track.waveform), 200)
+    
+    def test_failed_enrichment_batch_leaves_no_cover_files(self):
+        """Test artwork written before a failed bulk update is removed before the retry"""
+        from celery.exceptions import Retry
+        from music.tasks import enrich_uploaded_tracks
+        
+        artist = Artist.objects.create(name="Cover Artist")
+        track = MusicFile.objects.create(
+            title="Cover", artist=artist, format="mp3", file_size=1024, processing_status='processing'
+        )
+        probe = {'artwork': b'\xff\xd8 jpeg', 'artwork_mime': 'image/jpeg'}
+        with mock.patch('music.tasks.probe_audio', return_value=probe), \
+                mock.patch('music.tasks.bulk_enrich_tracks', side_effect=RuntimeError('db down')), \
+                mock.patch.object(enrich_uploaded_tracks, 'retry', side_effect=Retry()):
+            with self.assertRaises(Retry):
+                enrich_uploaded_tracks([track.id])
+        
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'covers')), [])
+    
+    def test_last_enrichment_attempt_fails_the_batch(self):
+        """Test a batch that fails on its last retry is marked failed and closes its session"""
+        from music.models import UploadSession
+        from music.tasks import enrich_uploaded_tracks
+        
+        user = User.objects.create_user(username='uploader', password='testpass123')
+        session = UploadSession.objects.create(user=user, total_files=1)
+        artist = Artist.objects.create(name="Cover Artist")
+        track = MusicFile.objects.create(
+            title="Cover", artist=artist, format="mp3", file_size=1024, processing_status='processing'
+        )
+        probe = {'artwork': b'\xff\xd8 jpeg', 'artwork_mime': 'image/jpeg'}
+        with mock.patch('music.tasks.probe_audio', return_value=probe), \
+                mock.patch('music.tasks.bulk_enrich_tracks', side_effect=RuntimeError('db down')):
+            result = enrich_uploaded_tracks.apply(
+                args=[[track.id], str(session.id)], retries=enrich_uploaded_tracks.max_retries
+            ).get()
+        
+        self.assertEqual(result, {'ready': 0, 'failed': 1})
+        track.refresh_from_db()
+        session.refresh_from_db()
+        self.assertEqual(track.processing_status, 'failed')
+        self.assertEqual((session.status, session.failed_uploads), ('failed', 1))
+        self.assertIn('Cover: db down', session.error_log)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'covers')), [])
+    
+    def test_non_audio_payload_is_rejected_and_removed(self):
+        """Test sniffed non-audio content is discarded"""
+        upload = SimpleUploadedFile('fake.mp3', b'<html>not audio</html>')
+        response = self.client.post(reverse('music:upload_music'), {'file': upload})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'tracks')), [])
+
+
+class ChunkedUploadTests(TestCase):
+    """Unit tests for resumable chunked uploads"""
+    
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        self.user = User.objects.create_user('uploader', password='secret')
+        self.client.force_login(self.user)
+        self.data = make_wav_bytes(seconds=1)
+        run_tasks_eagerly(self)
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def _create_session(self):
+        response = self.client.post(
+            reverse('music:upload_session_create'),
+            data=json.dumps({'files': [{'name': 'take.wav', 'size': len(self.data)}]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.content)
+    
+    def _put(self, upload_id, offset, payload):
+        return self.client.put(
+            f"{reverse('music:upload_chunk', args=[upload_id])}?offset={offset}",
+            data=payload,
+            content_type='application/octet-stream'
+        )
+    
+    def test_out_of_order_chunks_resume_and_finalize(self):
+        """Test chunks assemble in any order and finalize creates a track"""
+        upload_id = self._create_session()['uploads'][0]['id']
+        half = len(self.data) // 2
+        
+        response = self._put(upload_id, half, self.data[half:])
+        self.assertEqual(json.loads(response.content)['missing_ranges'], [[0, half]])
+        
+        finalize_url = reverse('music:upload_finalize', args=[upload_id])
+        self.assertEqual(self.client.post(finalize_url).status_code, 409)
+        
+        self._put(upload_id, 0, self.data[:half])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(finalize_url)
+        self.assertEqual(response.status_code, 200)
+        
+        track = MusicFile.objects.get(id=json.loads(response.content)['track_id'])
+        self.assertEqual(track.duration, 1)
+        session = ChunkedUpload.objects.get(id=upload_id).session
+        self.assertEqual(session.status, 'completed')
+        self.assertEqual(session.successful_uploads, 1)
+    
+    def test_abandoned_sessions_are_garbage_collected(self):
+        """Test idle uploads expire and their part files are removed"""
+        from music.tasks import cleanup_abandoned_upload_sessions
+        from music.utils.uploads import chunk_part_path
+        from django.utils import timezone
+        from datetime import timedelta
+        
+        upload_id = self._create_session()['uploads'][0]['id']
+        ChunkedUpload.objects.filter(id=upload_id).update(
+            updated_at=timezone.now() - timedelta(days=2)
+        )
+        
+        result = cleanup_abandoned_upload_sessions()
+        
+        self.assertEqual(result['expired'], 1)
+        self.assertFalse(chunk_part_path(upload_id).exists())
+        self.assertEqual(UploadSession.objects.get().status, 'failed')
+
+
+class BatchUploadTests(TestCase):
+    """Unit tests for the bulk multi-file upload endpoint"""
+    
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        self.user = User.objects.create_user('batcher', password='secret')
+        self.client.force_login(self.user)
+        run_tasks_eagerly(self)
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def _post(self, count, extra=()):
+        files = [
+            SimpleUploadedFile(f'track{i}.wav', make_wav_bytes(seconds=i + 1))
+            for i in range(count)
+        ] + list(extra)
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('music:upload_batch'),
+                {'files': files, 'artist': 'Batch Artist', 'album': 'Batch Album'}
+            )
+    
+    def test_batch_reports_per_file_results(self):
+        """Test valid files are created and invalid ones reported"""
+        bad = SimpleUploadedFile('notes.mp3', b'plain text')
+        response = self._post(3, extra=[bad])
+        data = json.loads(response.content)
+        
+        self.assertEqual(data['results'][0]['status'], 'processing')
+        self.assertEqual(data['results'][3]['status'], 'failed')
+        self.assertEqual(Artist.objects.filter(name='Batch Artist').count(), 1)
+        self.assertEqual(MusicFile.objects.filter(album__title='Batch Album').count(), 3)
+        
+        session = UploadSession.objects.get(id=data['session_id'])
+        self.assertEqual(session.successful_uploads, 3)
+        self.assertEqual(session.failed_uploads, 1)
+        self.assertEqual(session.status, 'completed')
+    
+    def test_batch_query_count_does_not_grow_per_file(self):
+        """Test entity resolution and inserts are set-based"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        
+        from music.models import SystemSettings
+        SystemSettings.load()  # enrichment reads the singleton; create it up front
+        
+        with CaptureQueriesContext(connection) as small:
+            self._post(2)
+        Artist.objects.all().delete()
+        with CaptureQueriesContext(connection) as large:
+            self._post(6)
+        self.assertEqual(len(small), len(large))
+
+
+class ContentAddressedStorageTests(TestCase):
+    """Unit tests for hash-keyed storage and duplicate detection"""
+    
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        self.user = User.objects.create_user('deduper', password='secret')
+        self.client.force_login(self.user)
+        run_tasks_eagerly(self)
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def _stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media_root)
+            for root, _, names in os.walk(os.path.join(self.media_root, 'tracks'))
+            for name in names
+        )
+    
+    def test_repeated_upload_returns_existing_track(self):
+        """Test identical bytes are stored once and the same track is returned"""
+        data = make_wav_bytes()
+        with self.captureOnCommitCallbacks(execute=True):
+            first = json.loads(self.client.post(
+                reverse('music:upload_music'), {'file': SimpleUploadedFile('a.wav', data)}
+            ).content)
+        second = json.loads(self.client.post(
+            reverse('music:upload_music'), {'file': SimpleUploadedFile('copy.wav', data)}
+        ).content)
+        
+        self.assertTrue(second['duplicate'])
+        self.assertEqual(second['id'], first['id'])
+        
+        track = MusicFile.objects.get()
+        self.assertEqual(track.file.name, f"tracks/{track.content_hash[:2]}/{track.content_hash}.wav")
+        self.assertEqual(self._stored_files(), [track.file.name])
+    
+    def test_batch_collapses_repeated_files(self):
+        """Test repeats inside one batch share a track and close the session"""
+        data = make_wav_bytes()
+        files = [SimpleUploadedFile(name, data) for name in ('x.wav', 'y.wav')]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('music:upload_batch'), {'files': files})
+        results = json.loads(response.content)['results']
+        
+        self.assertEqual([r['status'] for r in results], ['processing', 'duplicate'])
+        self.assertEqual(results[0]['id'], results[1]['id'])
+        self.assertEqual(len(self._stored_files()), 1)
+        self.assertEqual(UploadSession.objects.get().successful_uploads, 2)
+    
+    def test_backfill_hashes_and_merges_duplicates(self):
+        """Test the backfill command keeps one track per content hash"""
+        from django.core.management import call_command
+        from music.models import Playlist
+        
+        artist = Artist.objects.create(name='Legacy')
+        tracks = []
+        for name in ('old1.wav', 'old2.wav'):
+            path = os.path.join(self.media_root, 'tracks', name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(make_wav_bytes())
+            tracks.append(MusicFile.objects.create(
+                title=name, artist=artist, file=f'tracks/{name}', duration=1, play_count=2
+            ))
+        playlist = Playlist.objects.create(name='Mix', user=self.user)
+        playlist.tracks.add(tracks[1])
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('backfill_content_hashes', workers=2, stdout=io.StringIO())
+        
+        track = MusicFile.objects.get()
+        self.assertEqual(track.pk, tracks[0].pk)
+        self.assertEqual(track.play_count, 4)
+        self.assertEqual(list(playlist.tracks.all()), [track])
+        self.assertEqual(self._stored_files(), [track.file.name])
+
+
+class EntityResolverTests(TestCase):
+    """Unit tests for normalized, cached artist/album/genre resolution"""
+    
+    def setUp(self):
+        cache.clear()
+    
+    def test_spelling_variants_resolve_to_one_artist(self):
+        """Test case, width and whitespace variants share a single row"""
+        from music.utils.resolver import resolve_artist_ids
+        
+        ids = resolve_artist_ids(['Daft Punk', 'daft  punk', 'ＤＡＦＴ PUNK'])
+        
+        self.assertEqual(len(set(ids.values())), 1)
+        self.assertEqual(Artist.objects.count(), 1)
+    
+    def test_warm_lookup_skips_the_database(self):
+        """Test committed ids are served from the cache"""
+        from music.utils.resolver import resolve_artist_ids, resolve_album_ids
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            artist_id = resolve_artist_ids(['Cached'])['Cached']
+            resolve_album_ids({('Hits', artist_id): 2001})
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_artist_ids(['cached'])['cached'], artist_id)
+            resolve_album_ids({('HITS', artist_id): None})
+    
+    def test_merge_command_folds_existing_duplicates(self):
+        """Test rows that collide under normalization are merged"""
+        from django.core.management import call_command
+        
+        keep = Artist.objects.create(name='The Band')
+        dup = Artist.objects.create(name='Placeholder')
+        # Simulate a row stored before normalization existed
+        Artist.objects.filter(pk=dup.pk).update(name='the band ', name_key='legacy')
+        Album.objects.create(title='Live', artist=keep)
+        dup_album = Album.objects.create(title='LIVE', artist=dup)
+        track = MusicFile.objects.create(
+            title='Song', artist=dup, album=dup_album, file='tracks/song.mp3', duration=1
+        )
+        
+        call_command('merge_duplicate_entities', stdout=io.StringIO())
+        
+        track.refresh_from_db()
+        self.assertEqual(list(Artist.objects.all()), [keep])
+        self.assertEqual(track.artist_id, keep.pk)
+        self.assertEqual(track.album.title, 'Live')
+        self.assertEqual(Album.objects.count(), 1)
+
+
+class SingleExtractionTests(TestCase):
+    """Unit tests for reusing one yt-dlp extraction per download"""
+    
+    URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    
+    def setUp(self):
+        cache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        self.calls = []
+        test = self
+        
+        class FakeYoutubeDL:
+            def __init__(self, params):
+                self.params = params
+            
+            def __enter__(self):
+                return self
+            
+            def __exit__(self, *exc):
+                return False
+            
+            def sanitize_info(self, info):
+                return info
+            
+            def extract_info(self, url, download=True):
+                test.calls.append(('extract_info', download))
+                return {'id': 'dQw4w9WgXcQ', 'extractor_key': 'Youtube',
+                        'title': 'Song', 'uploader': 'Singer', 'duration': 200}
+            
+            def process_ie_result(self, info, download=True):
+                test.calls.append(('process_ie_result', download))
+                with open(os.path.join(test.tmpdir, f"{info['id']}.mp3"), 'wb') as f:
+                    f.write(b'ID3')
+                return info
+        
+        patcher = mock.patch('music.utils.downloader.yt_dlp.YoutubeDL', FakeYoutubeDL)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+    
+    def test_validate_info_and_download_share_one_extraction(self):
+        """Test validation, metadata and download trigger a single extract_info"""
+        from pathlib import Path
+        from music.utils.downloader import MediaDownloader
+        
+        downloader = MediaDownloader(download_dir=Path(self.tmpdir))
+        self.assertTrue(downloader.validate_url(self.URL)[0])
+        self.assertEqual(downloader.get_video_info(self.URL)['artist'], 'Singer')
+        path = downloader.fetch_audio(self.URL)
+        
+        self.assertEqual(path.name, 'dQw4w9WgXcQ.mp3')
+        self.assertEqual(self.calls, [('extract_info', False), ('process_ie_result', True)])
+    
+    def test_url_variants_hit_the_shared_cache(self):
+        """Test another spelling of the same video reuses the cached info"""
+        from pathlib import Path
+        from music.utils.downloader import MediaDownloader
+        
+        MediaDownloader(download_dir=Path(self.tmpdir)).extract_info(self.URL)
+        MediaDownloader(download_dir=Path(self.tmpdir)).extract_info('https://youtu.be/dQw4w9WgXcQ?t=42')
+        
+        self.assertEqual(self.calls, [('extract_info', False)])
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class DownloadProgressTests(TestCase):
+    """Unit tests for live download progress"""
+    
+    def setUp(self):
+        from music.models import DownloadTask
+        cache.clear()
+        self.user = User.objects.create_user(username='downloader', password='testpass123')
+        self.task = DownloadTask.objects.create(user=self.user, url='https://example.com/a.mp3')
+    
+    def test_tracker_publishes_throttled_without_db_writes(self):
+        """Test per-percent progress is throttled and never hits the database"""
+        from music.utils.downloader import DownloadProgressTracker
+        from music.utils.progress import ProgressPublisher
+        
+        tracker = DownloadProgressTracker(self.task.id, self.task.publish_progress)
+        clock = iter(range(1000))
+        with mock.patch('music.utils.progress.time.monotonic', lambda: next(clock) * 0.1), \
+                mock.patch.object(ProgressPublisher, '_send') as send:
+            with self.assertNumQueries(0):
+                for percent in range(1, 101):
+                    tracker({'status': 'downloading', '_percent_str': f'{percent}%'})
+        
+        # 100 updates 0.1s apart, at most one every 0.5s
+        self.assertEqual(send.call_count, 20)
+        self.assertEqual(send.call_args_list[0].args[0]['progress'], 1)
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.progress, 0)
+    
+    def test_stage_transitions_are_persisted_and_cached(self):
+        """Test stage changes hit the database and feed the polling endpoint"""
+        with mock.patch('music.utils.progress.PUBLISH_INTERVAL', 0):
+            self.task.mark_started()
+            self.task.publish_progress(40, 'Downloading: 40.0%')
+        
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, 'downloading')
+        self.assertEqual(self.task.progress, 0)
+        
+        client = Client()
+        client.login(username='downloader', password='testpass123')
+        response = client.get(reverse('music:download_progress'))
+        tasks = json.loads(response.content)['tasks']
+        self.assertEqual(tasks[0]['progress'], 40)
+        self.assertEqual(tasks[0]['step'], 'Downloading: 40.0%')
+        
+        self.task.mark_processing(85, 'Extracting metadata...')
+        self.task.refresh_from_db()
+        self.assertEqual((self.task.status, self.task.progress), ('processing', 85))
+    
+    def test_consumer_sends_snapshot_and_relays_events(self):
+        """Test the WebSocket consumer sends a snapshot, then live updates"""
+        from asgiref.sync import async_to_sync
+        from channels.db import database_sync_to_async
+        from channels.testing.websocket import WebsocketCommunicator
+        from music.consumers import DownloadProgressConsumer
+        
+        self.task.mark_started()
+        self.task._progress_publisher.min_interval = 0
+        
+        async def scenario():
+            communicator = WebsocketCommunicator(DownloadProgressConsumer.as_asgi(), '/ws/downloads/')
+            communicator.scope['user'] = self.user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            snapshot = await communicator.receive_json_from()
+            await database_sync_to_async(self.task.publish_progress)(50, 'Downloading: 50.0%')
+            update = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return snapshot, update
+        
+        snapshot, update = async_to_sync(scenario)()
+        self.assertEqual(snapshot['type'], 'snapshot')
+        self.assertEqual(snapshot['tasks'][0]['task_id'], str(self.task.id))
+        self.assertEqual((update['type'], update['progress']), ('progress', 50))
+    
+    def test_consumer_rejects_anonymous_users(self):
+        """Test anonymous WebSocket connections are closed"""
+        from asgiref.sync import async_to_sync
+        from django.contrib.auth.models import AnonymousUser
+        from channels.testing.websocket import WebsocketCommunicator
+        from music.consumers import DownloadProgressConsumer
+        
+        async def scenario():
+            communicator = WebsocketCommunicator(DownloadProgressConsumer.as_asgi(), '/ws/downloads/')
+            communicator.scope['user'] = AnonymousUser()
+            connected, _ = await communicator.connect()
+            return connected
+        
+        self.assertFalse(async_to_sync(scenario)())
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ListenerPresenceTests(TestCase):
+    """Unit tests for per-connection listener presence"""
+    
+    def setUp(self):
+        from music.utils import presence
+        patcher = mock.patch.object(presence, '_backend', presence._LocalPresence())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_connections_count_once_and_expire_without_ping(self):
+        """Test each connection counts once and stops counting after the TTL"""
+        from asgiref.sync import async_to_sync
+        from music.utils import presence
+        
+        with mock.patch('music.utils.presence.time.time', return_value=1000.0):
+            self.assertEqual(async_to_sync(presence.join)(7, 'a'), 1)
+            self.assertEqual(async_to_sync(presence.join)(7, 'b'), 2)
+            self.assertEqual(async_to_sync(presence.join)(7, 'a'), 2)
+            self.assertEqual(async_to_sync(presence.leave)(7, 'b'), 1)
+        with mock.patch('music.utils.presence.time.time', return_value=1000.0 + presence.PRESENCE_TTL):
+            # 'a' never pinged again, e.g. its node crashed
+            self.assertEqual(async_to_sync(presence.listener_counts)([7, 8]), {'7': 0, '8': 0})
+    
+    def test_expiry_found_by_a_ping_is_broadcast(self):
+        """Test a crashed connection's expiry marks the track changed for the remaining listeners"""
+        from asgiref.sync import async_to_sync
+        from music.utils import presence
+        
+        backend = presence._get_backend()
+        with mock.patch('music.utils.presence.time.time', return_value=1000.0):
+            async_to_sync(presence.join)(9, 'crashed')
+            async_to_sync(presence.join)(9, 'alive')
+            async_to_sync(backend.pop_changed)(10)
+        with mock.patch('music.utils.presence.time.time', return_value=1000.0 + presence.PRESENCE_TTL - 1):
+            async_to_sync(presence.join)(9, 'alive')
+            self.assertEqual(async_to_sync(backend.pop_changed)(10), [])
+        with mock.patch('music.utils.presence.time.time', return_value=1000.0 + presence.PRESENCE_TTL):
+            self.assertEqual(async_to_sync(presence.join)(9, 'alive'), 1)
+            self.assertEqual(async_to_sync(backend.pop_changed)(10), ['9'])
+    
+    def test_consumer_counts_live_connections(self):
+        """Test the listeners consumer reports joins and coalesces broadcasts per track"""
+        from asgiref.sync import async_to_sync
+        from channels.layers import get_channel_layer
+        from channels.testing.websocket import WebsocketCommunicator
+        from music.consumers import TrackListenersConsumer
+        from music.utils import presence
+        
+        def listener():
+            communicator = WebsocketCommunicator(TrackListenersConsumer.as_asgi(), '/ws/track/7/listeners/')
+            communicator.scope['url_route'] = {'kwargs': {'track_id': '7'}}
+            return communicator
+        
+        async def scenario():
+            first, second = listener(), listener()
+            await first.connect()
+            joined = [(await first.receive_json_from())['count']]
+            await second.connect()
+            joined.append((await second.receive_json_from())['count'])
+            await second.send_json_to({'type': 'ping'})
+            pong = await second.receive_json_from()
+            
+            # Churn: a listener comes and goes, then the first one leaves
+            third = listener()
+            await third.connect()
+            await third.disconnect()
+            await first.disconnect()
+            quiet = await second.receive_nothing()
+            
+            broadcasts = await presence.broadcast_changed_counts(get_channel_layer())
+            left = await second.receive_json_from()
+            coalesced = await second.receive_nothing()
+            await second.disconnect()
+            return joined, pong, quiet, broadcasts, left, coalesced
+        
+        with mock.patch.object(presence, 'BROADCAST_INTERVAL', 3600):
+            joined, pong, quiet, broadcasts, left, coalesced = async_to_sync(scenario)()
+        self.assertEqual(joined, [1, 2])
+        self.assertEqual(pong, {'type': 'pong'})
+        self.assertTrue(quiet)
+        self.assertEqual(broadcasts, 1)
+        self.assertEqual((left['type'], left['count']), ('listener_count', 1))
+        self.assertTrue(coalesced)
+    
+    def test_asgi_application_routes_websockets(self):
+        """Test config.asgi serves the consumers and rejects foreign origins"""
+        import uuid
+        from asgiref.sync import async_to_sync
+        from channels.testing.websocket import WebsocketCommunicator
+        from config.asgi import application
+        
+        track_id = uuid.uuid4()
+        
+        async def connect(path, origin=b'http://testserver'):
+            communicator = WebsocketCommunicator(application, path, headers=[(b'origin', origin)])
+            connected, _ = await communicator.connect()
+            first = await communicator.receive_json_from() if connected and 'listeners' in path else None
+            await communicator.disconnect()
+            return connected, first
+        
+        connected, first = async_to_sync(connect)(f'/ws/track/{track_id}/listeners/')
+        self.assertTrue(connected)
+        self.assertEqual(first, {'type': 'listener_count', 'track_id': str(track_id), 'count': 1})
+        self.assertTrue(async_to_sync(connect)('/ws/now-playing/')[0])
+        self.assertFalse(async_to_sync(connect)('/ws/now-playing/', origin=b'http://evil.example')[0])
+
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class NowPlayingBoardTests(TestCase):
+    """Unit tests for the aggregated "playing now" board"""
+    
+    def setUp(self):
+        from music.utils import now_playing
+        for name, value in (('_backend', now_playing._LocalBoard()), ('PUBLISH_INTERVAL', 3600)):
+            patcher = mock.patch.object(now_playing, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cache.clear()
+        self.artist = Artist.objects.create(name="Board Artist")
+        self.tracks = [
+            MusicFile.objects.create(title=f"Hit {i}", artist=self.artist, format="mp3", file_size=1024)
+            for i in range(3)
+        ]
+    
+    def test_board_counts_starts_in_window(self):
+        """Test the board ranks recent starts and drops unknown and expired tracks"""
+        import uuid
+        from asgiref.sync import async_to_sync
+        from music.utils import now_playing
+        
+        first, second, _ = self.tracks
+        with mock.patch('music.utils.now_playing.time.time', return_value=1000.0):
+            for track_id in (first.id, second.id, second.id):
+                self.assertTrue(async_to_sync(now_playing.record_play)(track_id))
+            # Forged ids are not counted, however often they are reported
+            for _ in range(3):
+                self.assertFalse(async_to_sync(now_playing.record_play)(uuid.uuid4()))
+            board = async_to_sync(now_playing.build_board)()
+        with mock.patch('music.utils.now_playing.time.time', return_value=1000.0 + now_playing.WINDOW):
+            expired = async_to_sync(now_playing.build_board)()
+        
+        self.assertEqual(board, [
+            {'track_id': str(second.id), 'title': 'Hit 1', 'artist': 'Board Artist', 'plays': 2},
+            {'track_id': str(first.id), 'title': 'Hit 0', 'artist': 'Board Artist', 'plays': 1},
+        ])
+        self.assertEqual(expired, [])
+    
+    def test_deleted_tracks_do_not_shrink_the_board(self):
+        """Test tracks deleted after being counted leave room for the next ones"""
+        from asgiref.sync import async_to_sync
+        from music.utils import now_playing
+        
+        gone, kept, _ = self.tracks
+        for track, plays in ((gone, 3), (kept, 1)):
+            for _ in range(plays):
+                async_to_sync(now_playing.record_play)(track.id)
+        gone.delete()
+        
+        with mock.patch.object(now_playing, 'TOP_K', 1):
+            board = async_to_sync(now_playing.build_board)()
+        self.assertEqual([entry['track_id'] for entry in board], [str(kept.id)])
+    
+    def test_consumer_ingests_without_relaying(self):
+        """Test reported starts are rate-limited and reach clients only as snapshots"""
+        from asgiref.sync import async_to_sync
+        from channels.layers import get_channel_layer
+        from channels.testing.websocket import WebsocketCommunicator
+        from music.consumers import NowPlayingConsumer
+        from music.utils import now_playing
+        
+        track = self.tracks[0]
+        
+        async def scenario():
+            reporter = WebsocketCommunicator(NowPlayingConsumer.as_asgi(), '/ws/now-playing/')
+            watcher = WebsocketCommunicator(NowPlayingConsumer.as_asgi(), '/ws/now-playing/')
+            await reporter.connect()
+            await watcher.connect()
+            snapshots = [await reporter.receive_json_from(), await watcher.receive_json_from()]
+            
+            for _ in range(now_playing.START_BURST + 2):
+                await reporter.send_json_to({
+                    'type': 'track_start', 'track_id': str(track.id), 'track_title': 'Forged', 'user_id': 42
+                })
+            await reporter.send_json_to({'type': 'track_start', 'track_id': 'not-a-uuid'})
+            limited = [await reporter.receive_json_from() for _ in range(2)]
+            relayed = await watcher.receive_nothing()
+            
+            await now_playing.publish_board(get_channel_layer())
+            board = await watcher.receive_json_from()
+            await reporter.disconnect()
+            await watcher.disconnect()
+            return snapshots, limited, relayed, board
+        
+        snapshots, limited, relayed, board = async_to_sync(scenario)()
+        self.assertEqual(snapshots, [{'type': 'now_playing', 'tracks': []}] * 2)
+        self.assertEqual(limited, [{'type': 'rate_limited'}] * 2)
+        self.assertTrue(relayed)
+        self.assertEqual(board, {'type': 'now_playing', 'tracks': [{
+            'track_id': str(track.id), 'title': 'Hit 0', 'artist': 'Board Artist',
+            'plays': now_playing.START_BURST,
+        }]})
+    
+    def test_websocket_benchmark_reports_every_consumer(self):
+        """Test the load harness connects, fans out and reports both consumers"""
+        from io import StringIO
+        from django.core.management import call_command
+        from music.utils import presence
+        
+        out = StringIO()
+        with mock.patch.object(presence, '_backend', presence._LocalPresence()):
+            call_command('benchmark_websockets', listeners=4, now_playing=3, tracks=2, rounds=2,
+                         memory_layer=True, stdout=out)
+        
+        output = out.getvalue()
+        self.assertIn('Клиентов: 7, ошибок подключения: 0', output)
+        self.assertRegex(output, r'connect listeners\s+4\s')
+        self.assertRegex(output, r'fanout listeners\s+8\s')
+        self.assertRegex(output, r'fanout now_playing\s+6\s')
+        self.assertNotIn('Не доставлено', output)
+
+class PlaylistImportTests(TestCase):
+    """Unit tests for playlist imports fanned out into child tasks"""
+    
+    def setUp(self):
+        from music.models import DownloadTask
+        cache.clear()
+        self.user = User.objects.create_user(username='importer', password='testpass123')
+        self.batch = DownloadTask.objects.create(
+            user=self.user, url='https://artist.bandcamp.com/album/record', source_type='bandcamp'
+        )
+        self.info = {
+            '_type': 'playlist', 'id': 'record', 'extractor_key': 'BandcampAlbum', 'title': 'Record',
+            'entries': [
+                {'ie_key': 'Bandcamp', 'id': f't{n}', 'title': f'Track {n}',
+                 'url': f'https://artist.bandcamp.com/track/t{n}'}
+                for n in (1, 2, 2, 3, 4)
+            ],
+        }
+        patcher = mock.patch('music.tasks.BATCH_CONCURRENCY', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def expand(self):
+        from music.tasks import expand_playlist
+        from music.utils.downloader import MediaDownloader
+        
+        self.batch.mark_started()
+        with mock.patch('music.tasks.process_download_task.apply_async') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            expand_playlist(self.batch, self.info, MediaDownloader.playlist_entries(self.info))
+        return delay
+    
+    def test_expansion_dedupes_and_bounds_concurrency(self):
+        """Test a playlist becomes deduplicated children, queued two at a time"""
+        from music.models import DownloadTask
+        
+        artist = Artist.objects.create(name='Band')
+        track = MusicFile.objects.create(title='Track 1', artist=artist, file='tracks/t1.mp3', format='mp3')
+        DownloadTask.objects.create(
+            user=self.user, url='https://artist.bandcamp.com/track/t1',
+            media_id='Bandcamp:t1', status='completed', result_track=track
+        )
+        
+        delay = self.expand()
+        
+        children = self.batch.children.order_by('created_at')
+        self.assertEqual(
+            [c.media_id for c in children],
+            ['Bandcamp:t1', 'Bandcamp:t2', 'Bandcamp:t3', 'Bandcamp:t4']
+        )
+        self.assertEqual(children[0].status, 'completed')
+        self.assertEqual(children[0].result_track, track)
+        self.assertEqual(delay.call_count, 2)
+        self.assertEqual(
+            sorted(DownloadTask.objects.filter(parent=self.batch).values_list('status', flat=True)),
+            ['completed', 'pending', 'queued', 'queued']
+        )
+        self.batch.refresh_from_db()
+        self.assertEqual((self.batch.item_count, self.batch.progress), (4, 25))
+    
+    def test_finished_children_free_slots_and_complete_the_batch(self):
+        """Test each finished child queues the next and updates the parent"""
+        from music.tasks import advance_download_batch
+        
+        self.expand()
+        for child in self.batch.children.filter(status='queued'):
+            child.mark_failed('gone')
+        with mock.patch('music.tasks.process_download_task.apply_async') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            advance_download_batch(self.batch.id)
+        self.assertEqual(delay.call_count, 2)
+        
+        self.batch.refresh_from_db()
+        self.assertEqual(self.batch.status, 'downloading')
+        self.assertEqual(self.batch.progress, 50)
+        
+        track = MusicFile.objects.create(title='T', artist=Artist.objects.create(name='Band'),
+                                         file='tracks/t.mp3', format='mp3')
+        for child in self.batch.children.filter(status='queued'):
+            child.mark_completed(track)
+        advance_download_batch(self.batch.id)
+        
+        self.batch.refresh_from_db()
+        self.assertEqual((self.batch.status, self.batch.progress), ('completed', 100))
+        self.assertEqual(self.batch.current_step, '2/4 imported, 2 failed')
+
+
+class SourceSchedulerTests(TestCase):
+    """Unit tests for per-source download rate limits"""
+    
+    def setUp(self):
+        from music.models import SystemSettings
+        from music.utils.scheduler import SourceScheduler, _LocalBackend
+        
+        system = SystemSettings.load()
+        system.download_rate_per_minute = 60
+        system.download_burst = 2
+        system.download_max_concurrent = 0
+        system.download_source_limits = {'youtube': {'max_concurrent': 1, 'rate_per_minute': 0}}
+        system.save()
+        self.scheduler = SourceScheduler(backend=_LocalBackend())
+    
+    def test_token_bucket_allows_burst_then_defers(self):
+        """Test a source starts a burst of jobs, then has to wait for tokens"""
+        with mock.patch('music.utils.scheduler.time.time', return_value=1000.0):
+            self.assertEqual(self.scheduler.acquire('bandcamp', 'a'), 0)
+            self.assertEqual(self.scheduler.acquire('bandcamp', 'b'), 0)
+            self.assertAlmostEqual(self.scheduler.acquire('bandcamp', 'c'), 1.0)
+            # Other sources have their own bucket
+            self.assertEqual(self.scheduler.acquire('soundcloud', 'd'), 0)
+        with mock.patch('music.utils.scheduler.time.time', return_value=1001.0):
+            self.assertEqual(self.scheduler.acquire('bandcamp', 'c'), 0)
+    
+    def test_concurrency_slots_are_released(self):
+        """Test per-source overrides cap running jobs until one is released"""
+        self.assertEqual(self.scheduler.acquire('youtube', 'a'), 0)
+        self.assertGreater(self.scheduler.acquire('youtube', 'b'), 0)
+        # Re-admitting a job that holds a slot keeps it
+        self.assertEqual(self.scheduler.acquire('youtube', 'a'), 0)
+        
+        self.scheduler.release('youtube', 'a')
+        self.assertEqual(self.scheduler.acquire('youtube', 'b'), 0)
+    
+    def test_over_budget_download_is_deferred_not_failed(self):
+        """Test process_download_task retries later without using a failure retry"""
+        from celery.exceptions import Retry
+        from music.models import DownloadTask
+        from music.tasks import process_download_task
+        
+        user = User.objects.create_user(username='scheduled', password='testpass123')
+        task = DownloadTask.objects.create(user=user, url='https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+        self.scheduler.acquire('youtube', 'other-job')
+        
+        with mock.patch('music.tasks.get_scheduler', return_value=self.scheduler), \
+                mock.patch.object(process_download_task, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                process_download_task(str(task.id))
+        
+        self.assertIsNone(retry.call_args.kwargs['max_retries'])
+        self.assertGreaterEqual(retry.call_args.kwargs['countdown'], 15)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.retry_count), ('pending', 0))
+
+
+    def test_breaker_pauses_a_failing_source(self):
+        """Test repeated failures stop a source for the cooldown, then probation re-trips it"""
+        from music.utils.scheduler import BREAKER_COOLDOWN, BREAKER_THRESHOLD
+        
+        with mock.patch('music.utils.scheduler.time.time', return_value=1000.0):
+            for _ in range(BREAKER_THRESHOLD):
+                self.scheduler.record_failure('bandcamp')
+            self.assertAlmostEqual(self.scheduler.acquire('bandcamp', 'a'), BREAKER_COOLDOWN)
+            self.assertEqual(self.scheduler.acquire('soundcloud', 'b'), 0)
+        
+        with mock.patch('music.utils.scheduler.time.time', return_value=1000.0 + BREAKER_COOLDOWN):
+            self.assertEqual(self.scheduler.acquire('bandcamp', 'a'), 0)
+            # One failure while on probation opens it again
+            self.scheduler.record_failure('bandcamp')
+            self.assertAlmostEqual(self.scheduler.acquire('bandcamp', 'c'), BREAKER_COOLDOWN)
+        
+        with mock.patch('music.utils.scheduler.time.time', return_value=1000.0 + 2 * BREAKER_COOLDOWN):
+            self.scheduler.record_success('bandcamp')
+            self.scheduler.record_failure('bandcamp')
+            self.assertEqual(self.scheduler.acquire('bandcamp', 'c'), 0)
+
+
+class ImportReuseTests(TestCase):
+    """Unit tests for reusing earlier imports of the same media"""
+    
+    URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    
+    def setUp(self):
+        from music.models import DownloadTask
+        self.user = User.objects.create_user(username='reuser', password='testpass123')
+        self.client = Client()
+        self.client.login(username='reuser', password='testpass123')
+        artist = Artist.objects.create(name='Singer')
+        self.track = MusicFile.objects.create(title='Song', artist=artist, file='tracks/song.mp3', format='mp3')
+        DownloadTask.objects.create(
+            user=User.objects.create_user(username='first', password='testpass123'),
+            url='https://youtu.be/dQw4w9WgXcQ', media_id='Youtube:dQw4w9WgXcQ',
+            output_format='mp3', output_quality='320k',
+            status='completed', result_track=self.track
+        )
+    
+    def import_url(self, quality):
+        with mock.patch('music.tasks.process_download_task.apply_async') as delay:
+            self.client.post(reverse('music:url_import'), {
+                'url': self.URL, 'output_format': 'mp3', 'output_quality': quality,
+            })
+        return self.user.download_tasks.get(), delay
+    
+    def test_repeat_import_completes_instantly(self):
+        """Test an import of known media with the same settings is not queued"""
+        task, delay = self.import_url('320k')
+        
+        self.assertEqual((task.status, task.result_track), ('completed', self.track))
+        self.assertEqual((task.source_type, task.media_id), ('youtube', 'Youtube:dQw4w9WgXcQ'))
+        delay.assert_not_called()
+    
+    def test_other_quality_is_downloaded(self):
+        """Test a different output quality still downloads"""
+        task, delay = self.import_url('128k')
+        
+        self.assertEqual(task.status, 'pending')
+        delay.assert_called_once_with(args=[str(task.id)], task_id=f'download-{task.id}-probe')
+    
+    def test_worker_reuses_track_without_network(self):
+        """Test process_download_task finishes a repeat import without yt-dlp"""
+        from music.models import DownloadTask
+        from music.tasks import process_download_task
+        
+        task = DownloadTask.objects.create(user=self.user, url=self.URL)
+        with mock.patch('music.utils.downloader.yt_dlp.YoutubeDL', side_effect=AssertionError('network')):
+            result = process_download_task(str(task.id))
+        
+        self.assertEqual(result['track_id'], str(self.track.id))
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.current_step), ('completed', 'Already in library'))
+
+
+class DownloadPipelineTests(TestCase):
+    """Unit tests for the staged probe -> fetch -> transcode -> ingest pipeline"""
+    
+    URL = 'https://soundcloud.com/singer/song'
+    
+    def setUp(self):
+        from music.models import DownloadTask
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        user = User.objects.create_user(username='piper', password='testpass123')
+        self.task = DownloadTask.objects.create(user=user, url=self.URL)
+        self.fetches = 0
+        self.during_fetch = None
+        test = self
+        
+        class FakeYoutubeDL:
+            def __init__(self, params):
+                self.params = params
+            
+            def __enter__(self):
+                return self
+            
+            def __exit__(self, *exc):
+                return False
+            
+            def sanitize_info(self, info):
+                return info
+            
+            def extract_info(self, url, download=True):
+                return {'id': 'song', 'extractor_key': 'Soundcloud', 'title': 'Song',
+                        'uploader': 'Singer', 'duration': 200}
+            
+            def process_ie_result(self, info, download=True):
+                test.fetches += 1
+                target = self.params['outtmpl'].replace('%(id)s.%(ext)s', 'song.opus')
+                with open(target + '.part', 'wb') as f:
+                    f.write(b'OggS fetched')
+                if test.during_fetch:
+                    test.during_fetch()
+                for hook in self.params['progress_hooks']:
+                    hook({'status': 'downloading', '_percent_str': '50.0%'})
+                os.replace(target + '.part', target)
+                return info
+        
+        patcher = mock.patch('music.utils.downloader.yt_dlp.YoutubeDL', FakeYoutubeDL)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Fresh slots and circuit breakers for every test
+        from music.utils.scheduler import SourceScheduler, _LocalBackend
+        patcher = mock.patch('music.tasks.get_scheduler', return_value=SourceScheduler(backend=_LocalBackend()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def run_stage(self, stage_task):
+        """Run one stage inline; returns the stage name it handed over to"""
+        from music import tasks
+        queued = {name: mock.Mock() for name in tasks.DOWNLOAD_STAGES}
+        with mock.patch.object(tasks, 'STAGE_TASKS', queued):
+            result = stage_task(str(self.task.id))
+        self.task.refresh_from_db()
+        return result
+    
+    @staticmethod
+    def fake_ffmpeg(command, **kwargs):
+        with open(command[-1], 'wb') as f:
+            f.write(make_wav_bytes())
+        return mock.Mock(returncode=0, communicate=mock.Mock(return_value=(b'', b'')))
+    
+    def test_stages_hand_over_until_the_track_exists(self):
+        """Test each stage records its output and queues the next stage"""
+        from music.tasks import (
+            fetch_download, ingest_download, process_download_task, transcode_download
+        )
+        
+        self.assertEqual(self.run_stage(process_download_task)['stage'], 'fetch')
+        self.assertEqual(self.run_stage(fetch_download)['stage'], 'transcode')
+        self.assertEqual(self.task.staged_file, f'downloads/temp/{self.task.id}/song.opus')
+        
+        with mock.patch('music.utils.downloader.subprocess.Popen', side_effect=self.fake_ffmpeg) as ffmpeg:
+            self.assertEqual(self.run_stage(transcode_download)['stage'], 'ingest')
+        self.assertIn('libmp3lame', ffmpeg.call_args.args[0])
+        self.assertIn('title=Song', ffmpeg.call_args.args[0])
+        self.assertEqual(self.task.staged_file, f'downloads/temp/{self.task.id}/song.320.mp3')
+        
+        staged_inode = os.stat(os.path.join(self.media_root, self.task.staged_file)).st_ino
+        result = self.run_stage(ingest_download)
+        self.assertEqual(result['status'], 'completed')
+        self.assertEqual(self.task.status, 'completed')
+        self.assertEqual(self.task.result_track.artist.name, 'Singer')
+        
+        # The transcoded file was renamed into storage, not copied
+        track = self.task.result_track
+        self.assertEqual(os.stat(track.file.path).st_ino, staged_inode)
+        self.assertEqual(track.file.name, f'tracks/{track.content_hash[:2]}/{track.content_hash}.mp3')
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'downloads', 'temp')), [])
+    
+    def test_move_into_storage_copies_only_across_devices(self):
+        """Test a cross-device rename falls back to copy-then-rename"""
+        import errno
+        from music.utils.uploads import move_into_storage
+        
+        source = os.path.join(self.media_root, 'song.mp3')
+        with open(source, 'wb') as f:
+            f.write(b'ID3 bytes')
+        real_replace = os.replace
+        calls = []
+        
+        def replace(src, dst):
+            calls.append(str(src))
+            if len(calls) == 1:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            return real_replace(src, dst)
+        
+        with mock.patch('music.utils.uploads.os.replace', side_effect=replace):
+            move_into_storage(source, 'tracks/ab/abc.mp3')
+        
+        self.assertTrue(calls[1].endswith('abc.mp3.part'))
+        self.assertFalse(os.path.exists(source))
+        with open(os.path.join(self.media_root, 'tracks', 'ab', 'abc.mp3'), 'rb') as f:
+            self.assertEqual(f.read(), b'ID3 bytes')
+    
+    def test_failed_stage_retries_without_refetching(self):
+        """Test a transcode failure keeps the fetched file and retries only transcode"""
+        from celery.exceptions import Retry
+        from music import tasks
+        from music.tasks import fetch_download, process_download_task, resume_download, transcode_download
+        
+        self.run_stage(process_download_task)
+        self.run_stage(fetch_download)
+        
+        ffmpeg = mock.Mock(returncode=1, communicate=mock.Mock(return_value=(b'', b'bad input')))
+        with mock.patch('music.utils.downloader.subprocess.Popen', return_value=ffmpeg), \
+                mock.patch.object(transcode_download, 'retry', side_effect=Retry()) as retry, \
+                mock.patch.object(tasks.get_scheduler(), 'record_failure') as record_failure:
+            with self.assertRaises(Retry):
+                self.run_stage(transcode_download)
+        # A local ffmpeg failure does not count against the source's breaker
+        record_failure.assert_not_called()
+        # Deferrals count in request.retries too: failures are bounded by retry_count
+        self.assertIsNone(retry.call_args.kwargs['max_retries'])
+        
+        self.task.refresh_from_db()
+        self.assertEqual((self.task.stage, self.task.retry_count), ('transcode', 1))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, self.task.staged_file)))
+        
+        with mock.patch.object(transcode_download, 'apply_async') as delay:
+            resume_download(self.task)
+        delay.assert_called_once_with(
+            args=[str(self.task.id)], task_id=f'download-{self.task.id}-transcode'
+        )
+        self.assertEqual(self.fetches, 1)
+    
+    def test_fetch_waits_for_scratch_quota(self):
+        """Test a fetch is deferred while scratch is over quota, then runs in its own directory"""
+        from celery.exceptions import Retry
+        from music.tasks import fetch_download, process_download_task
+        from music.utils.scratch import job_dir
+        
+        self.run_stage(process_download_task)
+        (job_dir('other-job') / 'big.opus').write_bytes(b'x' * 1024)
+        with mock.patch('music.utils.scratch.SCRATCH_QUOTA', 1024), \
+                mock.patch.object(fetch_download, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                self.run_stage(fetch_download)
+        self.assertIsNone(retry.call_args.kwargs['max_retries'])
+        self.assertEqual((self.fetches, self.task.retry_count), (0, 0))
+        
+        with mock.patch('music.utils.scratch.SCRATCH_QUOTA', 4096):
+            self.assertEqual(self.run_stage(fetch_download)['stage'], 'transcode')
+        self.assertTrue(self.task.staged_file.startswith(f'downloads/temp/{self.task.id}/'))
+    
+    def test_permanent_failure_is_not_retried(self):
+        """Test removed media fails for good while network errors stay retryable"""
+        import subprocess
+        import yt_dlp
+        from music.tasks import fetch_download, process_download_task, retry_failed_downloads
+        from music.utils.downloader import is_permanent_error
+        
+        self.assertTrue(is_permanent_error(yt_dlp.utils.DownloadError('ERROR: [youtube] abc: Private video')))
+        self.assertTrue(is_permanent_error(yt_dlp.utils.DownloadError('ERROR: HTTP Error 404: Not Found')))
+        self.assertFalse(is_permanent_error(yt_dlp.utils.DownloadError('ERROR: HTTP Error 429: Too Many Requests')))
+        self.assertFalse(is_permanent_error(subprocess.CalledProcessError(1, 'ffmpeg')))
+        
+        removed = yt_dlp.utils.DownloadError('ERROR: [soundcloud] song: This video has been removed')
+        self.run_stage(process_download_task)
+        with mock.patch('music.utils.downloader.MediaDownloader.fetch_audio', side_effect=removed), \
+                mock.patch.object(fetch_download, 'retry') as retry:
+            result = self.run_stage(fetch_download)
+        
+        retry.assert_not_called()
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual((self.task.status, self.task.error_kind, self.task.retry_count), ('failed', 'permanent', 0))
+        self.assertEqual(retry_failed_downloads(), {'retried': 0})
+    
+    def test_cancel_interrupts_fetch_and_removes_partial_file(self):
+        """Test the progress hook stops a cancelled fetch and nothing is queued after it"""
+        from music.tasks import fetch_download, process_download_task
+        
+        self.run_stage(process_download_task)
+        self.during_fetch = self.task.cancel
+        with mock.patch('music.utils.downloader.CANCEL_CHECK_INTERVAL', 0):
+            result = self.run_stage(fetch_download)
+        
+        self.assertEqual(result, {'status': 'cancelled'})
+        self.assertEqual((self.task.status, self.task.stage), ('cancelled', 'fetch'))
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'downloads', 'temp')), [])
+        
+        # Later messages for the task are no-ops
+        self.assertEqual(self.run_stage(fetch_download), {'status': 'cancelled'})
+        self.assertEqual(self.fetches, 1)
+    
+    def test_requeued_fetch_runs_as_downloading_again(self):
+        """Test a task requeued as pending is visible to the reaper again once its fetch resumes"""
+        from music.models import DownloadTask
+        from music.tasks import fetch_download, process_download_task
+        
+        self.run_stage(process_download_task)
+        started_at = self.task.started_at
+        DownloadTask.objects.filter(id=self.task.id).update(status='pending')
+        statuses = []
+        self.during_fetch = lambda: statuses.append(DownloadTask.objects.get(id=self.task.id).status)
+        self.run_stage(fetch_download)
+        
+        self.assertEqual(statuses, ['downloading'])
+        self.assertEqual(self.task.started_at, started_at)
+    
+    def test_running_stage_beats_until_it_returns(self):
+        """Test a stage has a heartbeat while it runs and none once it handed over"""
+        from music.tasks import fetch_download, process_download_task
+        from music.utils.heartbeat import last_heartbeats
+        
+        beats = []
+        self.during_fetch = lambda: beats.append(last_heartbeats([self.task.id]))
+        self.run_stage(process_download_task)
+        self.run_stage(fetch_download)
+        
+        self.assertIn(str(self.task.id), beats[0])
+        self.assertEqual(last_heartbeats([self.task.id]), {})
+    
+    def test_cancel_terminates_ffmpeg(self):
+        """Test a cancelled transcode kills ffmpeg and drops its input and output"""
+        import subprocess
+        from music.tasks import fetch_download, process_download_task, transcode_download
+        
+        self.run_stage(process_download_task)
+        self.run_stage(fetch_download)
+        
+        ffmpeg = mock.Mock(returncode=None)
+        ffmpeg.communicate.side_effect = [subprocess.TimeoutExpired('ffmpeg', 2), (b'', b'')]
+        
+        def cancel_while_running(command, **kwargs):
+            self.task.cancel()
+            return ffmpeg
+        
+        with mock.patch('music.utils.downloader.subprocess.Popen', side_effect=cancel_while_running):
+            result = self.run_stage(transcode_download)
+        
+        self.assertEqual(result['status'], 'cancelled')
+        ffmpeg.terminate.assert_called_once()
+        self.assertEqual((self.task.status, self.task.staged_file), ('cancelled', ''))
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'downloads', 'temp')), [])
+    
+    def test_cancel_api_revokes_queued_stages_of_a_batch(self):
+        """Test cancelling a playlist import cancels its unfinished items and revokes them"""
+        from music.models import DownloadTask
+        from music.tasks import advance_download_batch
+        
+        self.client.login(username='piper', password='testpass123')
+        batch, user = self.task, self.task.user
+        finished = DownloadTask.objects.create(user=user, parent=batch, url=self.URL, status='completed')
+        waiting = DownloadTask.objects.create(user=user, parent=batch, url=self.URL)
+        running = DownloadTask.objects.create(user=user, parent=batch, url=self.URL, status='downloading')
+        DownloadTask.objects.filter(id=batch.id).update(status='downloading', item_count=3)
+        
+        with mock.patch('music.tasks.current_app.control.revoke') as revoke:
+            response = self.client.post(reverse('music:download_cancel', args=[batch.id]))
+        
+        self.assertEqual(response.json()['cancelled'], 3)
+        revoked = revoke.call_args.args[0]
+        self.assertIn(f'download-{waiting.id}-probe', revoked)
+        self.assertIn(f'download-{running.id}-transcode', revoked)
+        self.assertNotIn(f'download-{finished.id}-probe', revoked)
+        self.assertEqual(
+            dict(DownloadTask.objects.filter(parent=batch).values_list('id', 'status')),
+            {finished.id: 'completed', waiting.id: 'cancelled', running.id: 'cancelled'}
+        )
+        
+        # Nothing left to queue, and the batch stays cancelled
+        with mock.patch('music.tasks.process_download_task.apply_async') as delay:
+            advance_download_batch(batch.id)
+        delay.assert_not_called()
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, 'cancelled')
+        
+        response = self.client.post(reverse('music:download_cancel', args=[batch.id]))
+        self.assertEqual(response.status_code, 409)
+
+
+class DownloadBenchmarkTests(TestCase):
+    """Unit tests for the offline pipeline benchmark"""
+    
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def test_eager_run_reports_every_stage_and_cleans_up(self):
+        """Test the benchmark imports through all stages with the fake backend"""
+        from io import StringIO
+        from django.core.management import call_command
+        from music.models import DownloadTask, SystemSettings
+        
+        out = StringIO()
+        with override_settings(FAKE_TRANSCODE_SECONDS=0):
+            call_command('benchmark_downloads', items=3, concurrency=1, latency=0,
+                         throughput=1000, duration=1, stdout=out)
+        
+        output = out.getvalue()
+        self.assertIn('готово: 3', output)
+        for stage in ('probe', 'fetch', 'transcode', 'ingest'):
+            self.assertRegex(output, rf'{stage}\s+3\s')
+        self.assertFalse(DownloadTask.objects.exists())
+        self.assertFalse(MusicFile.objects.exists())
+        self.assertEqual(SystemSettings.load().download_source_limits, {})
+    
+    def test_broker_run_uses_its_own_queues_and_worker(self):
+        """Test broker mode never publishes to the shared stage queues or trusts other workers"""
+        from io import StringIO
+        from celery import current_app
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from music.tasks import process_download_task
+        
+        with mock.patch('music.management.commands.benchmark_downloads.subprocess.Popen') as popen, \
+                mock.patch.object(current_app.control, 'ping', return_value=[{'worker': 'pong'}]) as ping, \
+                mock.patch.object(process_download_task, 'apply_async') as publish:
+            popen.return_value.poll.return_value = None
+            # Nothing consumes the jobs here: the run times out right away
+            with self.assertRaises(CommandError):
+                call_command('benchmark_downloads', items=2, mode='broker', timeout=0, stdout=StringIO())
+        
+        command = popen.call_args.args[0]
+        queues = command[command.index('-Q') + 1].split(',')
+        prefix = popen.call_args.kwargs['env']['DOWNLOAD_QUEUE_PREFIX']
+        self.assertEqual(queues, [f'{prefix}{queue}' for queue in ('extract', 'fetch', 'transcode', 'ingest')])
+        self.assertEqual(ping.call_args.kwargs['destination'], [command[command.index('-n') + 1]])
+        self.assertEqual({call.kwargs['queue'] for call in publish.call_args_list}, {f'{prefix}extract'})
+        self.assertEqual(publish.call_count, 2)
+
+
+class AsyncFetchWorkerTests(TransactionTestCase):
+    """Unit tests for the asyncio fetch-stage worker"""
+    
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            DOWNLOADER_BACKEND='music.utils.benchmark.FakeMediaDownloader',
+            FAKE_DOWNLOAD_LATENCY=0, FAKE_DOWNLOAD_THROUGHPUT=1000, FAKE_DOWNLOAD_DURATION=1,
+        )
+        self.override.enable()
+        self.user = User.objects.create_user(username='async', password='testpass123')
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def test_burst_run_fetches_every_queued_message(self):
+        """Test queued and delayed fetch messages all run and hand over to transcode"""
+        import asyncio
+        from celery import current_app
+        from kombu import Connection
+        from music import tasks
+        from music.models import DownloadTask
+        from music.utils.async_fetch import AsyncFetchWorker
+        
+        downloads = [
+            DownloadTask.objects.create(user=self.user, url=f'https://benchmark.invalid/async/{n}',
+                                        stage='fetch', status='downloading')
+            for n in range(4)
+        ]
+        with Connection('memory://') as connection:
+            for n, task in enumerate(downloads):
+                tasks.fetch_download.apply_async(
+                    args=[str(task.id)], task_id=tasks.stage_task_id(task.id, 'fetch'),
+                    countdown=0.3 if n == 0 else None, ignore_result=True, connection=connection,
+                )
+        
+        queued = {name: mock.Mock() for name in tasks.DOWNLOAD_STAGES}
+        worker = AsyncFetchWorker(concurrency=4, per_source=2, backlog=0)
+        broker_url = current_app.conf.broker_read_url
+        current_app.conf.broker_read_url = 'memory://'
+        try:
+            with mock.patch.object(tasks, 'STAGE_TASKS', queued):
+                asyncio.run(worker.run(burst=True))
+        finally:
+            current_app.conf.broker_read_url = broker_url
+        
+        self.assertEqual(worker.processed, 4)
+        self.assertEqual(queued['transcode'].apply_async.call_count, 4)
+        for task in downloads:
+            task.refresh_from_db()
+            self.assertTrue(task.staged_file.startswith(f'downloads/temp/{task.id}/'))
+
+
+class StaleDownloadReaperTests(TestCase):
+    """Unit tests for recovering downloads whose worker died"""
+    
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        self.user = User.objects.create_user(username='reaper', password='testpass123')
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def make_task(self, status, beat_age=None, **fields):
+        import time
+        from music.models import DownloadTask
+        from music.utils.heartbeat import heartbeat_key
+        
+        task = DownloadTask.objects.create(
+            user=self.user, url='https://soundcloud.com/singer/song', status=status, **fields
+        )
+        if beat_age is not None:
+            cache.set(heartbeat_key(task.id), time.time() - beat_age)
+        return task
+    
+    def temp_file(self, name, age):
+        import time
+        path = os.path.join(self.media_root, 'downloads', 'temp', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'audio')
+        os.utime(path, (time.time() - age, time.time() - age))
+        os.utime(os.path.dirname(path), (time.time() - age, time.time() - age))
+        return path
+    
+    def test_stale_tasks_are_requeued_or_failed(self):
+        """Test dead workers' tasks are requeued at their stage, or failed after 3 attempts"""
+        from datetime import timedelta
+        from django.utils import timezone
+        from music.tasks import LOST_AFTER, fetch_download, reap_stale_downloads
+        
+        lost = self.make_task('downloading', beat_age=600, stage='fetch')
+        exhausted = self.make_task('processing', beat_age=600, retry_count=3)
+        alive = self.make_task('downloading', beat_age=5)
+        between_stages = self.make_task('processing')
+        never_beat = self.make_task(
+            'downloading', stage='fetch', started_at=timezone.now() - timedelta(seconds=LOST_AFTER + 60)
+        )
+        done = self.make_task('completed')
+        
+        kept = self.temp_file(f'{lost.id}/lost.opus', age=7 * 60 * 60)
+        lost.staged_file = f'downloads/temp/{lost.id}/lost.opus'
+        lost.save()
+        dead = self.temp_file(f'{exhausted.id}/dead.opus', age=60)
+        leftover = self.temp_file(f'{done.id}/gone.webm.part', age=7 * 60 * 60)
+        legacy = self.temp_file('gone.webm.part', age=7 * 60 * 60)
+        fresh = self.temp_file(f'{alive.id}/busy.webm.part', age=60)
+        
+        with mock.patch.object(fetch_download, 'apply_async') as delay:
+            result = reap_stale_downloads()
+        
+        self.assertEqual(result, {'reaped': 3, 'requeued': 2, 'orphaned': 2})
+        self.assertEqual(
+            sorted(call.kwargs['task_id'] for call in delay.call_args_list),
+            sorted(f'download-{task.id}-fetch' for task in (lost, never_beat))
+        )
+        for task in (lost, exhausted, alive, between_stages, never_beat):
+            task.refresh_from_db()
+        self.assertEqual((lost.status, lost.retry_count), ('pending', 1))
+        self.assertEqual((never_beat.status, never_beat.retry_count), ('pending', 1))
+        self.assertEqual((exhausted.status, exhausted.error_message), ('failed', 'Worker stopped responding'))
+        self.assertIsNotNone(exhausted.completed_at)
+        self.assertEqual((alive.status, between_stages.status), ('downloading', 'processing'))
+        
+        self.assertTrue(os.path.exists(kept))
+        self.assertTrue(os.path.exists(fresh))
+        # A task failed for good drops its directory at once; the rest once stale
+        for path in (dead, leftover, legacy):
+            self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(os.path.dirname(leftover)))
@@ -10,9 +10,19 @@ urlpatterns = [
     path('download/<uuid:pk>/', views.download_music, name='download'),
     path('upload/', views.upload_page, name='upload_page'),
     path('api/upload/', views.upload_music, name='upload_music'),
+    path('api/upload/batch/', views.upload_batch, name='upload_batch'),
     path('api/search/', views.api_search, name='api_search'),
     
+    # Resumable chunked uploads
+    path('api/uploads/sessions/', views.upload_session_create, name='upload_session_create'),
+    path('api/uploads/sessions/<uuid:pk>/', views.upload_session_status, name='upload_session_status'),
+    path('api/uploads/sessions/<uuid:pk>/complete/', views.upload_session_finalize, name='upload_session_finalize'),
+    path('api/uploads/<uuid:pk>/chunk/', views.upload_chunk, name='upload_chunk'),
+    path('api/uploads/<uuid:pk>/complete/', views.upload_finalize, name='upload_finalize'),
+    
     # Download manager
     path('import/', views.url_import, name='url_import'),
     path('downloads/', views.download_manager, name='download_manager'),
+    path('api/downloads/progress/', views.download_progress, name='download_progress'),
+    path('api/downloads/<uuid:pk>/cancel/', views.download_cancel, name='download_cancel'),
 ]
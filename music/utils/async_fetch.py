@@ -0,0 +1,209 @@
+"""Asyncio worker for the fetch stage of the download pipeline
+
+A Celery prefork child fetches one stream at a time and spends nearly all of
+it waiting on the network. ``AsyncFetchWorker`` consumes the same ``fetch``
+queue from a single event loop instead and keeps up to ``concurrency``
+fetches in flight, each running the regular ``fetch_download`` stage in a
+shared thread pool (yt-dlp is blocking), so one process with one Django
+connection per busy thread replaces dozens of prefork children.
+
+- Per source, at most ``per_source`` fetches run at once (asyncio
+  semaphores), so one slow source cannot take every slot; the cross-worker
+  limits of ``SourceScheduler`` still apply on top.
+- Messages with an ETA (retries, over-budget deferrals) wait on the loop
+  without holding a fetch slot; at most HELD_FACTOR x ``concurrency`` messages
+  are taken off the queue at a time.
+- Backpressure: while ``transcode_backlog`` fetched files wait for transcode
+  and ingest, no new message is taken off the queue.
+
+Messages are acknowledged when their fetch starts, like Celery's default
+early ack; a worker dying mid-fetch is covered by ``reap_stale_downloads``.
+Retries go through ``Task.retry`` with the request rebuilt from the message,
+so they are published exactly as a Celery worker would.
+"""
+
+import asyncio
+import logging
+import socket
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+
+from celery import current_app
+from celery.exceptions import Retry
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+FETCH_QUEUE = f"{getattr(settings, 'DOWNLOAD_QUEUE_PREFIX', '')}fetch"
+FETCH_CONCURRENCY = getattr(settings, 'DOWNLOAD_ASYNC_FETCH_CONCURRENCY', 50)
+SOURCE_CONCURRENCY = getattr(settings, 'DOWNLOAD_ASYNC_SOURCE_CONCURRENCY', 16)
+TRANSCODE_BACKLOG = getattr(settings, 'DOWNLOAD_TRANSCODE_BACKLOG', 100)
+# Messages held (running or waiting for their ETA) per fetch slot
+HELD_FACTOR = 4
+# Seconds between backlog checks, and broker poll timeout
+POLL_INTERVAL = 1.0
+
+
+def task_source(task_id) -> str:
+    """Source of a download task ('url' when it no longer exists)"""
+    from ..models import DownloadTask
+    from .downloader import MediaDownloader
+
+    try:
+        url = DownloadTask.objects.filter(id=task_id).values_list('url', flat=True).first()
+    finally:
+        close_old_connections()
+    return MediaDownloader.detect_source(url or '')
+
+
+def transcode_backlog() -> int:
+    """Fetched files not yet ingested (waiting for transcode or ingest)"""
+    from ..models import DownloadTask
+
+    try:
+        return (
+            DownloadTask.objects.filter(status__in=DownloadTask.ACTIVE_STATUSES)
+            .exclude(staged_file='').count()
+        )
+    finally:
+        close_old_connections()
+
+
+def run_fetch(headers: dict, args: list, kwargs: dict, delivery_info: dict):
+    """Run fetch_download for one message, as a Celery worker would"""
+    from ..tasks import fetch_download
+
+    fetch_download.push_request(
+        id=headers['id'],
+        args=args,
+        kwargs=kwargs,
+        retries=headers.get('retries') or 0,
+        delivery_info=delivery_info,
+        hostname=socket.gethostname(),
+        called_directly=False,
+        is_eager=False,
+    )
+    try:
+        return fetch_download.run(*args, **kwargs)
+    except Retry:
+        # Already published again with its countdown
+        return None
+    finally:
+        fetch_download.pop_request()
+        close_old_connections()
+
+
+class AsyncFetchWorker:
+    """Consumes the fetch queue with many concurrent fetches per process"""
+
+    def __init__(self, concurrency: int = None, per_source: int = None,
+                 backlog: int = None, app=None):
+        self.app = app or current_app
+        self.concurrency = concurrency or FETCH_CONCURRENCY
+        self.per_source = min(self.concurrency, per_source or SOURCE_CONCURRENCY)
+        self.backlog = TRANSCODE_BACKLOG if backlog is None else backlog
+        self.processed = 0
+
+    async def run(self, stop: asyncio.Event = None, burst: bool = False):
+        """
+        Consume until ``stop`` is set (or, with ``burst``, the queue is empty),
+        then wait for running fetches.
+        """
+        self.stop = stop or asyncio.Event()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.held = asyncio.Semaphore(self.concurrency * HELD_FACTOR)
+        self.sources = defaultdict(lambda: asyncio.Semaphore(self.per_source))
+        self.pool = ThreadPoolExecutor(self.concurrency, thread_name_prefix='fetch')
+        # Kombu channels are not thread-safe: every broker call goes through one thread
+        self.broker = ThreadPoolExecutor(1, thread_name_prefix='fetch-broker')
+        jobs = set()
+
+        connection = await self._broker_call(self.app.connection_for_read)
+        queue = await self._broker_call(connection.SimpleQueue, self.app.amqp.queues[FETCH_QUEUE])
+        logger.info(f"Async fetch worker started: {self.concurrency} slots, {self.per_source} per source")
+        try:
+            while not self.stop.is_set():
+                await self.held.acquire()
+                if not await self._wait_for_backlog():
+                    self.held.release()
+                    break
+                message = await self._broker_call(self._get, queue)
+                if message is None:
+                    self.held.release()
+                    if burst and not jobs:
+                        break
+                    continue
+                job = asyncio.create_task(self._handle(message))
+                jobs.add(job)
+                job.add_done_callback(jobs.discard)
+            if jobs:
+                logger.info(f"Async fetch worker stopping: waiting for {len(jobs)} fetches")
+                await asyncio.gather(*jobs, return_exceptions=True)
+        finally:
+            await self._broker_call(queue.close)
+            await self._broker_call(connection.release)
+            self.pool.shutdown(wait=True)
+            self.broker.shutdown(wait=True)
+
+    async def _broker_call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.broker, func, *args)
+
+    async def _pool_call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    @staticmethod
+    def _get(queue):
+        try:
+            return queue.get(block=True, timeout=POLL_INTERVAL)
+        except queue.Empty:
+            return None
+
+    async def _sleep(self, seconds: float) -> bool:
+        """Sleep unless stopped first; True when the worker is stopping"""
+        try:
+            await asyncio.wait_for(self.stop.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _wait_for_backlog(self) -> bool:
+        """Hold off while transcode lags behind; False when stopping"""
+        while self.backlog and await self._pool_call(transcode_backlog) >= self.backlog:
+            if await self._sleep(POLL_INTERVAL):
+                return False
+        return not self.stop.is_set()
+
+    async def _handle(self, message):
+        held = True
+        try:
+            headers = message.headers or {}
+            if headers.get('task') != 'music.tasks.fetch_download':
+                logger.error(f"Async fetch worker dropped unexpected task {headers.get('task')}")
+                await self._broker_call(message.reject)
+                return
+
+            args, kwargs = message.payload[0], message.payload[1]
+            if headers.get('eta'):
+                delay = (datetime.fromisoformat(headers['eta']) - datetime.now(dt_timezone.utc)).total_seconds()
+                if delay > 0 and await self._sleep(delay):
+                    # Hand it back for the next worker
+                    await self._broker_call(message.requeue)
+                    return
+
+            source = await self._pool_call(task_source, args[0])
+            async with self.sources[source], self.slots:
+                await self._broker_call(message.ack)
+                self.held.release()
+                held = False
+                await self._pool_call(run_fetch, headers, args, kwargs, message.delivery_info)
+            self.processed += 1
+        except Exception as e:
+            logger.error(f"Async fetch of {message.headers.get('id')} failed: {e}", exc_info=True)
+            if held:
+                # Not started: leave it for another attempt
+                await self._broker_call(message.requeue)
+        finally:
+            if held:
+                self.held.release()
@@ -0,0 +1,164 @@
+"""Offline download backend and stage instrumentation for pipeline benchmarks
+
+``FakeMediaDownloader`` stands in for yt-dlp and ffmpeg (select it with
+``DOWNLOADER_BACKEND``): extraction sleeps for FAKE_DOWNLOAD_LATENCY, the
+"download" writes a generated WAV clip at FAKE_DOWNLOAD_THROUGHPUT MB/s
+through the regular progress hook, and transcoding re-tags the clip after
+FAKE_TRANSCODE_SECONDS. Every clip has unique bytes, so content-hash
+deduplication never short-circuits an import.
+
+Importing this module also hooks Celery's task_prerun/task_postrun signals:
+each download stage records its own wall time and the number of
+INSERT/UPDATE/DELETE statements it ran in the shared cache, where the
+``benchmark_downloads`` command collects them. Start broker-mode workers
+with ``-I music.utils.benchmark`` so the hooks are loaded there too.
+"""
+
+import hashlib
+import io
+import logging
+import random
+import threading
+import time
+import wave
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from .downloader import DownloadCancelled, MediaDownloader
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 22050
+CHUNK_SIZE = 256 * 1024
+STATS_TIMEOUT = 60 * 60 * 24
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def fake_clip(seed: str, seconds: int) -> bytes:
+    """Mono 16-bit WAV of noise, different for every seed"""
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(rng.randbytes(SAMPLE_RATE * 2 * seconds))
+    return buffer.getvalue()
+
+
+class FakeMediaDownloader(MediaDownloader):
+    """MediaDownloader that never touches the network or ffmpeg"""
+
+    @staticmethod
+    def _fake_id(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+
+    def extract_info(self, url: str) -> Optional[Dict]:
+        key = self._fake_id(url)
+        if key not in self._extracted:
+            time.sleep(settings.FAKE_DOWNLOAD_LATENCY)
+            self._extracted[key] = {
+                'id': key,
+                'extractor_key': 'Fake',
+                'title': f'Benchmark {key[:8]}',
+                'uploader': 'Benchmark Artist',
+                'duration': settings.FAKE_DOWNLOAD_DURATION,
+            }
+        return self._extracted[key]
+
+    def validate_url(self, url: str):
+        # Benchmark URLs belong to no supported source on purpose
+        return (True, "URL is valid") if self.extract_info(url) else (False, "Extraction failed")
+
+    def fetch_audio(self, url: str, progress_callback=None) -> Optional[Path]:
+        info = self.extract_info(url)
+        data = fake_clip(info['id'], settings.FAKE_DOWNLOAD_DURATION)
+        seconds_per_chunk = CHUNK_SIZE / (settings.FAKE_DOWNLOAD_THROUGHPUT * 1024 * 1024)
+        target = self.download_dir / f"{info['id']}.wav"
+        part_path = target.with_name(target.name + '.part')
+
+        with open(part_path, 'wb') as f:
+            for offset in range(0, len(data), CHUNK_SIZE):
+                time.sleep(seconds_per_chunk)
+                f.write(data[offset:offset + CHUNK_SIZE])
+                if progress_callback:
+                    percent = 100 * min(len(data), offset + CHUNK_SIZE) / len(data)
+                    progress_callback({'status': 'downloading', '_percent_str': f'{percent:.1f}%'})
+        part_path.replace(target)
+        return target
+
+    def transcode_audio(self, source: Path, output_format: str = 'mp3',
+                        quality: str = '320', tags: Optional[Dict] = None,
+                        is_cancelled=None) -> Path:
+        # The clip stays WAV whatever the extension; only the time is simulated
+        time.sleep(settings.FAKE_TRANSCODE_SECONDS)
+        if is_cancelled and is_cancelled():
+            raise DownloadCancelled()
+        target = source.with_name(f"{source.stem}.{quality}.{output_format}")
+        target.write_bytes(source.read_bytes())
+        return target
+
+
+# ============================================================================
+# Per-stage timings and DB writes
+# ============================================================================
+
+_local = threading.local()
+
+
+def _stats_key(task_id, stage: str) -> str:
+    return f'download_benchmark:{task_id}:{stage}'
+
+
+def _stage_names() -> Dict[str, str]:
+    from .. import tasks
+    return {task.name: stage for stage, task in tasks.STAGE_TASKS.items()}
+
+
+def _count_writes(execute, sql, params, many, context):
+    frames = getattr(_local, 'frames', None)
+    if frames and sql.lstrip()[:6].upper() in WRITE_STATEMENTS:
+        frames[-1]['writes'] += 1
+    return execute(sql, params, many, context)
+
+
+@task_prerun.connect
+def _stage_started(sender=None, task_id=None, task=None, args=None, **kwargs):
+    if task is None or task.name not in _stage_names():
+        return
+    if _count_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_writes)
+    frames = _local.__dict__.setdefault('frames', [])
+    frames.append({'started': time.perf_counter(), 'nested': 0.0, 'writes': 0})
+
+
+@task_postrun.connect
+def _stage_finished(sender=None, task_id=None, task=None, args=None, **kwargs):
+    stage = _stage_names().get(getattr(task, 'name', None))
+    frames = getattr(_local, 'frames', None)
+    if stage is None or not frames or not args:
+        return
+    frame = frames.pop()
+    elapsed = time.perf_counter() - frame['started']
+    # Eager mode runs the next stage inside this one: keep only own time
+    if frames:
+        frames[-1]['nested'] += elapsed
+    cache.set(_stats_key(args[0], stage), {
+        'seconds': elapsed - frame['nested'],
+        'writes': frame['writes'],
+    }, timeout=STATS_TIMEOUT)
+
+
+def stage_stats(task_ids: Iterable, stages: Iterable[str]) -> Dict[str, list]:
+    """Recorded {'seconds', 'writes'} samples per stage for the given tasks"""
+    stages = list(stages)
+    keys = {_stats_key(task_id, stage): stage for task_id in task_ids for stage in stages}
+    samples = {stage: [] for stage in stages}
+    for key, value in cache.get_many(keys).items():
+        samples[keys[key]].append(value)
+    return samples
@@ -0,0 +1,140 @@
+"""Set-based catalog writes for bulk ingestion
+
+Resolves every artist, album and genre referenced by a batch of files
+through the cached resolver (``utils.resolver``) and inserts the tracks with
+a single ``bulk_create``, instead of one ``get_or_create``/``create`` round
+trip per file.
+"""
+
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+
+from django.db import transaction
+
+from ..models import MusicFile
+from .resolver import resolve_album_ids, resolve_artist_ids, resolve_genre_ids
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN_ARTIST = 'Unknown Artist'
+
+
+def _year(value) -> Optional[int]:
+    value = str(value or '')[:4]
+    return int(value) if value.isdigit() else None
+
+
+def _track_row(fallback_title: str, probe: Dict, overrides: Dict) -> Dict:
+    """Catalog values for one file: explicit overrides win over tags"""
+    return {
+        'title': overrides.get('title') or probe.get('title') or fallback_title,
+        'artist': overrides.get('artist') or probe.get('artist') or UNKNOWN_ARTIST,
+        'album': overrides.get('album') or probe.get('album') or '',
+        'genre': overrides.get('genre') or probe.get('genre') or '',
+        'year': _year(overrides.get('year') or probe.get('year')),
+    }
+
+
+def _resolve_rows(rows: List[Dict]):
+    """Resolve the entities of many rows at once; yields (artist_id, album_id, genre_id)"""
+    artists = resolve_artist_ids(r['artist'] for r in rows)
+    genres = resolve_genre_ids(r['genre'] for r in rows)
+    albums = resolve_album_ids({
+        (r['album'], artists[r['artist']]): r['year']
+        for r in rows if r['album']
+    })
+    for row in rows:
+        artist_id = artists[row['artist']]
+        album_id = albums.get((row['album'], artist_id)) if row['album'] else None
+        yield artist_id, album_id, genres.get(row['genre'])
+
+
+def find_tracks_by_hash(hashes: Iterable[str]) -> Dict[str, MusicFile]:
+    """Map content hashes to the tracks already storing those bytes"""
+    hashes = {h for h in hashes if h}
+    if not hashes:
+        return {}
+    return {t.content_hash: t for t in MusicFile.objects.filter(content_hash__in=hashes)}
+
+
+def bulk_create_tracks(entries: List[Dict], defaults: Optional[Dict] = None,
+                       processing_status: str = 'ready') -> List[MusicFile]:
+    """
+    Create tracks for already-stored audio files.
+
+    Args:
+        entries: dicts with ``storage_name``, ``filename``, ``format`` and
+            optional ``content_hash`` and ``probe`` (a probe_audio() result)
+        defaults: optional title/artist/album/genre values that override tags
+        processing_status: 'processing' for placeholder rows that a Celery
+            task will enrich later
+
+    Returns:
+        list: MusicFile instances in entry order. Entries carrying the same
+        content hash share one bulk-created row.
+    """
+    defaults = defaults or {}
+    rows = [
+        _track_row(os.path.splitext(entry['filename'])[0], entry.get('probe') or {}, defaults)
+        for entry in entries
+    ]
+
+    with transaction.atomic():
+        tracks, created, by_hash = [], [], {}
+        for entry, row, (artist_id, album_id, genre_id) in zip(entries, rows, _resolve_rows(rows)):
+            content_hash = entry.get('content_hash')
+            if content_hash in by_hash:
+                tracks.append(by_hash[content_hash])
+                continue
+
+            track = MusicFile(
+                title=row['title'],
+                artist_id=artist_id,
+                album_id=album_id,
+                genre_id=genre_id,
+                file=entry['storage_name'],
+                content_hash=content_hash,
+                format=entry['format'],
+                processing_status=processing_status,
+            )
+            track.apply_metadata(entry.get('probe'))
+            if content_hash:
+                by_hash[content_hash] = track
+            tracks.append(track)
+            created.append(track)
+
+        MusicFile.objects.bulk_create(created)
+
+    return tracks
+
+
+def bulk_enrich_tracks(tracks: List[MusicFile], probes: List[Dict],
+                       overrides: Optional[Dict] = None, extra_fields=()) -> None:
+    """
+    Apply probe results to placeholder tracks with set-based writes.
+
+    Tags fill every catalog field the uploader did not set explicitly
+    (``overrides``); technical info always comes from the probe. Tracks are
+    marked ready; ``extra_fields`` already set by the caller (artwork,
+    waveform) are written in the same bulk update.
+    """
+    overrides = overrides or {}
+    rows = [
+        _track_row(track.title, probe, overrides)
+        for track, probe in zip(tracks, probes)
+    ]
+
+    with transaction.atomic():
+        for track, probe, row, (artist_id, album_id, genre_id) in zip(tracks, probes, rows, _resolve_rows(rows)):
+            track.title = row['title']
+            track.artist_id = artist_id
+            track.album_id = album_id
+            track.genre_id = genre_id
+            track.apply_metadata(probe)
+            track.processing_status = 'ready'
+
+        MusicFile.objects.bulk_update(tracks, [
+            'title', 'artist', 'album', 'genre', 'duration',
+            'bitrate', 'file_size', 'processing_status', *extra_fields,
+        ])
@@ -4,17 +4,94 @@ import os
 import re
 import logging
 import subprocess
+import time
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urlparse, parse_qs
 
 import yt_dlp
+from yt_dlp.extractor import gen_extractor_classes
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files import File
-from mutagen import File as MutagenFile
+from django.utils.module_loading import import_string
+
+from .metadata import probe_audio
 
 logger = logging.getLogger(__name__)
 
+# Extracted info dicts carry signed stream URLs, so keep them only briefly
+INFO_CACHE_TIMEOUT = getattr(settings, 'DOWNLOAD_INFO_CACHE_TIMEOUT', 600)
+# Seconds between cancellation checks of a running download or transcode
+CANCEL_CHECK_INTERVAL = getattr(settings, 'DOWNLOAD_CANCEL_CHECK_INTERVAL', 2)
+
+
+class DownloadCancelled(yt_dlp.utils.DownloadCancelled):
+    """The task was cancelled while downloading or transcoding"""
+    msg = 'The download was cancelled'
+
+
+# Extractor messages for media that no retry will ever bring back
+PERMANENT_ERROR_MESSAGES = (
+    'private video',
+    'video unavailable',
+    'this video is not available',
+    'this video has been removed',
+    'not available in your country',
+    'sign in to confirm your age',
+    'members-only',
+    'copyright',
+    'account associated with this video has been terminated',
+    'unsupported url',
+    'requested format is not available',
+    'http error 404',
+    'http error 410',
+)
+
+
+def is_permanent_error(error: BaseException) -> bool:
+    """
+    Whether a download error can never succeed on retry (private, removed,
+    geo-blocked or unsupported media). Network trouble, rate limiting and
+    anything unrecognized count as transient.
+    """
+    if isinstance(error, (yt_dlp.utils.GeoRestrictedError, yt_dlp.utils.UnsupportedError)):
+        return True
+    original = getattr(error, 'exc_info', None)
+    if original and original[1] is not None and original[1] is not error:
+        if is_permanent_error(original[1]):
+            return True
+    message = str(error).lower()
+    return any(pattern in message for pattern in PERMANENT_ERROR_MESSAGES)
+
+
+@lru_cache(maxsize=1024)
+def canonical_media_id(url: str) -> Optional[str]:
+    """
+    ``<extractor>:<id>`` for a URL without any network access, so every
+    spelling of the same video (youtu.be, watch?v=, extra params) shares
+    one cache entry. None when the id is only known after extraction.
+    """
+    for ie in gen_extractor_classes():
+        if ie.ie_key() != 'Generic' and ie.suitable(url):
+            media_id = ie.get_temp_id(url)
+            return f"{ie.ie_key()}:{media_id}" if media_id else None
+    return None
+
+
+def _info_cache_key(media_id: str) -> str:
+    return f"media_info:{media_id}"
+
+
+def get_downloader(**kwargs) -> 'MediaDownloader':
+    """
+    Instance of the configured download backend (DOWNLOADER_BACKEND), e.g.
+    music.utils.benchmark.FakeMediaDownloader for offline benchmarks.
+    """
+    backend = getattr(settings, 'DOWNLOADER_BACKEND', 'music.utils.downloader.MediaDownloader')
+    return import_string(backend)(**kwargs)
+
 
 class MediaDownloader:
     """Handle media downloads from various sources"""
@@ -28,13 +105,17 @@ class MediaDownloader:
     def __init__(self, download_dir: Optional[Path] = None):
         self.download_dir = download_dir or Path(settings.MEDIA_ROOT) / 'downloads' / 'temp'
         self.download_dir.mkdir(parents=True, exist_ok=True)
+        self._extracted = {}
+        # Exception of the last failed extraction, for failure classification
+        self.last_error = None
     
-    def detect_source(self, url: str) -> str:
+    @classmethod
+    def detect_source(cls, url: str) -> str:
         """Detect the source platform from URL"""
         parsed = urlparse(url)
         domain = parsed.netloc.lower()
         
-        for source, domains in self.SUPPORTED_SOURCES.items():
+        for source, domains in cls.SUPPORTED_SOURCES.items():
             if any(d in domain for d in domains):
                 return source
         
@@ -54,96 +135,192 @@ class MediaDownloader:
                     return match.group(1)
         return None
     
+    def extract_info(self, url: str) -> Optional[Dict]:
+        """
+        Full yt-dlp extraction for a URL, done at most once.
+        
+        The sanitized info dict is memoized on this downloader and cached
+        for INFO_CACHE_TIMEOUT under the canonical media id, so validation,
+        metadata and the download itself share a single page fetch.
+        Playlists come back flat: their entries are listed, not extracted.
+        """
+        media_id = canonical_media_id(url)
+        key = media_id or url
+        if key in self._extracted:
+            return self._extracted[key]
+        
+        info = cache.get(_info_cache_key(media_id)) if media_id else None
+        if info is None:
+            ydl_opts = {
+                'quiet': True,
+                'no_warnings': True,
+                'extract_flat': 'in_playlist',
+            }
+            try:
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+            except Exception as e:
+                logger.error(f"Failed to extract info from {url}: {e}")
+                self.last_error = e
+                return None
+            
+            media_id = media_id or self.media_id_for(info)
+            cache.set(_info_cache_key(media_id), info, timeout=INFO_CACHE_TIMEOUT)
+        
+        self._extracted[key] = info
+        return info
+    
+    def forget_info(self, url: str):
+        """Drop a memoized/cached extraction (e.g. its stream URLs expired)"""
+        media_id = canonical_media_id(url)
+        self._extracted.pop(media_id or url, None)
+        if media_id:
+            cache.delete(_info_cache_key(media_id))
+    
+    @staticmethod
+    def media_id_for(info: Dict) -> str:
+        """``<extractor>:<id>`` of an info dict or flat playlist entry"""
+        return f"{info.get('extractor_key') or info.get('ie_key')}:{info.get('id')}"
+    
+    @classmethod
+    def playlist_entries(cls, info: Dict) -> Optional[List[Dict]]:
+        """
+        Items of a flat playlist/album/channel extraction as
+        ``{'url', 'media_id', 'title'}`` dicts; None for a single video.
+        """
+        if info.get('_type') not in ('playlist', 'multi_video'):
+            return None
+        entries = []
+        for entry in info.get('entries') or []:
+            url = entry and (entry.get('webpage_url') or entry.get('url'))
+            if not url:
+                continue
+            entries.append({
+                'url': url,
+                'media_id': cls.media_id_for(entry),
+                'title': entry.get('title') or '',
+            })
+        return entries
+    
+    @classmethod
+    def summarize_info(cls, info: Dict) -> Dict:
+        """The metadata fields the app stores from an info dict"""
+        return {
+            'media_id': cls.media_id_for(info),
+            'title': info.get('title', ''),
+            'artist': info.get('uploader', '') or info.get('artist', ''),
+            'duration': info.get('duration', 0),
+            'thumbnail': info.get('thumbnail', ''),
+            'description': info.get('description', ''),
+            'upload_date': info.get('upload_date', ''),
+        }
+    
     def get_video_info(self, url: str) -> Optional[Dict]:
         """Extract video metadata without downloading"""
+        info = self.extract_info(url)
+        return self.summarize_info(info) if info else None
+    
+    def fetch_audio(self, url: str, progress_callback=None) -> Optional[Path]:
+        """
+        Download the best audio stream as-is (network only, no ffmpeg).
+        
+        Errors propagate so the caller can retry the fetch on its own;
+        transcode_audio converts the result separately.
+        """
         ydl_opts = {
+            'format': 'bestaudio/best',
+            'outtmpl': str(self.download_dir / '%(id)s.%(ext)s'),
             'quiet': True,
             'no_warnings': True,
-            'extract_flat': False,
+            'progress_hooks': [progress_callback] if progress_callback else [],
         }
         
+        info = self.extract_info(url)
         try:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                return {
-                    'title': info.get('title', ''),
-                    'artist': info.get('uploader', '') or info.get('artist', ''),
-                    'duration': info.get('duration', 0),
-                    'thumbnail': info.get('thumbnail', ''),
-                    'description': info.get('description', ''),
-                    'upload_date': info.get('upload_date', ''),
-                }
-        except Exception as e:
-            logger.error(f"Failed to extract info from {url}: {e}")
-            return None
+                if info is None:
+                    info = ydl.extract_info(url, download=True)
+                else:
+                    try:
+                        ydl.process_ie_result(dict(info), download=True)
+                    except yt_dlp.utils.DownloadError as e:
+                        logger.info(f"Re-extracting {url} after download error: {e}")
+                        self.forget_info(url)
+                        info = ydl.extract_info(url, download=True)
+        except DownloadCancelled:
+            # Drop the partial stream (<id>.<ext>.part) before bailing out
+            if info and info.get('id'):
+                for file_path in self.download_dir.glob(f"{info['id']}.*"):
+                    self.cleanup_file(file_path)
+            raise
+        
+        video_id = info.get('id', 'download')
+        for file_path in self.download_dir.glob(f"{video_id}.*"):
+            # Skip partial downloads and earlier transcodes (<id>.<q>.<ext>)
+            if file_path.stem == video_id and file_path.suffix not in ('.part', '.ytdl'):
+                return file_path
+        return None
+    
+    # ffmpeg encoder arguments per output format ({q} = bitrate in kbps)
+    ENCODER_ARGS = {
+        'mp3': ['-codec:a', 'libmp3lame', '-b:a', '{q}k'],
+        'ogg': ['-codec:a', 'libvorbis', '-b:a', '{q}k'],
+        'm4a': ['-codec:a', 'aac', '-b:a', '{q}k'],
+        'flac': ['-codec:a', 'flac'],
+        'wav': ['-codec:a', 'pcm_s16le'],
+    }
     
-    def download_audio(self, url: str, output_format: str = 'mp3', 
-                      quality: str = '320', progress_callback=None) -> Optional[Path]:
-        """Download audio from URL"""
+    def transcode_audio(self, source: Path, output_format: str = 'mp3',
+                        quality: str = '320', tags: Optional[Dict] = None,
+                        is_cancelled=None) -> Path:
+        """
+        Convert a fetched stream to the output format and write tags
+        (CPU only, no network).
         
-        output_template = str(self.download_dir / '%(id)s.%(ext)s')
+        ``is_cancelled()`` is polled every CANCEL_CHECK_INTERVAL seconds;
+        when it returns True ffmpeg is terminated, the partial output
+        removed and DownloadCancelled raised.
         
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': output_template,
-            'quiet': False,
-            'no_warnings': False,
-            'extract_audio': True,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': output_format,
-                'preferredquality': quality,
-            }],
-            'progress_hooks': [progress_callback] if progress_callback else [],
-        }
+        Returns:
+            Path: The converted file next to the source
+        """
+        target = source.with_name(f"{source.stem}.{quality}.{output_format}")
+        encoder = [arg.format(q=quality) for arg in self.ENCODER_ARGS[output_format]]
+        metadata = []
+        for key, value in (tags or {}).items():
+            if value:
+                metadata += ['-metadata', f'{key}={value}']
+        
+        command = ['ffmpeg', '-y', '-loglevel', 'error', '-i', str(source), '-vn',
+                   *encoder, *metadata, str(target)]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=CANCEL_CHECK_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if is_cancelled and is_cancelled():
+                    self._terminate(process)
+                    self.cleanup_file(target)
+                    raise DownloadCancelled()
         
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+        return target
+    
+    @staticmethod
+    def _terminate(process, grace: float = 5):
+        """Stop a subprocess: SIGTERM first, SIGKILL if it does not exit"""
+        process.terminate()
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                video_id = info.get('id', 'download')
-                
-                # Find downloaded file
-                possible_files = list(self.download_dir.glob(f"{video_id}.*"))
-                
-                for file_path in possible_files:
-                    if file_path.suffix.lower() in ['.mp3', '.flac', '.wav', '.m4a', '.ogg']:
-                        return file_path
-                
-                logger.error(f"Downloaded file not found for {url}")
-                return None
-                
-        except Exception as e:
-            logger.error(f"Download failed for {url}: {e}")
-            return None
+            process.communicate(timeout=grace)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
     
     def extract_metadata(self, file_path: Path) -> Dict:
-        """Extract metadata from audio file using mutagen"""
-        try:
-            audio = MutagenFile(file_path)
-            
-            if audio is None:
-                return {}
-            
-            metadata = {
-                'duration': int(audio.info.length) if hasattr(audio.info, 'length') else 0,
-                'bitrate': int(audio.info.bitrate / 1000) if hasattr(audio.info, 'bitrate') else 0,
-                'sample_rate': getattr(audio.info, 'sample_rate', 0),
-                'channels': getattr(audio.info, 'channels', 0),
-            }
-            
-            # Try to extract tags
-            if hasattr(audio, 'tags') and audio.tags:
-                tags = audio.tags
-                metadata['title'] = str(tags.get('title', [''])[0]) if 'title' in tags else ''
-                metadata['artist'] = str(tags.get('artist', [''])[0]) if 'artist' in tags else ''
-                metadata['album'] = str(tags.get('album', [''])[0]) if 'album' in tags else ''
-            
-            return metadata
-            
-        except Exception as e:
-            logger.error(f"Metadata extraction failed for {file_path}: {e}")
-            return {}
+        """Extract metadata from audio file (shared, content-hash cached probe)"""
+        return probe_audio(file_path)
     
     def cleanup_file(self, file_path: Path):
         """Remove temporary file"""
@@ -162,14 +339,14 @@ class MediaDownloader:
             if source == 'url':
                 return False, "Unsupported URL. Please use YouTube, SoundCloud, or Bandcamp links."
             
-            # Quick check without full download
-            info = self.get_video_info(url)
+            # Single extraction, reused later by get_video_info/fetch_audio
+            info = self.extract_info(url)
             
             if info is None:
                 return False, "Unable to extract video information. URL may be invalid or restricted."
             
             # Check duration (max 1 hour for free tier)
-            if info.get('duration', 0) > 3600:
+            if (info.get('duration') or 0) > 3600:
                 return False, "Video duration exceeds 1 hour limit."
             
             return True, "URL is valid"
@@ -179,21 +356,37 @@ class MediaDownloader:
 
 
 class DownloadProgressTracker:
-    """Track download progress for callbacks"""
+    """
+    Track download progress for callbacks.
     
-    def __init__(self, task_id, update_callback):
+    With ``is_cancelled``, the hook also polls for cancellation (at most
+    every CANCEL_CHECK_INTERVAL seconds) and raises DownloadCancelled,
+    which yt-dlp lets propagate out of the download.
+    """
+    
+    def __init__(self, task_id, update_callback, is_cancelled=None):
         self.task_id = task_id
         self.update_callback = update_callback
+        self.is_cancelled = is_cancelled
         self.last_progress = 0
+        self.last_cancel_check = time.monotonic()
     
     def __call__(self, d):
         """Called by yt-dlp with progress updates"""
+        if self.is_cancelled:
+            now = time.monotonic()
+            if now - self.last_cancel_check >= CANCEL_CHECK_INTERVAL:
+                self.last_cancel_check = now
+                if self.is_cancelled():
+                    raise DownloadCancelled()
+        
         if d['status'] == 'downloading':
             try:
                 percent_str = d.get('_percent_str', '0%')
                 percent = float(percent_str.strip('%'))
                 
-                # Only update if progress changed significantly
+                # Only report whole-percent changes; the callback's
+                # publisher throttles further and never writes the DB
                 if abs(percent - self.last_progress) >= 1:
                     self.last_progress = percent
                     self.update_callback(int(percent), f"Downloading: {percent:.1f}%")
@@ -0,0 +1,75 @@
+"""Liveness heartbeats for running download stages
+
+While a pipeline stage runs, a daemon thread refreshes a timestamp for its
+task in the shared cache every HEARTBEAT_INTERVAL seconds; the key is
+removed when the stage returns. A key that stops moving therefore means the
+worker died mid-stage (OOM kill, lost node), which ``reap_stale_downloads``
+turns into a requeue. Tasks waiting in a queue between stages have no key
+and are not mistaken for dead ones, unless they stay without a beat for
+DOWNLOAD_LOST_AFTER seconds after starting (lost stage message, worker gone
+before its first beat, flushed cache).
+
+Beats are one cache write each and never touch the database. Like live
+progress, they need the shared cache (REDIS_URL) to be seen across workers.
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = getattr(settings, 'DOWNLOAD_HEARTBEAT_INTERVAL', 30)
+# Outlives any plausible stall, so a dead worker's last beat stays visible
+HEARTBEAT_TTL = 60 * 60 * 24
+
+
+def heartbeat_key(task_id) -> str:
+    return f'download_heartbeat:{task_id}'
+
+
+def last_heartbeats(task_ids: Iterable) -> Dict[str, float]:
+    """Timestamp of the latest beat per task id (missing when not running)"""
+    keys = {heartbeat_key(task_id): str(task_id) for task_id in task_ids}
+    return {keys[key]: value for key, value in cache.get_many(keys).items()}
+
+
+def forget_heartbeats(task_ids: Iterable):
+    cache.delete_many([heartbeat_key(task_id) for task_id in task_ids])
+
+
+class Heartbeat:
+    """Context manager beating for one task while its stage runs"""
+
+    def __init__(self, task_id, interval: float = None):
+        self.key = heartbeat_key(task_id)
+        self.interval = HEARTBEAT_INTERVAL if interval is None else interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def beat(self):
+        try:
+            cache.set(self.key, time.time(), timeout=HEARTBEAT_TTL)
+        except Exception as e:
+            # A missed beat is harmless unless it lasts DOWNLOAD_STALE_AFTER
+            logger.warning(f"Heartbeat {self.key} failed: {e}")
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.beat()
+
+    def __enter__(self):
+        self.beat()
+        self._thread = threading.Thread(target=self._run, name=f'heartbeat-{self.key}', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        cache.delete(self.key)
+        return False
@@ -0,0 +1,256 @@
+"""Audio metadata probing with a content-hash keyed cache
+
+Every place that needs tags, technical info or embedded artwork goes
+through ``probe_audio``: the file is parsed by mutagen exactly once and the
+result is cached under the SHA-256 of its bytes, so re-saves, admin
+re-extraction and downloads never re-parse unchanged content.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    from mutagen import File as MutagenFile
+    from mutagen.flac import Picture
+    MUTAGEN_AVAILABLE = True
+except ImportError:
+    MUTAGEN_AVAILABLE = False
+    logging.warning('Mutagen not installed. Metadata extraction disabled.')
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+PROBE_CACHE_TIMEOUT = getattr(settings, 'METADATA_PROBE_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+
+# Tag lookups per container: ID3 frame, Vorbis comment, MP4 atom
+TAG_KEYS = {
+    'title': ('TIT2', 'title', '\xa9nam'),
+    'artist': ('TPE1', 'artist', '\xa9ART'),
+    'albumartist': ('TPE2', 'albumartist', 'aART'),
+    'album': ('TALB', 'album', '\xa9alb'),
+    'year': ('TDRC', 'date', '\xa9day'),
+    'genre': ('TCON', 'genre', '\xa9gen'),
+}
+
+MP4_COVER_MIMES = {13: 'image/jpeg', 14: 'image/png'}
+
+
+def compute_file_hash(source) -> str:
+    """Return the SHA-256 hex digest of a path or file-like object"""
+    digest = hashlib.sha256()
+
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    if hasattr(source, 'chunks'):
+        for chunk in source.chunks(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    else:
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return digest.hexdigest()
+
+
+def hash_for_path(path) -> str:
+    """
+    Return the content hash of a file on disk.
+
+    The digest is remembered per (path, size, mtime) so repeated saves of an
+    unchanged file don't re-read its bytes.
+    """
+    stat = os.stat(path)
+    path_key = hashlib.sha1(os.fsencode(os.path.abspath(path))).hexdigest()
+    cache_key = f'audio_hash:{path_key}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    content_hash = cache.get(cache_key)
+    if content_hash is None:
+        content_hash = compute_file_hash(path)
+        cache.set(cache_key, content_hash, timeout=PROBE_CACHE_TIMEOUT)
+    return content_hash
+
+
+def _local_path(source) -> Optional[str]:
+    """Best-effort filesystem path for a path, FieldFile or UploadedFile"""
+    if isinstance(source, (str, Path)):
+        return str(source)
+
+    if hasattr(source, 'temporary_file_path'):
+        return source.temporary_file_path()
+
+    # Committed FieldFile on a filesystem storage
+    if getattr(source, '_committed', False) and getattr(source, 'name', None):
+        try:
+            return source.path
+        except NotImplementedError:
+            return None
+
+    # Uncommitted FieldFile wrapping an upload
+    inner = getattr(source, 'file', None)
+    if inner is not None and inner is not source and hasattr(inner, 'temporary_file_path'):
+        return inner.temporary_file_path()
+    return None
+
+
+def _first_text(value) -> Optional[str]:
+    """Flatten an ID3 frame, Vorbis comment list or MP4 atom to a string"""
+    if value is None:
+        return None
+    if hasattr(value, 'text'):
+        value = value.text
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _extract_tags(audio) -> Dict:
+    tags = getattr(audio, 'tags', None)
+    if not tags:
+        return {}
+
+    result = {}
+    for field, keys in TAG_KEYS.items():
+        for key in keys:
+            try:
+                value = _first_text(tags.get(key))
+            except (KeyError, ValueError, TypeError):
+                value = None
+            if value:
+                result[field] = value
+                break
+    return result
+
+
+def _extract_artwork(audio) -> Optional[Dict]:
+    """Pull the first embedded picture from ID3, FLAC, Vorbis or MP4 tags"""
+    pictures = getattr(audio, 'pictures', None)
+    if pictures:
+        return {'data': pictures[0].data, 'mime': pictures[0].mime}
+
+    tags = getattr(audio, 'tags', None)
+    if not tags:
+        return None
+
+    if hasattr(tags, 'getall'):
+        frames = tags.getall('APIC')
+        if frames:
+            return {'data': frames[0].data, 'mime': frames[0].mime}
+        return None
+
+    covers = tags.get('covr')
+    if covers:
+        cover = covers[0]
+        mime = MP4_COVER_MIMES.get(getattr(cover, 'imageformat', None), 'image/jpeg')
+        return {'data': bytes(cover), 'mime': mime}
+
+    encoded = tags.get('metadata_block_picture')
+    if encoded:
+        try:
+            picture = Picture(base64.b64decode(encoded[0]))
+            return {'data': picture.data, 'mime': picture.mime}
+        except Exception as e:
+            logger.debug(f"Could not decode Vorbis picture block: {e}")
+    return None
+
+
+def _parse(source, path: Optional[str], file_size: int) -> Dict:
+    """Run the single mutagen parse and normalize its output"""
+    if path:
+        audio = MutagenFile(path)
+    else:
+        source.seek(0)
+        audio = MutagenFile(source)
+        source.seek(0)
+
+    if audio is None:
+        return {}
+
+    result = _extract_tags(audio)
+    if not result.get('artist') and result.get('albumartist'):
+        result['artist'] = result['albumartist']
+
+    info = getattr(audio, 'info', None)
+    length = getattr(info, 'length', 0) or 0
+    bitrate = getattr(info, 'bitrate', 0) or 0
+    if not bitrate and length and file_size:
+        bitrate = int(file_size * 8 / length)
+
+    result.update({
+        'duration': int(length),
+        'bitrate': int(bitrate / 1000) if bitrate else None,
+        'sample_rate': getattr(info, 'sample_rate', 0) or 0,
+        'channels': getattr(info, 'channels', 0) or 0,
+    })
+
+    try:
+        artwork = _extract_artwork(audio)
+    except Exception as e:
+        logger.debug(f"Could not extract artwork: {e}")
+        artwork = None
+    if artwork:
+        result['artwork'] = artwork['data']
+        result['artwork_mime'] = artwork['mime']
+
+    return result
+
+
+def probe_audio(source, content_hash: Optional[str] = None) -> Dict:
+    """
+    Parse an audio file once and return tags, technical info and artwork.
+
+    Args:
+        source: Path, Django FieldFile or UploadedFile
+        content_hash: Precomputed SHA-256 of the bytes, if already known
+
+    Returns:
+        dict: Always contains ``content_hash`` and ``file_size``; tag keys
+        (title, artist, album, year, genre), technical keys (duration,
+        bitrate, sample_rate, channels) and artwork/artwork_mime are present
+        when the file could be parsed.
+    """
+    path = _local_path(source)
+
+    try:
+        if path:
+            file_size = os.path.getsize(path)
+            content_hash = content_hash or hash_for_path(path)
+        else:
+            file_size = getattr(source, 'size', 0) or 0
+            content_hash = content_hash or compute_file_hash(source)
+    except (OSError, ValueError) as e:
+        logger.error(f"Cannot read audio file for probing: {e}")
+        return {}
+
+    cache_key = f'audio_probe:{content_hash}'
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
+    result = {}
+    if MUTAGEN_AVAILABLE:
+        try:
+            result = _parse(source, path, file_size)
+        except Exception as e:
+            logger.error(f"Metadata extraction error: {e}")
+
+    # Unparseable files are cached too so they aren't retried on every save
+    result['content_hash'] = content_hash
+    result['file_size'] = file_size
+    cache.set(cache_key, result, timeout=PROBE_CACHE_TIMEOUT)
+    return dict(result)
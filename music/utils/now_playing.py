@@ -0,0 +1,236 @@
+"""Server-side "playing now" board over a sliding window
+
+Play starts reported by WebSocket clients are counted per track in
+time buckets of BUCKET_SECONDS (one sorted set each, expiring on its own);
+the board is the top NOW_PLAYING_TOP_K tracks of the buckets covering the
+last NOW_PLAYING_WINDOW seconds. Subscribers never see individual play
+events: an aggregator task publishes a compact snapshot of the board to the
+``now_playing`` group every NOW_PLAYING_INTERVAL seconds, so traffic grows
+with the number of subscribers, not with subscribers x plays.
+
+Each connection may report NOW_PLAYING_STARTS_PER_MINUTE play starts
+(token bucket, bursts of NOW_PLAYING_START_BURST); further reports are
+dropped before they touch the board (``StartLimiter``). Only ids of
+tracks in the library are counted, so forged ids cannot crowd real tracks
+off the board.
+
+With ``REDIS_URL`` the buckets live in Redis (redis.asyncio) and a
+short-lived lock lets only one ASGI process publish each tick; without
+Redis the same bookkeeping runs in-process.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Dict, List
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+WINDOW = getattr(settings, 'NOW_PLAYING_WINDOW', 5 * 60)
+TOP_K = getattr(settings, 'NOW_PLAYING_TOP_K', 10)
+PUBLISH_INTERVAL = getattr(settings, 'NOW_PLAYING_INTERVAL', 5.0)
+STARTS_PER_MINUTE = getattr(settings, 'NOW_PLAYING_STARTS_PER_MINUTE', 6)
+START_BURST = getattr(settings, 'NOW_PLAYING_START_BURST', 3)
+BUCKET_SECONDS = 10
+# Board candidates read per shown track, and how long a known track id is cached
+OVERFETCH = 4
+TRACK_CACHE_TIMEOUT = 60 * 60
+GROUP = 'now_playing'
+
+
+def _bucket_key(bucket: int) -> str:
+    return f'now_playing:{bucket}'
+
+
+def _buckets(now: float) -> List[int]:
+    current = int(now // BUCKET_SECONDS)
+    return list(range(current - WINDOW // BUCKET_SECONDS + 1, current + 1))
+
+
+class StartLimiter:
+    """Per-connection token bucket for reported play starts"""
+
+    def __init__(self, per_minute: int = None, burst: int = None):
+        self.rate = (STARTS_PER_MINUTE if per_minute is None else per_minute) / 60
+        self.burst = START_BURST if burst is None else burst
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class _RedisBoard:
+    def __init__(self, url):
+        import redis.asyncio as aioredis
+        self.client = aioredis.Redis.from_url(url)
+
+    async def record(self, track_id, now):
+        key = _bucket_key(_buckets(now)[-1])
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zincrby(key, 1, track_id)
+            pipe.expire(key, WINDOW + BUCKET_SECONDS)
+            await pipe.execute()
+
+    async def top(self, limit, now):
+        keys = [_bucket_key(bucket) for bucket in _buckets(now)]
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zunionstore('now_playing:window', keys)
+            pipe.zrevrange('now_playing:window', 0, limit - 1, withscores=True)
+            pipe.delete('now_playing:window')
+            results = await pipe.execute()
+        return [(track_id.decode(), int(plays)) for track_id, plays in results[1]]
+
+    async def claim_tick(self, interval):
+        return bool(await self.client.set('now_playing:publisher', 1, nx=True, px=int(interval * 1000)))
+
+    async def save_snapshot(self, board):
+        await self.client.set('now_playing:board', json.dumps(board), ex=WINDOW)
+
+    async def snapshot(self):
+        board = await self.client.get('now_playing:board')
+        return json.loads(board) if board else None
+
+
+class _LocalBoard:
+    """Single-process equivalent of the Redis buckets"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.board = None
+
+    async def record(self, track_id, now):
+        with self.lock:
+            buckets = _buckets(now)
+            for bucket in list(self.buckets):
+                if bucket < buckets[0]:
+                    del self.buckets[bucket]
+            self.buckets.setdefault(buckets[-1], Counter())[track_id] += 1
+
+    async def top(self, limit, now):
+        with self.lock:
+            window = Counter()
+            for bucket in _buckets(now):
+                window.update(self.buckets.get(bucket, {}))
+            return window.most_common(limit)
+
+    async def claim_tick(self, interval):
+        return True
+
+    async def save_snapshot(self, board):
+        self.board = board
+
+    async def snapshot(self):
+        return self.board
+
+
+_backend = None
+
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        redis_url = getattr(settings, 'REDIS_URL', '')
+        _backend = _RedisBoard(redis_url) if redis_url else _LocalBoard()
+    return _backend
+
+
+@database_sync_to_async
+def _is_track(track_id: str) -> bool:
+    from ..models import MusicFile
+
+    key = f'now_playing:track:{track_id}'
+    if cache.get(key):
+        return True
+    # Only hits are cached: forged ids cost one pk lookup each (rate-limited)
+    exists = MusicFile.objects.filter(id=track_id).exists()
+    if exists:
+        cache.set(key, True, TRACK_CACHE_TIMEOUT)
+    return exists
+
+
+async def record_play(track_id) -> bool:
+    """Count one play start of a library track; False for unknown ids"""
+    track_id = str(track_id)
+    if not await _is_track(track_id):
+        return False
+    await _get_backend().record(track_id, time.time())
+    return True
+
+
+@database_sync_to_async
+def _describe(track_ids) -> Dict[str, Dict]:
+    from ..models import MusicFile
+
+    tracks = MusicFile.objects.filter(id__in=track_ids).values('id', 'title', 'artist__name')
+    return {str(track['id']): track for track in tracks}
+
+
+async def build_board() -> List[Dict]:
+    """Top tracks of the window, with titles from the library"""
+    # Over-fetch: tracks deleted since their plays were counted are dropped below
+    top = await _get_backend().top(TOP_K * OVERFETCH, time.time())
+    if not top:
+        return []
+    tracks = await _describe([track_id for track_id, _ in top])
+    return [
+        {
+            'track_id': track_id,
+            'title': tracks[track_id]['title'],
+            'artist': tracks[track_id]['artist__name'],
+            'plays': plays,
+        }
+        for track_id, plays in top if track_id in tracks
+    ][:TOP_K]
+
+
+async def current_board() -> List[Dict]:
+    """Last published board (built now if none was published yet)"""
+    board = await _get_backend().snapshot()
+    return await build_board() if board is None else board
+
+
+async def publish_board(channel_layer) -> bool:
+    """Build and push one snapshot, unless another process has this tick"""
+    backend = _get_backend()
+    if not await backend.claim_tick(PUBLISH_INTERVAL):
+        return False
+    board = await build_board()
+    await backend.save_snapshot(board)
+    await channel_layer.group_send(GROUP, {'type': 'now_playing_board', 'tracks': board})
+    return True
+
+
+async def _publish_forever(channel_layer):
+    while True:
+        await asyncio.sleep(PUBLISH_INTERVAL)
+        try:
+            await publish_board(channel_layer)
+        except Exception as e:
+            logger.error(f"Now playing snapshot failed: {e}")
+
+
+_publisher = None
+
+
+def ensure_publisher(channel_layer):
+    """Start this process's snapshot loop on the running event loop once"""
+    global _publisher
+    loop = asyncio.get_running_loop()
+    if _publisher is None or _publisher.done() or _publisher.get_loop() is not loop:
+        _publisher = loop.create_task(_publish_forever(channel_layer))
+    return _publisher
@@ -0,0 +1,211 @@
+"""Listener presence per track, counted from live WebSocket connections
+
+Every connection watching a track is a member of the track's sorted set,
+scored with the time its presence expires. Connecting and every client ping
+push the expiry LISTENER_PRESENCE_TTL seconds ahead; disconnecting removes
+the member. Expired members are dropped before each count, so a connection
+that vanished without ``disconnect`` (crashed node, killed process) stops
+counting after one TTL instead of inflating the count forever; dropping
+them marks the track changed like a leave, so the remaining listeners
+(whose pings prune the set) are sent the corrected count too.
+
+With ``REDIS_URL`` the sets live in Redis and each update is a single
+MULTI/EXEC pipeline on the redis.asyncio client (no thread hop, no
+read-modify-write), so counts are exact across all ASGI nodes. Without
+Redis (development, tests) the same bookkeeping runs in-process.
+
+Count changes are not broadcast per event: joins and leaves only mark the
+track as changed, and a small aggregator task in each ASGI process
+(``ensure_aggregator``) sends the latest count of every changed track to
+its group at most once per LISTENER_BROADCAST_INTERVAL. Changed tracks are
+popped atomically, so across processes each one is still broadcast once.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Iterable
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_TTL = getattr(settings, 'LISTENER_PRESENCE_TTL', 90)
+BROADCAST_INTERVAL = getattr(settings, 'LISTENER_BROADCAST_INTERVAL', 2.0)
+# Changed tracks broadcast per aggregator pass at most
+BROADCAST_BATCH = 500
+DIRTY_KEY = 'track_listeners:changed'
+
+
+def presence_key(track_id) -> str:
+    return f'track_listeners:{track_id}'
+
+
+def listeners_group(track_id) -> str:
+    """Channels group of the connections watching a track"""
+    return f'track_{track_id}_listeners'
+
+
+class _RedisPresence:
+    def __init__(self, url):
+        import redis.asyncio as aioredis
+        self.client = aioredis.Redis.from_url(url)
+
+    async def touch(self, key, member, now):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, {member: now + PRESENCE_TTL})
+            pipe.expire(key, PRESENCE_TTL)
+            pipe.zcard(key)
+            results = await pipe.execute()
+        return bool(results[0] or results[1]), results[-1]
+
+    async def remove(self, key, member, now):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zrem(key, member)
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zcard(key)
+            results = await pipe.execute()
+        return bool(results[0] or results[1]), results[-1]
+
+    async def counts(self, keys, now):
+        async with self.client.pipeline(transaction=True) as pipe:
+            for key in keys:
+                pipe.zremrangebyscore(key, '-inf', now)
+                pipe.zcard(key)
+            results = await pipe.execute()
+        return list(zip((bool(pruned) for pruned in results[0::2]), results[1::2]))
+
+    async def mark_changed(self, track_id):
+        await self.client.sadd(DIRTY_KEY, track_id)
+
+    async def pop_changed(self, limit):
+        track_ids = await self.client.spop(DIRTY_KEY, limit)
+        return [track_id.decode() for track_id in track_ids or []]
+
+
+class _LocalPresence:
+    """Single-process equivalent of the Redis sorted sets"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = {}
+        self.changed = set()
+
+    def _live(self, key, now):
+        """Unexpired members of a key, and whether any expired ones were dropped"""
+        members = self.members.get(key, {})
+        expired = [member for member, expires in members.items() if expires <= now]
+        for member in expired:
+            del members[member]
+        return members, bool(expired)
+
+    async def touch(self, key, member, now):
+        with self.lock:
+            members, pruned = self._live(key, now)
+            added = member not in members
+            members[member] = now + PRESENCE_TTL
+            self.members[key] = members
+            return added or pruned, len(members)
+
+    async def remove(self, key, member, now):
+        with self.lock:
+            members, pruned = self._live(key, now)
+            removed = members.pop(member, None) is not None
+            return removed or pruned, len(members)
+
+    async def counts(self, keys, now):
+        with self.lock:
+            return [(pruned, len(members)) for members, pruned in (self._live(key, now) for key in keys)]
+
+    async def mark_changed(self, track_id):
+        with self.lock:
+            self.changed.add(str(track_id))
+
+    async def pop_changed(self, limit):
+        with self.lock:
+            return [self.changed.pop() for _ in range(min(limit, len(self.changed)))]
+
+
+_backend = None
+
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        redis_url = getattr(settings, 'REDIS_URL', '')
+        _backend = _RedisPresence(redis_url) if redis_url else _LocalPresence()
+    return _backend
+
+
+async def join(track_id, member: str) -> int:
+    """Mark a connection as listening (or still listening); returns the count"""
+    backend = _get_backend()
+    changed, count = await backend.touch(presence_key(track_id), member, time.time())
+    if changed:
+        await backend.mark_changed(track_id)
+    return count
+
+
+async def leave(track_id, member: str) -> int:
+    """Remove a connection's presence; returns the remaining count"""
+    backend = _get_backend()
+    changed, count = await backend.remove(presence_key(track_id), member, time.time())
+    if changed:
+        await backend.mark_changed(track_id)
+    return count
+
+
+async def _counts(track_ids, mark_pruned: bool) -> Dict[str, int]:
+    track_ids = [str(track_id) for track_id in track_ids]
+    if not track_ids:
+        return {}
+    backend = _get_backend()
+    results = await backend.counts([presence_key(track_id) for track_id in track_ids], time.time())
+    if mark_pruned:
+        for track_id, (pruned, _) in zip(track_ids, results):
+            if pruned:
+                await backend.mark_changed(track_id)
+    return {track_id: count for track_id, (_, count) in zip(track_ids, results)}
+
+
+async def listener_counts(track_ids: Iterable) -> Dict[str, int]:
+    """Live listener count per track id"""
+    return await _counts(track_ids, mark_pruned=True)
+
+
+async def broadcast_changed_counts(channel_layer) -> int:
+    """Send the current count of every changed track to its group once"""
+    track_ids = await _get_backend().pop_changed(BROADCAST_BATCH)
+    # Expired members dropped here are already reflected in this broadcast
+    counts = await _counts(track_ids, mark_pruned=False)
+    for track_id, count in counts.items():
+        await channel_layer.group_send(listeners_group(track_id), {
+            'type': 'listener_count_message',
+            'track_id': track_id,
+            'count': count,
+        })
+    return len(counts)
+
+
+async def _aggregate(channel_layer):
+    while True:
+        await asyncio.sleep(BROADCAST_INTERVAL)
+        try:
+            await broadcast_changed_counts(channel_layer)
+        except Exception as e:
+            # Counts are marked changed again by the next join or leave
+            logger.error(f"Listener count broadcast failed: {e}")
+
+
+_aggregator = None
+
+
+def ensure_aggregator(channel_layer):
+    """Start this process's broadcast loop on the running event loop once"""
+    global _aggregator
+    loop = asyncio.get_running_loop()
+    if _aggregator is None or _aggregator.done() or _aggregator.get_loop() is not loop:
+        _aggregator = loop.create_task(_aggregate(channel_layer))
+    return _aggregator
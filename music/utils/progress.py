@@ -0,0 +1,98 @@
+"""Live download progress published to the channel layer and the cache
+
+Download workers report progress many times per second. Instead of writing
+each percent to ``DownloadTask`` (one UPDATE per step), the latest value is
+kept in the shared cache and pushed to a per-user channels group at a
+throttled rate; the database is only written at stage transitions.
+
+The cache entry doubles as the snapshot a freshly connected WebSocket (or
+the polling fallback) reads, so neither has to wait for the next event.
+"""
+
+import logging
+import time
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+    CHANNELS_AVAILABLE = True
+except ImportError:
+    CHANNELS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_INTERVAL = getattr(settings, 'DOWNLOAD_PROGRESS_INTERVAL', 0.5)
+CACHE_TIMEOUT = getattr(settings, 'DOWNLOAD_PROGRESS_CACHE_TIMEOUT', 60 * 60)
+EVENT_TYPE = 'download.progress'
+
+
+def progress_group(user_id) -> str:
+    """Channels group receiving every download progress event of a user"""
+    return f'downloads_user_{user_id}'
+
+
+def progress_cache_key(task_id) -> str:
+    return f'download_progress:{task_id}'
+
+
+def cached_progress(task_ids: Iterable) -> Dict[str, Dict]:
+    """Latest published progress per task id (missing when never published)"""
+    keys = {progress_cache_key(task_id): str(task_id) for task_id in task_ids}
+    return {keys[key]: value for key, value in cache.get_many(keys).items()}
+
+
+class ProgressPublisher:
+    """
+    Throttled publisher for one download task.
+
+    Ordinary updates go out at most once per ``min_interval`` seconds and
+    only when the value changed; status changes and forced updates (stage
+    transitions) are always sent.
+    """
+
+    def __init__(self, task_id, user_id, min_interval: Optional[float] = None):
+        self.task_id = str(task_id)
+        self.user_id = user_id
+        self.min_interval = PUBLISH_INTERVAL if min_interval is None else min_interval
+        self.last_sent = None
+        self.last_published_at = 0.0
+
+    def publish(self, progress: int, step: str = '', status: str = '', force: bool = False) -> bool:
+        """Publish unless throttled; returns whether anything was sent"""
+        payload = {
+            'task_id': self.task_id,
+            'status': status,
+            'progress': progress,
+            'step': step,
+        }
+        now = time.monotonic()
+        if not force and self.last_sent is not None:
+            if payload == self.last_sent:
+                return False
+            if (status == self.last_sent['status']
+                    and now - self.last_published_at < self.min_interval):
+                return False
+
+        self.last_sent = payload
+        self.last_published_at = now
+        cache.set(progress_cache_key(self.task_id), payload, timeout=CACHE_TIMEOUT)
+        self._send(payload)
+        return True
+
+    def _send(self, payload: Dict):
+        if not CHANNELS_AVAILABLE:
+            return
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        try:
+            async_to_sync(channel_layer.group_send)(
+                progress_group(self.user_id), {'type': EVENT_TYPE, **payload}
+            )
+        except Exception as e:
+            # Progress is best effort; the cache entry still serves pollers
+            logger.warning(f"Failed to publish progress for task {self.task_id}: {e}")
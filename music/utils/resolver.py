@@ -0,0 +1,312 @@
+"""Race-free, cached resolution of artist, album and genre names to ids
+
+Names are matched on a normalized key (``normalize_name``) backed by a
+unique index, and missing rows are inserted with ``ignore_conflicts`` and
+re-read, so concurrent workers resolving the same new name converge on a
+single row instead of creating duplicates.
+
+Resolved ids are remembered in a small in-process LRU and in the shared
+Django cache, so a warm upload or download resolves its artist, album and
+genre without touching the database. Ids are only cached once the
+inserting transaction commits, and deleting or merging entities rotates a
+shared generation token, which invalidates both layers.
+"""
+
+import hashlib
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from ..models import Album, Artist, Genre, MusicFile, normalize_name
+
+logger = logging.getLogger(__name__)
+
+LOCAL_CACHE_SIZE = getattr(settings, 'ENTITY_RESOLVER_CACHE_SIZE', 4096)
+SHARED_CACHE_TIMEOUT = getattr(settings, 'ENTITY_RESOLVER_CACHE_TIMEOUT', 60 * 60 * 24)
+GENERATION_KEY = 'entity_resolver:generation'
+
+
+class _LRU:
+    """Thread-safe bounded mapping used as the in-process id cache"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_local = _LRU(LOCAL_CACHE_SIZE)
+
+
+def _generation() -> str:
+    """Shared token namespacing every cached id; a fresh one drops them all"""
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def invalidate():
+    """Forget every cached name -> id mapping (after deletes and merges)"""
+    _local.clear()
+    cache.set(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def _remember(kind: str, generation: str, ids: Dict[str, object]):
+    cache.set_many(
+        {_cache_key(kind, generation, key): value for key, value in ids.items()},
+        timeout=SHARED_CACHE_TIMEOUT
+    )
+    for key, value in ids.items():
+        _local.set((kind, generation, key), value)
+
+
+def _cache_key(kind: str, generation: str, key: str) -> str:
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return f'entity:{kind}:{generation}:{digest}'
+
+
+def _resolve(kind: str, keys: Iterable[str], load, create) -> Dict[str, object]:
+    """
+    Map lookup keys to ids: in-process LRU, then shared cache, then one
+    query, then one conflict-tolerant insert for whatever is still missing.
+
+    Args:
+        load: callable(keys) -> {key: id} reading existing rows
+        create: callable(keys) bulk-inserting rows with ignore_conflicts
+    """
+    keys = set(keys)
+    if not keys:
+        return {}
+
+    generation = _generation()
+    found = {}
+    for key in keys:
+        value = _local.get((kind, generation, key))
+        if value is not None:
+            found[key] = value
+
+    missing = keys - found.keys()
+    if missing:
+        cache_keys = {_cache_key(kind, generation, key): key for key in missing}
+        for cache_key, value in cache.get_many(cache_keys).items():
+            found[cache_keys[cache_key]] = value
+            _local.set((kind, generation, cache_keys[cache_key]), value)
+
+    missing = keys - found.keys()
+    if missing:
+        fetched = load(missing)
+        if len(fetched) < len(missing):
+            # Losing an insert race is fine: re-reading returns the winner's row
+            create(missing - fetched.keys())
+            fetched.update(load(missing - fetched.keys()))
+        found.update(fetched)
+        # Rows inserted here vanish if the caller's transaction rolls back
+        transaction.on_commit(lambda: _remember(kind, generation, fetched))
+
+    return found
+
+
+def _spellings(names: Iterable[str], max_length: int = 255) -> Dict[str, str]:
+    """Map every distinct spelling to its normalized key"""
+    return {name: normalize_name(name, max_length) for name in set(filter(None, names))}
+
+
+def resolve_artist_ids(names: Iterable[str]) -> Dict[str, object]:
+    """Map artist names to Artist ids, creating the missing artists"""
+    spellings = _spellings(names)
+    by_key = {}
+    for name, key in spellings.items():
+        by_key.setdefault(key, name)
+
+    def load(keys):
+        return dict(Artist.objects.filter(name_key__in=keys).values_list('name_key', 'id'))
+
+    def create(keys):
+        Artist.objects.bulk_create(
+            [Artist(name=by_key[key], name_key=key) for key in keys],
+            ignore_conflicts=True
+        )
+
+    ids = _resolve('artist', by_key, load, create)
+    return {name: ids[key] for name, key in spellings.items()}
+
+
+def resolve_genre_ids(names: Iterable[str]) -> Dict[str, object]:
+    """Map genre names to Genre ids, creating the missing genres"""
+    spellings = _spellings(names, 100)
+    by_key = {}
+    for name, key in spellings.items():
+        by_key.setdefault(key, name[:100])
+
+    def load(keys):
+        return dict(Genre.objects.filter(name_key__in=keys).values_list('name_key', 'id'))
+
+    def create(keys):
+        Genre.objects.bulk_create(
+            [Genre(name=by_key[key], name_key=key) for key in keys],
+            ignore_conflicts=True
+        )
+
+    ids = _resolve('genre', by_key, load, create)
+    return {name: ids[key] for name, key in spellings.items()}
+
+
+def resolve_album_ids(albums: Dict[Tuple[str, object], Optional[int]]) -> Dict[Tuple[str, object], object]:
+    """
+    Map (title, artist_id) pairs to Album ids, creating the missing albums.
+
+    Args:
+        albums: {(title, artist_id): year or None}
+    """
+    by_key = {}
+    for (title, artist_id), year in albums.items():
+        if title:
+            by_key.setdefault(f'{artist_id}:{normalize_name(title)}', (title, artist_id, year))
+
+    def load(keys):
+        artist_ids = {by_key[key][1] for key in keys}
+        title_keys = {key.split(':', 1)[1] for key in keys}
+        rows = Album.objects.filter(
+            artist_id__in=artist_ids, title_key__in=title_keys
+        ).values_list('artist_id', 'title_key', 'id')
+        return {
+            key: album_id for key, album_id in
+            ((f'{artist_id}:{title_key}', album_id) for artist_id, title_key, album_id in rows)
+            if key in keys
+        }
+
+    def create(keys):
+        Album.objects.bulk_create(
+            [
+                Album(title=title, title_key=normalize_name(title), artist_id=artist_id, year=year)
+                for title, artist_id, year in (by_key[key] for key in keys)
+            ],
+            ignore_conflicts=True
+        )
+
+    ids = _resolve('album', by_key, load, create)
+    return {
+        (title, artist_id): ids[f'{artist_id}:{normalize_name(title)}']
+        for title, artist_id in albums if title
+    }
+
+
+def resolve_artist_id(name: str):
+    """Single-name convenience wrapper around resolve_artist_ids"""
+    return resolve_artist_ids([name])[name]
+
+
+# ============================================================================
+# Merging existing duplicates
+# ============================================================================
+
+def merge_duplicate_entities(artist_model=Artist, album_model=Album,
+                             genre_model=Genre, track_model=MusicFile) -> Dict[str, int]:
+    """
+    Collapse artists, albums and genres whose names normalize to the same
+    key, then (re)write the stored keys.
+
+    The oldest row of each group is kept; tracks and albums are repointed
+    to it. Keys are recomputed from the names rather than trusted, so this
+    also folds rows that only collide under changed normalization rules.
+    Migration 0007 runs a frozen copy of this against historical models.
+
+    Returns:
+        dict: Number of merged (deleted) rows per entity kind
+    """
+    merged = {'artists': 0, 'albums': 0, 'genres': 0}
+
+    with transaction.atomic():
+        for keep, dup_ids in _duplicate_groups(artist_model, lambda r: normalize_name(r['name']), 'name'):
+            track_model.objects.filter(artist_id__in=dup_ids).update(artist_id=keep)
+            # Albums move over, folding into the kept artist's album of the same title
+            kept_albums = {
+                normalize_name(title): pk for pk, title in
+                album_model.objects.filter(artist_id=keep).values_list('pk', 'title')
+            }
+            for album in album_model.objects.filter(artist_id__in=dup_ids).order_by('created_at', 'pk'):
+                title_key = normalize_name(album.title)
+                target = kept_albums.setdefault(title_key, album.pk)
+                if target != album.pk:
+                    track_model.objects.filter(album_id=album.pk).update(album_id=target)
+                    album_model.objects.filter(pk=album.pk).delete()
+                    merged['albums'] += 1
+                else:
+                    album_model.objects.filter(pk=album.pk).update(artist_id=keep, title_key=title_key)
+            artist_model.objects.filter(pk__in=dup_ids).delete()
+            merged['artists'] += len(dup_ids)
+        _write_keys(artist_model, 'name', 'name_key', 255)
+
+        album_key = lambda r: (r['artist_id'], normalize_name(r['title']))  # noqa: E731
+        for keep, dup_ids in _duplicate_groups(album_model, album_key, 'artist_id', 'title'):
+            track_model.objects.filter(album_id__in=dup_ids).update(album_id=keep)
+            album_model.objects.filter(pk__in=dup_ids).delete()
+            merged['albums'] += len(dup_ids)
+        _write_keys(album_model, 'title', 'title_key', 255)
+
+        for keep, dup_ids in _duplicate_groups(genre_model, lambda r: normalize_name(r['name'], 100), 'name'):
+            track_model.objects.filter(genre_id__in=dup_ids).update(genre_id=keep)
+            album_model.objects.filter(genre_id__in=dup_ids).update(genre_id=keep)
+            genre_model.objects.filter(pk__in=dup_ids).delete()
+            merged['genres'] += len(dup_ids)
+        _write_keys(genre_model, 'name', 'name_key', 100)
+
+    if any(merged.values()):
+        invalidate()
+    return merged
+
+
+def _duplicate_groups(model, group_key, *fields):
+    """Yield (kept_id, [duplicate ids]) for rows sharing the same group key"""
+    groups = {}
+    for row in model.objects.order_by('created_at', 'pk').values('pk', *fields):
+        groups.setdefault(group_key(row), []).append(row['pk'])
+    for ids in groups.values():
+        if len(ids) > 1:
+            yield ids[0], ids[1:]
+
+
+def _write_keys(model, source, key, max_length):
+    """Store the normalized key on every row where it is missing or stale"""
+    stale = []
+    for row in model.objects.only('pk', source, key):
+        value = normalize_name(getattr(row, source), max_length)
+        if getattr(row, key) != value:
+            setattr(row, key, value)
+            stale.append(row)
+    model.objects.bulk_update(stale, [key], batch_size=500)
+
+
+@receiver(post_delete, sender=Artist)
+@receiver(post_delete, sender=Album)
+@receiver(post_delete, sender=Genre)
+def _forget_deleted_entity(sender, **kwargs):
+    invalidate()
@@ -0,0 +1,281 @@
+"""Per-source rate limiting and concurrency slots for download workers
+
+Every source (``MediaDownloader.detect_source()``) gets a token bucket
+limiting how fast jobs may start and a cap on how many run at once. State
+lives in Redis when ``REDIS_URL`` is set, so the limits hold across all
+Celery workers; both checks run in one Lua script, so concurrent workers
+can never overdraw a bucket. Without Redis (development, tests) the same
+algorithm runs in-process.
+
+Running jobs hold a slot as a lease that expires on its own, so a worker
+that dies mid-download cannot leak a slot forever.
+
+Each source also has a circuit breaker: BREAKER_THRESHOLD transient
+failures within BREAKER_WINDOW seconds open it, and no job of that source
+starts for BREAKER_COOLDOWN seconds. The first failure after the cooldown
+(the probation period) opens it again straight away; successes reset it.
+"""
+
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SLOT_LEASE = getattr(settings, 'DOWNLOAD_SLOT_LEASE', 60 * 60)
+# Retry delay for a job waiting on a concurrency slot (no timing is known)
+SLOT_WAIT = 15
+BREAKER_THRESHOLD = getattr(settings, 'DOWNLOAD_BREAKER_THRESHOLD', 5)
+BREAKER_WINDOW = getattr(settings, 'DOWNLOAD_BREAKER_WINDOW', 5 * 60)
+BREAKER_COOLDOWN = getattr(settings, 'DOWNLOAD_BREAKER_COOLDOWN', 10 * 60)
+
+
+class SourceLimits(NamedTuple):
+    rate_per_minute: int  # 0 = unlimited
+    burst: int
+    max_concurrent: int  # 0 = unlimited
+
+
+def limits_for(source: str) -> SourceLimits:
+    """Limits for a source: SystemSettings defaults plus per-source overrides"""
+    from ..models import SystemSettings
+
+    system = SystemSettings.load()
+    overrides = (system.download_source_limits or {}).get(source) or {}
+    return SourceLimits(
+        rate_per_minute=int(overrides.get('rate_per_minute', system.download_rate_per_minute)),
+        burst=max(1, int(overrides.get('burst', system.download_burst))),
+        max_concurrent=int(overrides.get('max_concurrent', system.download_max_concurrent)),
+    )
+
+
+# KEYS: bucket hash, running-jobs sorted set
+# ARGV: now, tokens per second (0 = unlimited), burst, max concurrent, job id, lease, slot wait
+# Returns 0 when the slot was granted, else the seconds to wait (as a string)
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local max_running = tonumber(ARGV[4])
+local job = ARGV[5]
+local lease = tonumber(ARGV[6])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZSCORE', KEYS[2], job) then
+    redis.call('ZADD', KEYS[2], now + lease, job)
+    return 0
+end
+if max_running > 0 and redis.call('ZCARD', KEYS[2]) >= max_running then
+    return ARGV[7]
+end
+
+if rate > 0 then
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + (now - ts) * rate)
+    if tokens < 1 then
+        return tostring((1 - tokens) / rate)
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+end
+
+redis.call('ZADD', KEYS[2], now + lease, job)
+redis.call('EXPIRE', KEYS[2], lease)
+return 0
+"""
+
+# KEYS: failure counter, open flag, probation flag
+# ARGV: threshold, window, cooldown
+# Returns 1 when this failure opened the breaker
+FAILURE_SCRIPT = """
+local threshold = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local cooldown = tonumber(ARGV[3])
+
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+local failures = threshold
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    failures = redis.call('INCR', KEYS[1])
+    if failures == 1 then
+        redis.call('EXPIRE', KEYS[1], window)
+    end
+end
+if failures < threshold then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('SET', KEYS[2], 1, 'EX', cooldown)
+redis.call('SET', KEYS[3], 1, 'EX', cooldown + window)
+return 1
+"""
+
+
+def _breaker_keys(source):
+    return [f'download_breaker:{source}:failures', f'download_breaker:{source}:open',
+            f'download_breaker:{source}:probation']
+
+
+class _RedisBackend:
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.acquire_script = self.client.register_script(ACQUIRE_SCRIPT)
+        self.failure_script = self.client.register_script(FAILURE_SCRIPT)
+
+    def acquire(self, source, job_id, limits, now):
+        wait = self.acquire_script(
+            keys=[f'download_bucket:{source}', f'download_running:{source}'],
+            args=[now, limits.rate_per_minute / 60, limits.burst, limits.max_concurrent,
+                  job_id, SLOT_LEASE, SLOT_WAIT],
+        )
+        return float(wait)
+
+    def release(self, source, job_id):
+        self.client.zrem(f'download_running:{source}', job_id)
+
+    def breaker_wait(self, source, now):
+        ttl = self.client.pttl(_breaker_keys(source)[1])
+        return ttl / 1000 if ttl > 0 else 0.0
+
+    def record_failure(self, source, now):
+        tripped = self.failure_script(
+            keys=_breaker_keys(source),
+            args=[BREAKER_THRESHOLD, BREAKER_WINDOW, BREAKER_COOLDOWN],
+        )
+        return bool(tripped)
+
+    def record_success(self, source):
+        failures, _, probation = _breaker_keys(source)
+        self.client.delete(failures, probation)
+
+
+class _LocalBackend:
+    """Single-process equivalent of the Redis script"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.running = {}
+        # source -> [failures, window ends, open until, probation until]
+        self.breakers = {}
+
+    def acquire(self, source, job_id, limits, now):
+        with self.lock:
+            running = self.running.setdefault(source, {})
+            for job, expires in list(running.items()):
+                if expires <= now:
+                    del running[job]
+            if job_id in running:
+                running[job_id] = now + SLOT_LEASE
+                return 0.0
+            if limits.max_concurrent and len(running) >= limits.max_concurrent:
+                return float(SLOT_WAIT)
+
+            if limits.rate_per_minute:
+                rate = limits.rate_per_minute / 60
+                tokens, ts = self.buckets.get(source, (limits.burst, now))
+                tokens = min(limits.burst, tokens + (now - ts) * rate)
+                if tokens < 1:
+                    return (1 - tokens) / rate
+                self.buckets[source] = (tokens - 1, now)
+
+            running[job_id] = now + SLOT_LEASE
+            return 0.0
+
+    def release(self, source, job_id):
+        with self.lock:
+            self.running.get(source, {}).pop(job_id, None)
+
+    def breaker_wait(self, source, now):
+        with self.lock:
+            breaker = self.breakers.get(source)
+            return max(0.0, breaker[2] - now) if breaker else 0.0
+
+    def record_failure(self, source, now):
+        with self.lock:
+            breaker = self.breakers.setdefault(source, [0, 0.0, 0.0, 0.0])
+            if breaker[2] > now:
+                return False
+            if breaker[3] > now:
+                breaker[0] = BREAKER_THRESHOLD
+            else:
+                if breaker[1] <= now:
+                    breaker[0:2] = [0, now + BREAKER_WINDOW]
+                breaker[0] += 1
+            if breaker[0] < BREAKER_THRESHOLD:
+                return False
+            self.breakers[source] = [0, 0.0, now + BREAKER_COOLDOWN, now + BREAKER_COOLDOWN + BREAKER_WINDOW]
+            return True
+
+    def record_success(self, source):
+        with self.lock:
+            breaker = self.breakers.get(source)
+            if breaker:
+                breaker[0] = 0
+                breaker[3] = 0.0
+
+
+class SourceScheduler:
+    """Grants download jobs a start token and a running slot per source"""
+
+    def __init__(self, backend=None):
+        if backend is None:
+            redis_url = getattr(settings, 'REDIS_URL', '')
+            backend = _RedisBackend(redis_url) if redis_url else _LocalBackend()
+        self.backend = backend
+
+    def acquire(self, source: str, job_id: str) -> float:
+        """
+        Try to start a job.
+
+        Returns:
+            float: 0 when the job may run now, else seconds to wait before
+            asking again. A job that already holds a slot keeps it.
+        """
+        now = time.time()
+        # An open breaker holds back the whole source
+        wait = self.backend.breaker_wait(source, now)
+        if wait:
+            return wait
+        limits = limits_for(source)
+        return self.backend.acquire(source, str(job_id), limits, now)
+
+    def release(self, source: str, job_id: str):
+        """Free the job's running slot"""
+        try:
+            self.backend.release(source, str(job_id))
+        except Exception as e:
+            # The lease expires on its own
+            logger.error(f"Failed to release {source} slot of job {job_id}: {e}")
+
+    def record_failure(self, source: str):
+        """Count a transient failure; enough in a row pause the source"""
+        try:
+            if self.backend.record_failure(source, time.time()):
+                logger.warning(f"Circuit breaker opened for {source}: pausing for {BREAKER_COOLDOWN}s")
+        except Exception as e:
+            logger.error(f"Failed to record {source} failure: {e}")
+
+    def record_success(self, source: str):
+        """Close the source's breaker after a successful job"""
+        try:
+            self.backend.record_success(source)
+        except Exception as e:
+            logger.error(f"Failed to record {source} success: {e}")
+
+
+_scheduler = None
+
+
+def get_scheduler() -> SourceScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = SourceScheduler()
+    return _scheduler
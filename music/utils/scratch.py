@@ -0,0 +1,104 @@
+"""Per-job scratch space for downloads, with a disk quota
+
+Every download works in its own directory, ``downloads/temp/<task id>/``,
+so concurrent jobs never write the same file name and all of a job's
+leftovers (partial streams, earlier transcodes) go away with its directory
+once it finishes.
+
+Scratch lives on the same volume as the library, so the fetch stage waits
+(``space_wait``) while scratch holds more than DOWNLOAD_SCRATCH_QUOTA MB or
+less than DOWNLOAD_SCRATCH_MIN_FREE MB of the disk is free: imports pile up
+in the queue instead of filling the disk that streaming serves from.
+
+Directories of dead or abandoned jobs are reclaimed by
+``reap_stale_downloads`` through ``stale_entries`` once they are older than
+DOWNLOAD_TEMP_MAX_AGE.
+"""
+
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import List
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_DIR = Path('downloads') / 'temp'
+# 0 = unlimited
+SCRATCH_QUOTA = getattr(settings, 'DOWNLOAD_SCRATCH_QUOTA', 10 * 1024) * 1024 * 1024
+SCRATCH_MIN_FREE = getattr(settings, 'DOWNLOAD_SCRATCH_MIN_FREE', 1024) * 1024 * 1024
+# Retry delay for a job waiting on scratch space (no timing is known)
+SPACE_WAIT = 30
+
+
+def scratch_root() -> Path:
+    return Path(settings.MEDIA_ROOT) / SCRATCH_DIR
+
+
+def job_dir(task_id) -> Path:
+    """The task's own scratch directory (created on demand)"""
+    path = scratch_root() / str(task_id)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def release_job_dir(task_id):
+    """Remove the task's scratch directory and everything left in it"""
+    shutil.rmtree(scratch_root() / str(task_id), ignore_errors=True)
+
+
+def scratch_usage() -> int:
+    """Bytes currently held in scratch"""
+    total = 0
+    for dirpath, _, filenames in os.walk(scratch_root()):
+        for name in filenames:
+            try:
+                total += os.stat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                # Removed by its job meanwhile
+                continue
+    return total
+
+
+def space_wait() -> float:
+    """0 when a new job may use scratch now, else seconds to wait"""
+    root = scratch_root()
+    root.mkdir(parents=True, exist_ok=True)
+    if SCRATCH_MIN_FREE and shutil.disk_usage(root).free < SCRATCH_MIN_FREE:
+        logger.warning(f"Less than {SCRATCH_MIN_FREE // (1024 * 1024)}MB free for downloads")
+        return float(SPACE_WAIT)
+    if SCRATCH_QUOTA and scratch_usage() >= SCRATCH_QUOTA:
+        return float(SPACE_WAIT)
+    return 0.0
+
+
+def _last_modified(path: Path) -> float:
+    if not path.is_dir():
+        return path.stat().st_mtime
+    return max([path.stat().st_mtime] + [child.stat().st_mtime for child in path.iterdir()])
+
+
+def stale_entries(max_age: float) -> List[Path]:
+    """Job directories (and loose files) untouched for ``max_age`` seconds"""
+    root = scratch_root()
+    if not root.exists():
+        return []
+    cutoff = time.time() - max_age
+    entries = []
+    for path in root.iterdir():
+        try:
+            if _last_modified(path) < cutoff:
+                entries.append(path)
+        except FileNotFoundError:
+            continue
+    return entries
+
+
+def remove_entry(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
@@ -0,0 +1,365 @@
+"""Streaming and resumable upload handling for audio files
+
+``StreamingAudioUploadHandler`` writes incoming audio chunks straight into
+the track storage directory while computing a SHA-256 and sniffing the
+container header, so an upload is written to disk exactly once and never
+held in worker memory.
+
+Resumable uploads (``ChunkedUpload``) are assembled in place: each ranged
+chunk is streamed from the request into a preallocated ``.part`` file at its
+offset, and the finished file is renamed into ``tracks/``.
+
+Stored audio is content-addressed (``tracks/ab/<sha256>.<ext>``): bytes that
+are already on disk are linked to instead of written again.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from functools import wraps
+from pathlib import Path
+from typing import Optional
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from .metadata import compute_file_hash
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = ('mp3', 'flac', 'ogg', 'm4a', 'wav')
+TRACKS_DIR = 'tracks'
+CHUNKED_DIR = Path('temp') / 'chunked'
+SNIFF_BYTES = 16
+COPY_BLOCK_SIZE = 256 * 1024
+
+
+def sniff_audio_format(header: bytes) -> Optional[str]:
+    """Identify the audio container from the first bytes of a file"""
+    if header.startswith(b'fLaC'):
+        return 'flac'
+    if header.startswith(b'OggS'):
+        return 'ogg'
+    if header.startswith(b'RIFF') and header[8:12] == b'WAVE':
+        return 'wav'
+    if header[4:8] == b'ftyp':
+        return 'm4a'
+    if header.startswith(b'ID3'):
+        return 'mp3'
+    # Bare MPEG audio frame sync (11 set bits)
+    if len(header) >= 2 and header[0] == 0xFF and (header[1] & 0xE0) == 0xE0:
+        return 'mp3'
+    return None
+
+
+def new_track_storage_name(file_name: str) -> str:
+    """Collision-free storage name under tracks/ for bytes not yet hashed"""
+    safe_name = default_storage.get_valid_name(os.path.basename(file_name))
+    return f"{TRACKS_DIR}/{uuid.uuid4().hex[:12]}_{safe_name}"
+
+
+def content_storage_name(content_hash: str, file_name: str) -> str:
+    """Content-addressed storage name: tracks/ab/<sha256>.<ext>"""
+    ext = os.path.splitext(file_name)[1].lower()
+    return f"{TRACKS_DIR}/{content_hash[:2]}/{content_hash}{ext}"
+
+
+def move_into_storage(path, storage_name: str) -> str:
+    """
+    Rename a local file to ``storage_name`` without copying.
+
+    When the blob already exists the identical source is dropped and the
+    existing bytes are reused. Only a source on another filesystem is
+    copied (next to the target, then renamed, so readers never see a
+    partial blob).
+    """
+    target = Path(default_storage.path(storage_name))
+    if target.exists():
+        os.remove(path)
+        return storage_name
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(path, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        part_path = target.with_name(target.name + '.part')
+        shutil.copyfile(path, part_path)
+        os.replace(part_path, target)
+        os.remove(path)
+    return storage_name
+
+
+class StreamedAudioFile(UploadedFile):
+    """An upload that already lives at its final storage location"""
+
+    def __init__(self, path, storage_name, name, content_type, size, charset,
+                 sha256, detected_format, content_type_extra=None):
+        file = open(path, 'rb')
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.storage_name = storage_name
+        self.sha256 = sha256
+        self.detected_format = detected_format
+        self.claimed = False
+        self._path = path
+
+    def temporary_file_path(self):
+        """Absolute path of the stored bytes (lets probes read it in place)"""
+        return self._path
+
+    def store_as(self, storage_name):
+        """Move the bytes to their content-addressed name and claim them"""
+        self.close()
+        move_into_storage(self._path, storage_name)
+        self.storage_name = storage_name
+        self._path = default_storage.path(storage_name)
+        self.claimed = True
+        return storage_name
+
+    def discard(self):
+        """Delete the stored bytes when the upload is rejected"""
+        try:
+            self.close()
+        except Exception:
+            pass
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Failed to discard rejected upload {self._path}: {e}")
+
+
+class StreamingAudioUploadHandler(FileUploadHandler):
+    """
+    Upload handler that streams audio files directly into ``tracks/``.
+
+    Non-audio files (e.g. cover images) are passed on to the next handler.
+    Bytes beyond MAX_UPLOAD_SIZE are counted but not written, so the view can
+    reject the upload with an accurate size.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.activated = False
+        self.max_size = getattr(settings, 'MAX_UPLOAD_SIZE', 100 * 1024 * 1024)
+
+    def new_file(self, field_name, file_name, content_type, content_length,
+                 charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length,
+                         charset, content_type_extra)
+        ext = os.path.splitext(file_name)[1][1:].lower()
+        self.activated = ext in AUDIO_EXTENSIONS and self._storage_is_local()
+        if not self.activated:
+            return
+
+        self.storage_name = new_track_storage_name(file_name)
+        self.final_path = Path(default_storage.path(self.storage_name))
+        self.final_path.parent.mkdir(parents=True, exist_ok=True)
+        self.part_path = self.final_path.with_name(self.final_path.name + '.part')
+
+        self.destination = open(self.part_path, 'wb')
+        self.digest = hashlib.sha256()
+        self.header = b''
+        self.received = 0
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.activated:
+            return raw_data
+
+        self.received += len(raw_data)
+        if self.received > self.max_size:
+            return None
+
+        if len(self.header) < SNIFF_BYTES:
+            self.header += raw_data[:SNIFF_BYTES - len(self.header)]
+        self.digest.update(raw_data)
+        self.destination.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.activated:
+            return None
+
+        self.activated = False
+        self.destination.close()
+        os.replace(self.part_path, self.final_path)
+
+        return StreamedAudioFile(
+            path=str(self.final_path),
+            storage_name=self.storage_name,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=self.received,
+            charset=self.charset,
+            sha256=self.digest.hexdigest(),
+            detected_format=sniff_audio_format(self.header),
+            content_type_extra=self.content_type_extra,
+        )
+
+    def upload_interrupted(self):
+        if not self.activated:
+            return
+        self.activated = False
+        try:
+            self.destination.close()
+            os.remove(self.part_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _storage_is_local():
+        try:
+            default_storage.path('')
+            return True
+        except NotImplementedError:
+            return False
+
+
+def stream_audio_uploads(view_func):
+    """
+    Enable StreamingAudioUploadHandler for a view.
+
+    Upload handlers must be installed before CSRF middleware reads
+    request.POST, so the view is exempted and re-protected here as described
+    in the Django upload handler docs. Streamed files the view did not claim
+    (rejected requests, CSRF/auth failures, errors) are removed afterwards.
+    """
+    protected_view = csrf_protect(view_func)
+
+    @csrf_exempt
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        request.upload_handlers.insert(0, StreamingAudioUploadHandler(request))
+        try:
+            return protected_view(request, *args, **kwargs)
+        finally:
+            _discard_unclaimed(request)
+
+    return wrapper
+
+
+def _discard_unclaimed(request):
+    files = getattr(request, '_files', None)
+    if not files:
+        return
+    for _, uploads in files.lists():
+        for upload in uploads:
+            if isinstance(upload, StreamedAudioFile) and not upload.claimed:
+                upload.discard()
+
+
+def file_field_value(upload):
+    """Value to assign to a FileField: the stored name for streamed uploads"""
+    if isinstance(upload, StreamedAudioFile):
+        upload.claimed = True
+        return upload.storage_name
+    return upload
+
+
+def upload_content_hash(upload) -> str:
+    """SHA-256 of an upload (free for streamed uploads, hashed once otherwise)"""
+    content_hash = getattr(upload, 'sha256', None)
+    if not content_hash:
+        content_hash = compute_file_hash(upload)
+        upload.sha256 = content_hash
+    return content_hash
+
+
+def store_upload(upload) -> str:
+    """Content-addressed storage name for an upload, writing it only if new"""
+    storage_name = content_storage_name(upload_content_hash(upload), upload.name)
+    if isinstance(upload, StreamedAudioFile):
+        return upload.store_as(storage_name)
+    if default_storage.exists(storage_name):
+        return storage_name
+    return default_storage.save(storage_name, upload)
+
+
+def discard_upload(upload):
+    """Remove a rejected upload's bytes if they were not stored yet"""
+    if isinstance(upload, StreamedAudioFile) and not upload.claimed:
+        upload.discard()
+
+
+# ============================================================================
+# Resumable chunked uploads
+# ============================================================================
+
+def chunk_part_path(upload_id) -> Path:
+    """Location of the partially assembled file for a ChunkedUpload"""
+    return Path(settings.MEDIA_ROOT) / CHUNKED_DIR / f"{upload_id}.part"
+
+
+def allocate_chunked_file(upload_id, total_size: int) -> Path:
+    """Create the (sparse) target file so chunks can land at any offset"""
+    path = chunk_part_path(upload_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'ab') as f:
+        f.truncate(total_size)
+    return path
+
+
+def write_chunk(upload_id, offset: int, stream, length: int) -> int:
+    """
+    Stream ``length`` bytes from ``stream`` into the part file at ``offset``.
+
+    Data is copied in small blocks with positional writes, so parallel chunk
+    requests for the same file never buffer a whole chunk or clobber each
+    other's file position.
+
+    Returns:
+        int: Number of bytes actually written (short if the client hung up)
+    """
+    fd = os.open(chunk_part_path(upload_id), os.O_WRONLY)
+    written = 0
+    try:
+        while written < length:
+            block = stream.read(min(COPY_BLOCK_SIZE, length - written))
+            if not block:
+                break
+            os.pwrite(fd, block, offset + written)
+            written += len(block)
+    finally:
+        os.close(fd)
+    return written
+
+
+def sniff_file_format(path) -> Optional[str]:
+    """Run the container sniffer against a file on disk"""
+    with open(path, 'rb') as f:
+        return sniff_audio_format(f.read(SNIFF_BYTES))
+
+
+def promote_chunked_file(upload_id, file_name: str, content_hash: str) -> str:
+    """Move a fully assembled part file into content-addressed storage"""
+    return move_into_storage(
+        chunk_part_path(upload_id), content_storage_name(content_hash, file_name)
+    )
+
+
+def restore_chunked_file(upload_id, storage_name: str):
+    """Give a promoted upload its part file back (when finalize fails)"""
+    part_path = chunk_part_path(upload_id)
+    if not part_path.exists():
+        os.link(default_storage.path(storage_name), part_path)
+
+
+def discard_chunked_file(upload_id):
+    """Remove a part file (abandoned or rejected upload)"""
+    try:
+        chunk_part_path(upload_id).unlink()
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Failed to remove chunked upload {upload_id}: {e}")
@@ -0,0 +1,38 @@
+"""Waveform peak generation for the player"""
+
+import logging
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+WAVEFORM_POINTS = 200
+
+
+def generate_waveform(path, points: int = WAVEFORM_POINTS) -> Optional[List[float]]:
+    """
+    Compute ``points`` normalized peak amplitudes (0..1) across a track.
+
+    WAV is decoded natively by pydub; other formats need ffmpeg on PATH.
+    Returns None when the file can't be decoded.
+    """
+    try:
+        from pydub import AudioSegment
+    except ImportError:
+        logger.warning('pydub not installed. Waveform generation disabled.')
+        return None
+
+    try:
+        audio = AudioSegment.from_file(path).set_channels(1)
+    except Exception as e:
+        logger.error(f"Waveform decode failed for {path}: {e}")
+        return None
+
+    if not len(audio):
+        return None
+
+    step = len(audio) / points
+    ceiling = float(audio.max_possible_amplitude) or 1.0
+    return [
+        round(audio[int(i * step):int((i + 1) * step) or 1].max / ceiling, 4)
+        for i in range(points)
+    ]
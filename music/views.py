@@ -3,65 +3,38 @@ from django.http import FileResponse, JsonResponse, HttpResponse, Http404
 from django.views.decorators.http import require_http_methods
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from django.utils.html import escape
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
-from .models import MusicFile, Artist, Album, Genre, DownloadTask
+from .models import MusicFile, Artist, Album, Genre, DownloadTask, UploadSession, ChunkedUpload
 from .forms import URLImportForm
+from .utils.catalog import bulk_create_tracks, find_tracks_by_hash
+from .utils.metadata import compute_file_hash, probe_audio
+from .utils.uploads import (
+    stream_audio_uploads, discard_upload, store_upload, upload_content_hash,
+    allocate_chunked_file, write_chunk, chunk_part_path, sniff_file_format,
+    promote_chunked_file, restore_chunked_file, discard_chunked_file,
+)
 import os
+import re
+import json
 import mimetypes
 import logging
 
-try:
-    from mutagen import File as MutagenFile
-    from mutagen.id3 import ID3, APIC
-    from mutagen.mp3 import MP3
-    from mutagen.flac import FLAC
-    MUTAGEN_AVAILABLE = True
-except ImportError:
-    MUTAGEN_AVAILABLE = False
-    logging.warning('Mutagen not installed. Metadata extraction disabled.')
-
 logger = logging.getLogger(__name__)
 PAGES_PER_PAGE = 12
 
+TAG_FIELDS = ('title', 'artist', 'album', 'year', 'genre', 'artwork', 'artwork_mime')
+
+
 def extract_metadata(file_path):
-    """Extract metadata from audio file using mutagen"""
-    if not MUTAGEN_AVAILABLE:
-        return {}
-    
-    try:
-        audio = MutagenFile(file_path, easy=True)
-        if audio is None:
-            return {}
-        
-        metadata = {
-            'title': audio.get('title', [None])[0],
-            'artist': audio.get('artist', [None])[0] or audio.get('albumartist', [None])[0],
-            'album': audio.get('album', [None])[0],
-            'year': audio.get('date', [None])[0],
-            'genre': audio.get('genre', [None])[0],
-        }
-        
-        # Extract album art
-        try:
-            audio_full = MutagenFile(file_path)
-            if hasattr(audio_full, 'tags'):
-                for key in audio_full.tags.keys():
-                    if key.startswith('APIC'):
-                        artwork = audio_full.tags[key]
-                        metadata['artwork'] = artwork.data
-                        metadata['artwork_mime'] = artwork.mime
-                        break
-        except Exception as e:
-            logger.debug(f"Could not extract artwork: {e}")
-        
-        return {k: v for k, v in metadata.items() if v}
-    except Exception as e:
-        logger.error(f"Metadata extraction error: {e}")
-        return {}
+    """Extract tags and embedded artwork from an audio file (single cached probe)"""
+    metadata = probe_audio(file_path)
+    return {k: metadata[k] for k in TAG_FIELDS if metadata.get(k)}
 
 def index(request):
     """Display homepage with music list, search, and filters"""
@@ -131,6 +104,16 @@ def player(request, pk):
     }
     return render(request, 'music/player.html', context)
 
+def _download_filename(music_file):
+    """
+    "Artist - Title.ext" for Content-Disposition (stored files are named by
+    content hash); FileResponse adds the RFC 5987 form for non-ASCII names.
+    """
+    name = f"{music_file.artist.name} - {music_file.title}"
+    # No path separators, quotes or control characters in a saved file name
+    name = ' '.join(re.sub(r'[\x00-\x1f\x7f/\\:*?"<>|]', ' ', name).split()).strip('.') or 'track'
+    return f"{name[:200]}{os.path.splitext(music_file.file.name)[1]}"
+
 @require_http_methods(["GET"])
 def stream_music(request, pk):
     """Stream music file with byte-range support readiness"""
@@ -142,8 +125,9 @@ def stream_music(request, pk):
     content_type, _ = mimetypes.guess_type(file_path)
     
     # FileResponse handles streaming and range requests efficiently
-    response = FileResponse(open(file_path, 'rb'), content_type=content_type)
-    response['Content-Disposition'] = f'inline; filename="{os.path.basename(file_path)}"'
+    response = FileResponse(
+        open(file_path, 'rb'), content_type=content_type, filename=_download_filename(music_file)
+    )
     response['Accept-Ranges'] = 'bytes'
     response['X-Content-Type-Options'] = 'nosniff'
     return response
@@ -160,51 +144,128 @@ def download_music(request, pk):
     except Exception as e:
         logger.error(f"Download tracking error: {e}")
         
-    response = FileResponse(open(music_file.file.path, 'rb'))
-    response['Content-Disposition'] = f'attachment; filename="{os.path.basename(music_file.file.path)}"'
+    response = FileResponse(
+        open(music_file.file.path, 'rb'), as_attachment=True, filename=_download_filename(music_file)
+    )
     return response
 
+def _audio_upload_error(file, max_size):
+    """Validation message for an uploaded audio file, or None when acceptable"""
+    if file.size > max_size:
+        return f'File too large (max {max_size // (1024*1024)}MB)'
+    ext = os.path.splitext(file.name)[1].lower()
+    if ext not in ['.mp3', '.flac', '.ogg', '.wav', '.m4a'] or not getattr(file, 'detected_format', ext[1:]):
+        return 'Unsupported file format'
+    return None
+
+
+def _upload_entry(file):
+    """Persist an accepted upload and describe it for bulk_create_tracks"""
+    ext = os.path.splitext(file.name)[1].lower()
+    return {
+        'filename': file.name,
+        'format': getattr(file, 'detected_format', None) or ext[1:],
+        'content_hash': upload_content_hash(file),
+        'storage_name': store_upload(file),
+    }
+
+
+def _discard_new_blob(storage_name):
+    """Delete a freshly stored blob unless a track already links to it"""
+    if not MusicFile.objects.filter(file=storage_name).exists():
+        default_storage.delete(storage_name)
+
+
+def _duplicate_payload(track):
+    return {
+        'id': str(track.id),
+        'title': track.title,
+        'status': track.processing_status,
+        'duplicate': True,
+        'message': 'Track already in library'
+    }
+
+
+def _queue_enrichment(tracks, session=None, overrides=None):
+    """Hand placeholder tracks to the Celery enrichment pipeline after commit"""
+    from .tasks import enrich_uploaded_tracks
+    track_ids = list(dict.fromkeys(str(track.id) for track in tracks))
+    session_id = str(session.id) if session else None
+    transaction.on_commit(
+        lambda: enrich_uploaded_tracks.delay(track_ids, session_id, overrides or {})
+    )
+
+
+def _single_upload_session(request):
+    """UploadSession for a one-file upload (anonymous uploads are not tracked)"""
+    if not request.user.is_authenticated:
+        return None
+    return UploadSession.objects.create(user=request.user, total_files=1, status='processing')
+
+
+@stream_audio_uploads
 @require_http_methods(["POST"])
 def upload_music(request):
-    """Secure AJAX upload endpoint"""
+    """Secure AJAX upload endpoint; tags, artwork and probing run in Celery"""
     if 'file' not in request.FILES:
         return JsonResponse({'error': 'No file provided'}, status=400)
     
     file = request.FILES['file']
     max_size = getattr(settings, 'MAX_UPLOAD_SIZE', 100 * 1024 * 1024)
-    if file.size > max_size:
-        return JsonResponse({'error': f'File too large (max {max_size // (1024*1024)}MB)'}, status=400)
-        
-    title = escape(request.POST.get('title', file.name))
-    artist_name = escape(request.POST.get('artist', 'Unknown Artist'))
+    error = _audio_upload_error(file, max_size)
+    if error:
+        discard_upload(file)
+        return JsonResponse({'error': error}, status=400)
+    
+    # Identical bytes are never stored twice: hand back the existing track
+    content_hash = upload_content_hash(file)
+    duplicate = find_tracks_by_hash([content_hash]).get(content_hash)
+    if duplicate:
+        discard_upload(file)
+        return JsonResponse(_duplicate_payload(duplicate))
     
+    overrides = {
+        key: escape(request.POST.get(key, '').strip())
+        for key in ('title', 'artist')
+    }
+    
+    entry = None
     try:
-        artist, _ = Artist.objects.get_or_create(name=artist_name)
-        
-        # File extension validation
-        ext = os.path.splitext(file.name)[1].lower()
-        if ext not in ['.mp3', '.flac', '.ogg', '.wav', '.m4a']:
-            return JsonResponse({'error': 'Unsupported file format'}, status=400)
-            
-        music_file = MusicFile.objects.create(
-            title=title,
-            artist=artist,
-            file=file,
-            format=ext[1:]
-        )
+        entry = _upload_entry(file)
+        with transaction.atomic():
+            session = _single_upload_session(request)
+            music_file = bulk_create_tracks(
+                [entry], overrides, processing_status='processing'
+            )[0]
+            _queue_enrichment([music_file], session, overrides)
         
         return JsonResponse({
             'id': str(music_file.id),
             'title': music_file.title,
+            'status': music_file.processing_status,
+            'session_id': str(session.id) if session else None,
             'message': 'Upload successful'
         })
+    except IntegrityError:
+        # The same bytes were uploaded concurrently and won the unique index
+        duplicate = find_tracks_by_hash([content_hash]).get(content_hash)
+        if duplicate:
+            return JsonResponse(_duplicate_payload(duplicate))
+        logger.error(f"Upload integrity error for {content_hash}")
+        return JsonResponse({'error': 'Internal server error during upload'}, status=500)
     except Exception as e:
         logger.error(f"Upload error: {e}")
+        discard_upload(file)
+        if entry:
+            _discard_new_blob(entry['storage_name'])
         return JsonResponse({'error': 'Internal server error during upload'}, status=500)
 
+@stream_audio_uploads
 def upload_page(request):
-    """Handle music upload page with form processing and metadata extraction"""
+    """Handle music upload page; the file is stored now and enriched in the background"""
     if request.method == 'POST':
+        file = None
+        entry = None
         try:
             # Validate file presence
             if 'file' not in request.FILES:
@@ -218,114 +279,375 @@ def upload_page(request):
             if file.size > max_size:
                 max_size_mb = max_size // (1024 * 1024)
                 messages.error(request, f'Файл слишком большой (максимум {max_size_mb}MB). Размер файла: {file.size // (1024*1024)}MB')
+                discard_upload(file)
                 return render(request, 'music/upload.html')
             
-            # File format validation
+            # File format validation (extension, then sniffed header when streamed)
             ext = os.path.splitext(file.name)[1].lower()
-            if ext not in ['.mp3', '.flac', '.ogg', '.wav', '.m4a']:
+            if _audio_upload_error(file, max_size):
                 messages.error(request, f'Неподдерживаемый формат: {ext}')
+                discard_upload(file)
                 return render(request, 'music/upload.html')
             
-            # Save file temporarily to extract metadata
-            temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_path = os.path.join(temp_dir, file.name)
-            
-            with open(temp_path, 'wb+') as temp_file:
-                for chunk in file.chunks():
-                    temp_file.write(chunk)
-            
-            # Extract metadata from file
-            metadata = extract_metadata(temp_path)
-            logger.info(f"Extracted metadata: {metadata.keys()}")
+            # Identical bytes are never stored twice
+            content_hash = upload_content_hash(file)
+            duplicate = find_tracks_by_hash([content_hash]).get(content_hash)
+            if duplicate:
+                discard_upload(file)
+                messages.info(request, f'Трек "{duplicate.title}" уже есть в библиотеке')
+                return redirect('music:index')
             
-            # Get form data with fallback to extracted metadata
-            title = escape(request.POST.get('title', '').strip()) or metadata.get('title') or os.path.splitext(file.name)[0]
-            artist_name = escape(request.POST.get('artist', '').strip()) or metadata.get('artist') or 'Unknown Artist'
-            album_name = escape(request.POST.get('album', '').strip()) or metadata.get('album', '')
-            year = request.POST.get('year', '').strip() or (metadata.get('year', '')[:4] if metadata.get('year') else '')
-            genre_names = request.POST.getlist('genres') or ([metadata.get('genre')] if metadata.get('genre') else [])
+            # Explicit form values win over tags read later by the enrichment task
+            genre_names = request.POST.getlist('genres')
+            overrides = {
+                'title': escape(request.POST.get('title', '').strip()),
+                'artist': escape(request.POST.get('artist', '').strip()),
+                'album': escape(request.POST.get('album', '').strip()),
+                'year': request.POST.get('year', '').strip(),
+                'genre': genre_names[0] if genre_names else '',
+            }
             
-            if not title:
-                messages.error(request, 'Название трека обязательно')
-                os.remove(temp_path)
-                return render(request, 'music/upload.html')
-            
-            # Create or get artist
-            artist, _ = Artist.objects.get_or_create(name=artist_name)
-            
-            # Create or get album if provided
-            album = None
-            if album_name:
-                album_data = {'title': album_name}
-                if year and year.isdigit():
-                    album_data['year'] = int(year)
-                album, _ = Album.objects.get_or_create(
-                    title=album_name,
-                    artist=artist,
-                    defaults=album_data
-                )
-            
-            # Get or create genre (first one from the list)
-            genre = None
-            if genre_names and genre_names[0]:
-                genre, _ = Genre.objects.get_or_create(name=genre_names[0])
-            
-            # Reset file pointer
-            file.seek(0)
-            
-            # Create music file
-            music_file = MusicFile.objects.create(
-                title=title,
-                artist=artist,
-                album=album,
-                genre=genre,
-                file=file,
-                format=ext[1:]
-            )
-            
-            # Handle manually uploaded cover image FIRST (priority)
-            if 'cover' in request.FILES:
-                cover_file = request.FILES['cover']
-                if cover_file.size <= 5 * 1024 * 1024:  # 5MB max for images
-                    music_file.cover_image = cover_file
-                    music_file.save(update_fields=['cover_image'])
-                    logger.info(f"Saved manual cover image for {music_file.id}")
-            
-            # Handle embedded artwork from metadata (fallback)
-            elif 'artwork' in metadata and 'artwork_mime' in metadata:
-                try:
-                    artwork_ext = metadata['artwork_mime'].split('/')[-1]
-                    if artwork_ext == 'jpeg':
-                        artwork_ext = 'jpg'
-                    filename = f"{music_file.id}_cover.{artwork_ext}"
-                    music_file.cover_image.save(filename, ContentFile(metadata['artwork']), save=True)
-                    logger.info(f"Saved embedded artwork for {music_file.id}")
-                except Exception as e:
-                    logger.error(f"Failed to save embedded artwork: {e}")
-            
-            # Clean up temp file
-            try:
-                os.remove(temp_path)
-            except:
-                pass
+            entry = _upload_entry(file)
+            with transaction.atomic():
+                session = _single_upload_session(request)
+                music_file = bulk_create_tracks(
+                    [entry], overrides, processing_status='processing'
+                )[0]
+                
+                # Manually uploaded cover image takes priority over embedded artwork
+                if 'cover' in request.FILES:
+                    cover_file = request.FILES['cover']
+                    if cover_file.size <= 5 * 1024 * 1024:  # 5MB max for images
+                        music_file.cover_image = cover_file
+                        music_file.save(update_fields=['cover_image'])
+                        logger.info(f"Saved manual cover image for {music_file.id}")
+                
+                _queue_enrichment([music_file], session, overrides)
             
-            messages.success(request, f'✅ Трек "{title}" успешно загружен!')
+            messages.success(request, f'✅ Трек "{music_file.title}" загружен и обрабатывается')
             return redirect('music:index')
             
         except Exception as e:
             logger.error(f"Upload error in upload_page: {e}", exc_info=True)
             messages.error(request, f'Ошибка загрузки: {str(e)}')
-            try:
-                if 'temp_path' in locals() and os.path.exists(temp_path):
-                    os.remove(temp_path)
-            except:
-                pass
+            if file is not None:
+                discard_upload(file)
+            if entry:
+                _discard_new_blob(entry['storage_name'])
             return render(request, 'music/upload.html')
     
     return render(request, 'music/upload.html')
 
 
+@stream_audio_uploads
+@login_required
+@require_http_methods(["POST"])
+def upload_batch(request):
+    """
+    Upload many files in one multipart request (field name ``files``).
+    
+    Placeholder tracks for the whole batch are inserted with one
+    bulk_create and enriched (tags, artwork, waveform) by a single Celery
+    task. Files whose bytes are already in the library are reported as
+    duplicates of the existing track instead of being stored again.
+    Optional ``artist``/``album``/``genre`` fields override tags for every
+    file. Poll the returned session for progress.
+    """
+    files = request.FILES.getlist('files')
+    if not files:
+        return JsonResponse({'error': 'No files provided'}, status=400)
+    
+    max_size = getattr(settings, 'MAX_UPLOAD_SIZE', 100 * 1024 * 1024)
+    session = UploadSession.objects.create(
+        user=request.user, total_files=len(files), status='processing'
+    )
+    
+    results = []
+    accepted = []
+    for file in files:
+        error = _audio_upload_error(file, max_size)
+        if error:
+            discard_upload(file)
+            results.append({'filename': file.name, 'status': 'failed', 'error': error})
+            continue
+        
+        accepted.append((file, len(results)))
+        results.append({'filename': file.name, 'status': 'pending'})
+    
+    existing = find_tracks_by_hash(upload_content_hash(file) for file, _ in accepted)
+    entries = []
+    duplicates = 0
+    for file, index in accepted:
+        track = existing.get(upload_content_hash(file))
+        if track:
+            discard_upload(file)
+            results[index].update({'status': 'duplicate', 'id': str(track.id), 'title': track.title})
+            duplicates += 1
+            continue
+        entries.append(dict(_upload_entry(file), result=index))
+    
+    defaults = {
+        key: escape(request.POST.get(key, '').strip())
+        for key in ('artist', 'album', 'genre')
+    }
+    
+    try:
+        with transaction.atomic():
+            tracks = bulk_create_tracks(entries, defaults, processing_status='processing')
+            _queue_enrichment(tracks, session, defaults)
+        seen = set()
+        for entry, track in zip(entries, tracks):
+            # Repeated bytes within the batch share the first file's track
+            status = 'duplicate' if track.id in seen else 'processing'
+            duplicates += status == 'duplicate'
+            seen.add(track.id)
+            results[entry['result']].update({
+                'status': status, 'id': str(track.id), 'title': track.title
+            })
+    except Exception as e:
+        logger.error(f"Batch upload error: {e}", exc_info=True)
+        for entry in entries:
+            _discard_new_blob(entry['storage_name'])
+            results[entry['result']].update({'status': 'failed', 'error': 'Internal server error'})
+    
+    # New files are counted by the enrichment task once processed
+    failures = [f"{r['filename']}: {r['error']}" for r in results if r['status'] == 'failed']
+    if failures or duplicates:
+        session.record_results(duplicates, len(failures), failures)
+    else:
+        session.refresh_from_db()
+    
+    return JsonResponse({
+        'session_id': str(session.id),
+        'successful_uploads': session.successful_uploads,
+        'failed_uploads': session.failed_uploads,
+        'results': results,
+    })
+
+
+# ============================================================================
+# Resumable chunked uploads
+# ============================================================================
+
+def _chunked_upload_payload(upload):
+    return {
+        'id': str(upload.id),
+        'filename': upload.filename,
+        'total_size': upload.total_size,
+        'bytes_received': upload.bytes_received,
+        'received_ranges': upload.received_ranges,
+        'missing_ranges': upload.missing_ranges,
+        'status': upload.status,
+        'track_id': str(upload.result_track_id) if upload.result_track_id else None,
+        'error': upload.error_message,
+    }
+
+
+def _upload_session_payload(session):
+    return {
+        'session_id': str(session.id),
+        'status': session.status,
+        'total_files': session.total_files,
+        'successful_uploads': session.successful_uploads,
+        'failed_uploads': session.failed_uploads,
+        'chunk_size': settings.UPLOAD_CHUNK_SIZE,
+        'uploads': [_chunked_upload_payload(u) for u in session.chunked_uploads.all()],
+    }
+
+
+@login_required
+@require_http_methods(["POST"])
+def upload_session_create(request):
+    """Open a resumable upload session: {"files": [{"name": ..., "size": ...}]}"""
+    try:
+        files = json.loads(request.body).get('files') or []
+    except (ValueError, AttributeError):
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+    
+    if not files:
+        return JsonResponse({'error': 'No files declared'}, status=400)
+    
+    max_size = getattr(settings, 'MAX_UPLOAD_SIZE', 100 * 1024 * 1024)
+    declared = []
+    for entry in files:
+        name = os.path.basename(str(entry.get('name', '')))
+        try:
+            size = int(entry.get('size', 0))
+        except (TypeError, ValueError):
+            size = 0
+        ext = os.path.splitext(name)[1].lower()
+        if ext not in ['.mp3', '.flac', '.ogg', '.wav', '.m4a']:
+            return JsonResponse({'error': f'Unsupported file format: {name}'}, status=400)
+        if not 0 < size <= max_size:
+            return JsonResponse({'error': f'Invalid file size for {name} (max {max_size // (1024*1024)}MB)'}, status=400)
+        declared.append((name, size))
+    
+    with transaction.atomic():
+        session = UploadSession.objects.create(user=request.user, total_files=len(declared))
+        ChunkedUpload.objects.bulk_create([
+            ChunkedUpload(session=session, filename=name, total_size=size)
+            for name, size in declared
+        ])
+    
+    for upload in session.chunked_uploads.all():
+        allocate_chunked_file(upload.id, upload.total_size)
+    
+    return JsonResponse(_upload_session_payload(session), status=201)
+
+
+@login_required
+@require_http_methods(["GET"])
+def upload_session_status(request, pk):
+    """Report per-file progress so clients can resume after a disconnect"""
+    session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+    return JsonResponse(_upload_session_payload(session))
+
+
+@login_required
+@require_http_methods(["PUT"])
+def upload_chunk(request, pk):
+    """Write one chunk at ?offset=N; chunks may arrive in any order or in parallel"""
+    upload = get_object_or_404(ChunkedUpload, pk=pk, session__user=request.user)
+    if upload.status != 'uploading':
+        return JsonResponse({'error': f'Upload is {upload.status}'}, status=409)
+    
+    try:
+        offset = int(request.GET.get('offset', ''))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'offset and Content-Length are required'}, status=400)
+    
+    if length <= 0 or length > settings.UPLOAD_CHUNK_SIZE:
+        return JsonResponse({'error': f'Chunk must be 1..{settings.UPLOAD_CHUNK_SIZE} bytes'}, status=400)
+    if offset < 0 or offset + length > upload.total_size:
+        return JsonResponse({'error': 'Chunk outside declared file size'}, status=416)
+    
+    written = write_chunk(upload.id, offset, request, length)
+    if written:
+        with transaction.atomic():
+            upload = ChunkedUpload.objects.select_for_update().get(pk=pk)
+            upload.add_range(offset, offset + written)
+        UploadSession.objects.filter(pk=upload.session_id, status='pending').update(status='processing')
+    
+    if written < length:
+        return JsonResponse({**_chunked_upload_payload(upload), 'error': 'Incomplete chunk'}, status=400)
+    return JsonResponse(_chunked_upload_payload(upload))
+
+
+def _finalize_chunked_uploads(session, uploads):
+    """
+    Turn fully received chunked uploads into placeholder tracks with one
+    bulk insert and queue their enrichment.
+    
+    Uploads whose bytes are already in the library are linked to the
+    existing track and their part files dropped. Must run inside a
+    transaction with the uploads row-locked. Returns the number of such
+    duplicates and a list of failure messages; new tracks are counted by the
+    enrichment task.
+    """
+    candidates = []
+    failures = []
+    for upload in uploads:
+        part_path = chunk_part_path(upload.id)
+        detected_format = sniff_file_format(part_path)
+        if not detected_format:
+            upload.status = 'failed'
+            upload.error_message = 'Unsupported audio format'
+            upload.save(update_fields=['status', 'error_message', 'updated_at'])
+            discard_chunked_file(upload.id)
+            failures.append(f"{upload.filename}: {upload.error_message}")
+            continue
+        candidates.append((upload, detected_format, compute_file_hash(part_path)))
+    
+    existing = find_tracks_by_hash(content_hash for _, _, content_hash in candidates)
+    linked = []
+    entries = []
+    for upload, detected_format, content_hash in candidates:
+        if content_hash in existing:
+            discard_chunked_file(upload.id)
+            upload.result_track = existing[content_hash]
+            linked.append(upload)
+            continue
+        entries.append({
+            'upload': upload,
+            'filename': upload.filename,
+            'format': detected_format,
+            'content_hash': content_hash,
+            'storage_name': promote_chunked_file(upload.id, upload.filename, content_hash),
+        })
+    
+    try:
+        tracks = bulk_create_tracks(entries, processing_status='processing')
+    except Exception:
+        # Put the bytes back so the client can retry finalize
+        for entry in entries:
+            restore_chunked_file(entry['upload'].id, entry['storage_name'])
+        for storage_name in {entry['storage_name'] for entry in entries}:
+            _discard_new_blob(storage_name)
+        raise
+    
+    seen = set()
+    for entry, track in zip(entries, tracks):
+        entry['upload'].result_track = track
+        if track.id in seen:
+            linked.append(entry['upload'])
+        seen.add(track.id)
+    
+    for upload in uploads:
+        if upload.result_track_id:
+            upload.status = 'complete'
+    ChunkedUpload.objects.bulk_update(
+        [upload for upload in uploads if upload.status == 'complete'],
+        ['status', 'result_track']
+    )
+    if tracks:
+        _queue_enrichment(tracks, session)
+    return len(linked), failures
+
+
+@login_required
+@require_http_methods(["POST"])
+def upload_finalize(request, pk):
+    """Turn a fully received chunked upload into a track"""
+    with transaction.atomic():
+        upload = get_object_or_404(
+            ChunkedUpload.objects.select_for_update().select_related('session'),
+            pk=pk, session__user=request.user
+        )
+        if upload.status == 'complete':
+            return JsonResponse(_chunked_upload_payload(upload))
+        if upload.status != 'uploading':
+            return JsonResponse({'error': f'Upload is {upload.status}'}, status=409)
+        if not upload.is_complete:
+            return JsonResponse({**_chunked_upload_payload(upload), 'error': 'Upload incomplete'}, status=409)
+        
+        linked, failures = _finalize_chunked_uploads(upload.session, [upload])
+    
+    if linked or failures:
+        upload.session.record_results(linked, len(failures), failures)
+    return JsonResponse(_chunked_upload_payload(upload), status=400 if failures else 200)
+
+
+@login_required
+@require_http_methods(["POST"])
+def upload_session_finalize(request, pk):
+    """Finalize every fully received upload in a session with bulk writes"""
+    session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+    with transaction.atomic():
+        pending = [
+            upload for upload in
+            session.chunked_uploads.select_for_update().filter(status='uploading')
+            if upload.is_complete
+        ]
+        linked, failures = _finalize_chunked_uploads(session, pending)
+    
+    if linked or failures:
+        session.record_results(linked, len(failures), failures)
+    else:
+        session.refresh_from_db()
+    return JsonResponse(_upload_session_payload(session))
+
+
 @login_required
 def url_import(request):
     """Handle URL import with enhanced validation"""
@@ -333,21 +655,30 @@ def url_import(request):
         form = URLImportForm(request.POST)
         if form.is_valid():
             try:
-                # Create download task
+                from .utils.downloader import MediaDownloader, canonical_media_id
+                url = form.cleaned_data['url']
+                
+                # Create download task, keyed by its canonical media id
                 task = DownloadTask.objects.create(
                     user=request.user,
-                    url=form.cleaned_data['url'],
-                    source_type=form.cleaned_data.get('source_type', 'url'),
+                    url=url,
+                    source_type=MediaDownloader.detect_source(url),
+                    media_id=(canonical_media_id(url) or '')[:255],
                     output_format=form.cleaned_data.get('output_format', 'mp3'),
                     output_quality=form.cleaned_data.get('output_quality', '320k')
                 )
                 
+                # Imported before with the same settings: done right away
+                if task.complete_from_existing():
+                    messages.success(request, 'Track is already in the library')
+                    return redirect('music:download_manager')
+                
                 # Queue background download
-                from .tasks import process_download_task
-                process_download_task.delay(str(task.id))
+                from .tasks import resume_download
+                resume_download(task)
                 
                 messages.success(request, f'Download task created: {task.id}')
-                return redirect('download_manager')
+                return redirect('music:download_manager')
             except Exception as e:
                 logger.error(f"URL import error: {e}")
                 messages.error(request, 'Failed to create download task')
@@ -361,16 +692,38 @@ def url_import(request):
 
 @login_required
 def download_manager(request):
-    """Display user's download tasks"""
-    tasks = DownloadTask.objects.filter(user=request.user).order_by('-created_at')
+    """Display user's download tasks (playlist imports as one entry)"""
+    tasks = DownloadTask.objects.filter(
+        user=request.user, parent__isnull=True
+    ).order_by('-created_at')
     
     context = {
         'tasks': tasks,
-        'active_count': tasks.filter(status__in=['pending', 'downloading', 'processing']).count(),
+        'active_count': tasks.filter(status__in=DownloadTask.ACTIVE_STATUSES).count(),
     }
     return render(request, 'music/download_manager.html', context)
 
 
+@login_required
+@require_http_methods(["POST"])
+def download_cancel(request, pk):
+    """Cancel a queued or running download (a playlist import with all its items)"""
+    from .tasks import cancel_download
+    
+    task = get_object_or_404(DownloadTask, pk=pk, user=request.user)
+    if not task.is_active:
+        return JsonResponse({'error': f'Download is {task.status}'}, status=409)
+    
+    cancelled = cancel_download(task)
+    return JsonResponse({'task_id': str(task.id), 'status': 'cancelled', 'cancelled': cancelled})
+
+
+@login_required
+def download_progress(request):
+    """Live progress of active downloads (polling fallback for the WebSocket)"""
+    return JsonResponse({'tasks': DownloadTask.live_progress(request.user)})
+
+
 def api_search(request):
     query = escape(request.GET.get('q', '').strip())
     if len(query) < 2: